@@ -0,0 +1,933 @@
+"""Benchmarks for pycite. Standard library only.
+
+   python bench.py [--sizes 1000,100000,1000000] [--repeat 3] [--json results.json]
+                   [--baseline baseline.json] [--threshold 0.2] [name ...]
+       Run the regression suite (all of SUITE, or the names given), optionally saving the
+       results as JSON and failing if anything is slower than 'baseline' by more than
+       'threshold' (0.2 = 20%). A results file can be used as the next baseline.
+
+   python bench.py --report [name ...]
+       Print the one-off comparisons in REPORTS instead.
+"""
+import argparse
+import asyncio
+import gc
+import io
+import itertools
+import json
+import mmap
+import platform
+import random
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cite import Cite, Author, PageRange, render_bibliography, read_bibtex, write_bibtex
+from cite import render_cache_info, render_cache_clear, MLA, APA, format_many, PageSet, DuplicateIndex
+from cite import CitationRegistry, CiteStore, Snapshot, write_snapshot, SearchIndex, LiveBibliography
+from cite import read_mla, read_apa, format_threaded
+
+
+def make_cites(n):
+    cites = []
+    for i in range(n):
+        if i % 2:
+            cites.append(Cite('Incan Mythology {}'.format(i), authors=['Bob Smith', 'Sheila Pearson', 'James McDonald'],
+                              publisher='Macmillan', year=2002, in_title='All the Worlds Mythology',
+                              in_authors='Neil Tavistock', pages=[PageRange(10, 20), '25-40']))
+        else:
+            cites.append(Cite('Landscape Gardening {}'.format(i), authors=['Cynthia Davis', 'Jack Brown'],
+                              city='London', publisher='Wiley & Sons', year=1994))
+    return cites
+
+
+# The hand-written renderers the style templates replaced, kept as a reference point.
+
+def handwritten_mla(self, tokens):
+    opening_italics, closing_italics, opening_quote, closing_quote = tokens
+    in_larger = bool(self.in_title or self.in_authors)
+    output = []
+    append = output.append
+    if self.authors:
+        except_final_authors = self.authors[:-1]
+        efa_len = len(except_final_authors)
+        for idx, author in enumerate(except_final_authors):
+            if author.name == '':
+                continue
+            tmp = list(reversed(author))
+            append(tmp[0] + ', ' + ' '.join(tmp[1:]))
+            if efa_len > 1 and idx < efa_len - 1:
+                append(', ')
+        if len(self.authors) > 1:
+            append(', and ')
+        last_author = self.authors[-1]
+        if not (last_author.name == ''):
+            tmp = list(reversed(last_author))
+            append(tmp[0] + ', ' + ' '.join(tmp[1:]))
+        append('. ')
+
+    if in_larger:
+        append(opening_quote)
+    else:
+        append(opening_italics)
+    append(self.title)
+    if self.subtitle:
+        append(': ' + self.subtitle)
+    append('.')
+    if in_larger:
+        append(closing_quote)
+    else:
+        append(closing_italics)
+
+    if in_larger:
+        append(' ')
+        append(opening_italics)
+        append(self.in_title)
+        if self.in_subtitle:
+            append(': ' + self.in_subtitle)
+        append('.')
+        append(closing_italics)
+
+    if self.edition:
+        append(' ')
+        append(self.edition + ' ed.')
+
+    if self.in_authors_role and self.in_authors:
+        append(' ')
+        append(self.in_authors_role)
+    if self.in_authors:
+        append(' ')
+        except_final_authors = self.in_authors[:-1]
+        efa_len = len(except_final_authors)
+        for idx, author in enumerate(except_final_authors):
+            append(str(author))
+            if idx < efa_len - 2:
+                append(', ')
+            elif idx < efa_len - 1:
+                append(', and ')
+        append(str(self.in_authors[-1]))
+        append('.')
+
+    if self.city:
+        append(' ' + self.city)
+    if self.city and self.publisher:
+        append(':')
+    elif self.city and self.year:
+        append(',')
+    elif self.city:
+        append('.')
+    if self.publisher:
+        append(' ' + self.publisher)
+    if self.year and self.publisher:
+        append(',')
+    elif self.publisher:
+        append('.')
+    if self.year:
+        append(' ' + str(self.year) + '.')
+    elif self.date:
+        append(' ' + str(self.date.year) + '.')
+
+    if self.pages:
+        append(' ')
+        pages_len = len(self.pages)
+        if pages_len == 1 and len(self.pages[0]) == 1:
+            append(self.PAGE_ABBREV + '. ')
+        else:
+            append(self.PAGES_ABBREV + '. ')
+        append(', '.join([str(x) for x in self.pages]))
+        append('.')
+
+    return ''.join(output)
+
+
+def handwritten_apa(self, tokens):
+    opening_italics, closing_italics, _, _ = tokens
+    output = []
+    append = output.append
+    in_larger = bool(self.in_title or self.in_authors)
+
+    if self.authors:
+        tmp_copy = [x for x in self.authors]
+        for idx, _ in enumerate(tmp_copy):
+            tmp_copy[idx].initials = True
+        authors_reversed_copy = [reversed(x) for x in tmp_copy]
+        append(', '.join([str(x) for x in authors_reversed_copy[:-1]]))
+        if len(self.authors) > 1:
+            append(', & ')
+        append(str(authors_reversed_copy[-1]))
+
+    if self.year:
+        append(' (' + str(self.year) + ').')
+    elif self.date:
+        append(' (' + str(self.date.year) + ').')
+
+    append(' ')
+    if not in_larger:
+        append(opening_italics)
+    append(self.title)
+    if self.subtitle:
+        append(': ' + self.subtitle)
+    append('.')
+    if not in_larger:
+        append(closing_italics)
+
+    if self.city or self.publisher:
+        append(' ')
+    if self.city:
+        append(self.city)
+        if self.publisher:
+            append(': ')
+        else:
+            append('.')
+    if self.publisher:
+        append(self.publisher + '.')
+
+    if in_larger:
+        append(' ')
+        append(opening_italics)
+        append(self.in_title)
+        if self.in_subtitle:
+            append(': ' + self.in_subtitle)
+        if self.volume:
+            append(', ' + str(self.volume))
+        append(closing_italics)
+        if self.issue:
+            append('(' + str(self.issue) + ')')
+            if self.pages:
+                append(', ')
+    if self.pages:
+        append(', '.join([str(x) for x in self.pages]))
+        append('.')
+
+    if self.url:
+        append(' ' + self.url)
+
+    return ''.join(output)
+
+
+def markup_tokens(markup):
+    return (Cite.OPENING_ITALICS[markup], Cite.CLOSING_ITALICS[markup],
+            Cite.OPENING_QUOTE[markup], Cite.CLOSING_QUOTE[markup])
+
+
+GIVEN_NAMES = ('James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+               'Wei', 'Fatima', 'Hiroshi', 'Olga', 'José', 'Ngozi', 'Sven', 'Priya', 'Ahmed', 'Chloé')
+FAMILY_NAMES = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Wang', 'Li',
+                'Zhang', 'Kumar', 'Singh', 'Nguyen', 'Müller', 'Schmidt', 'Kowalski', 'Okafor', 'Tanaka', 'Silva')
+
+
+def make_author_names(n, distinct=5000, seed=1):
+    """Author names as they turn up across a bibliography: a few thousand people, some of them
+       cited far more often than others, some with middle names or initials"""
+    rng = random.Random(seed)
+    people = []
+    for _ in range(distinct):
+        parts = [rng.choice(GIVEN_NAMES)]
+        if rng.random() < 0.4:
+            parts.append(rng.choice(GIVEN_NAMES) if rng.random() < 0.5 else rng.choice('ABCDEFGHJKLMNPRSTW') + '.')
+        parts.append(rng.choice(FAMILY_NAMES))
+        people.append(' '.join(parts))
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    # Fresh str objects, as if each name had been read from a file
+    return [''.join(list(name)) for name in rng.choices(people, weights, k=n)]
+
+
+def timed(label, n, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('{:<40} {:>10.3f} ms {:>10.2f} us/record'.format(label, elapsed * 1e3, elapsed / n * 1e6))
+    return elapsed
+
+
+def bench_bibliography(n=20000):
+    cites = make_cites(n)
+    for style in (Cite.STYLE_MLA, Cite.STYLE_APA):
+        method = Cite.to_mla if style == Cite.STYLE_MLA else Cite.to_apa
+
+        def loop():
+            for cite in cites:
+                cite.markup = Cite.MARKUP_HTML
+            entries = sorted([method(cite) for cite in cites], key=str.casefold)
+            return ''.join(['<li>' + e + '</li>\n' for e in entries])
+
+        timed('{} per-object loop'.format(style), n, loop)
+        timed('{} render_bibliography'.format(style), n,
+              lambda: render_bibliography(cites, style, Cite.MARKUP_HTML, out=io.StringIO()))
+
+
+def bench_templates(n=20000):
+    cites = make_cites(n)
+    for cite in cites:
+        cite.markup = Cite.MARKUP_HTML
+    tokens = markup_tokens(Cite.MARKUP_HTML)
+    timed('mla hand-written', n, lambda: [handwritten_mla(cite, tokens) for cite in cites])
+    timed('mla compiled template', n, lambda: [cite.to_mla() for cite in cites])
+    timed('apa hand-written', n, lambda: [handwritten_apa(cite, tokens) for cite in cites])
+    timed('apa compiled template', n, lambda: [cite.to_apa() for cite in cites])
+
+
+def bench_render_cache(n=20000):
+    cites = make_cites(n)
+    render_cache_clear()
+    timed('to_mla first call (miss)', n, lambda: [cite.to_mla() for cite in cites])
+    timed('to_mla repeated (hit)', n, lambda: [cite.to_mla() for cite in cites])
+    for cite in cites[::10]:
+        cite.year = 2000
+    timed('to_mla after changing 10%', n, lambda: [cite.to_mla() for cite in cites])
+    print('{:<40} {}'.format('', render_cache_info()))
+
+
+def bench_authors(n=200000):
+    names = make_author_names(n)
+    timed('Author()', n, lambda: [Author(name) for name in names])
+    authors = [Author(name) for name in names]
+    timed('str(author)', n, lambda: [str(a) for a in authors])
+    timed('list(reversed(author))', n, lambda: [list(reversed(a)) for a in authors])
+    for a in authors:
+        a.initials = True
+    timed('str(author) with initials', n, lambda: [str(a) for a in authors])
+    timed('str(reversed(author)) with initials', n, lambda: [str(reversed(a)) for a in authors])
+    cites = [Cite('Title', authors=authors[i:i + 3], year=2000) for i in range(0, n, 3)]
+    timed('APA render, 3 authors', len(cites), lambda: [APA.render(cite, Cite.MARKUP_NONE) for cite in cites])
+    for a in authors:
+        a.initials = False
+    timed('MLA render, 3 authors', len(cites), lambda: [MLA.render(cite, Cite.MARKUP_NONE) for cite in cites])
+
+
+def bench_parallel(n=200000, max_workers=None):
+    """format_many() scaling from 1 to max_workers processes (default: CPU count, at least 2)"""
+    cites = make_cites(n)
+    max_workers = max_workers or max(2, os.cpu_count() or 1)
+    base = None
+    for workers in range(1, max_workers + 1):
+        elapsed = timed('format_many workers={}'.format(workers), n,
+                        lambda: format_many(cites, Cite.STYLE_APA, Cite.MARKUP_HTML, workers=workers, chunksize=2000))
+        base = base or elapsed
+        print('{:<40} {:>10.2f}x'.format('', base / elapsed))
+
+
+def bench_threads(n=200000, max_workers=None):
+    """Freezing citations, and format_threaded() from 1 to max_workers threads"""
+    cites = make_cites(n)
+    frozen = None
+
+    def freeze():
+        nonlocal frozen
+        frozen = [cite.freeze() for cite in cites]
+    timed('Cite.freeze()', n, freeze)
+    timed('hash(FrozenCite)', n, lambda: [hash(cite) for cite in frozen])
+    timed('APA render, Cite', n, lambda: [APA.render(cite, Cite.MARKUP_HTML) for cite in cites])
+    timed('APA render, FrozenCite', n, lambda: [APA.render(cite, Cite.MARKUP_HTML) for cite in frozen])
+    max_workers = max_workers or max(2, os.cpu_count() or 1)
+    base = None
+    for workers in range(1, max_workers + 1):
+        elapsed = timed('format_threaded workers={}'.format(workers), n,
+                        lambda: format_threaded(frozen, Cite.STYLE_APA, Cite.MARKUP_HTML, workers=workers, chunksize=2000))
+        base = base or elapsed
+        print('{:<40} {:>10.2f}x'.format('', base / elapsed))
+
+
+def bench_bibtex(n=50000):
+    fd, path = tempfile.mkstemp(suffix='.bib')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            timed('write_bibtex', n, lambda: write_bibtex(make_cites(n), f))
+        size = os.path.getsize(path)
+
+        def read_file():
+            with open(path, encoding='utf-8') as f:
+                for _ in read_bibtex(f):
+                    pass
+
+        def read_mmap():
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for _ in read_bibtex(m):
+                    pass
+
+        for label, func in (('read_bibtex text file', read_file), ('read_bibtex mmap', read_mmap)):
+            elapsed = timed(label, n, func)
+            print('{:<40} {:>10.2f} MB/s'.format('', size / elapsed / 1e6))
+
+        # Peak memory shouldn't depend on how much of the file has been read
+        for limit in (n // 10, n):
+            with open(path, encoding='utf-8') as f:
+                tracemalloc.start()
+                for i, _ in enumerate(read_bibtex(f)):
+                    if i == limit:
+                        break
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print('{:<40} {:>10.1f} KiB peak'.format('read_bibtex {} entries'.format(limit), peak / 1024))
+    finally:
+        os.unlink(path)
+
+
+def bench_pages(n=20000):
+    """Back-of-book index: n page references on one citation"""
+    rng = random.Random(1)
+    refs = []
+    for _ in range(n):
+        begin = rng.randrange(1, 5 * n)
+        refs.append(str(begin) if rng.random() < 0.5 else '{}-{}'.format(begin, begin + rng.randrange(1, 10)))
+    text = ', '.join(refs)
+    timed('[PageRange(s) for s in split]', n, lambda: [PageRange(s) for s in text.split(',')])
+    timed('PageSet.parse(text)', n, lambda: PageSet.parse(text))
+    pages = PageSet.parse(text)
+    print('{:<40} {:>10} ranges'.format('merged', len(pages)))
+    timed('PageSet.add, one at a time', n, lambda: [pages.add(r) for r in refs])
+    probes = [rng.randrange(1, 5 * n) for _ in range(n)]
+    ranges = [PageRange(s) for s in refs]
+    timed('page in list of PageRange', 100, lambda: [any([p in r for r in ranges]) for p in probes[:100]])
+    timed('page in PageSet', n, lambda: [p in pages for p in probes])
+    other = PageSet.parse(', '.join(refs[::-1][:n // 2]))
+    timed('PageSet union', n, lambda: pages | other)
+    timed('MLA render', 1, lambda: Cite('Index', pages=pages).to_mla())
+
+
+TITLE_WORDS = ('landscape', 'gardening', 'mythology', 'incan', 'history', 'modern', 'theory', 'practice',
+               'river', 'systems', 'urban', 'ancient', 'trade', 'northern', 'language', 'music', 'climate',
+               'economics', 'network', 'ritual', 'migration', 'coastal', 'empire', 'design', 'memory')
+
+
+def make_duplicated_cites(n, duplicate_rate=0.2, seed=1):
+    """n citations of which about duplicate_rate are re-exports of an earlier one: recased,
+       with a typo, or missing the year. Returns (cites, number of duplicates)."""
+    rng = random.Random(seed)
+    names = make_author_names(3 * n, seed=seed)
+    cites = []
+    duplicates = 0
+    for i in range(n):
+        if cites and rng.random() < duplicate_rate:
+            original = rng.choice(cites)
+            title = original.title
+            kind = rng.random()
+            if kind < 0.4:
+                title = title.upper()
+            elif kind < 0.8:
+                pos = rng.randrange(len(title))
+                title = title[:pos] + rng.choice('aeiou') + title[pos + 1:]
+            cites.append(Cite(title, authors=[a.name for a in original.authors],
+                              year=None if kind >= 0.8 else original.year))
+            duplicates += 1
+        else:
+            title = ' '.join(rng.choice(TITLE_WORDS) for _ in range(rng.randrange(3, 8))).capitalize()
+            cites.append(Cite(title, authors=names[3 * i:3 * i + rng.randrange(1, 4)], year=rng.randrange(1950, 2025)))
+    return cites, duplicates
+
+
+def bench_dedup(n=100000):
+    """DuplicateIndex.add() cost per citation grows with block sizes until they reach
+       max_block_size, then levels off. This corpus has only 20 family names, so its author
+       blocks fill far sooner than a real one's would."""
+    for size in (n // 100, n // 10, n):
+        cites, duplicates = make_duplicated_cites(size)
+        index = DuplicateIndex()
+        timed('DuplicateIndex.add n={}'.format(size), size, lambda: [index.add(c) for c in cites])
+        found = sum([len(cluster.cites) - 1 for cluster in index.clusters()])
+        print('{:<40} {:>10} of {} duplicates'.format('found', found, duplicates))
+
+
+def bench_in_text(n=100000):
+    """CitationRegistry per citation at growing document sizes; should stay flat"""
+    rng = random.Random(1)
+    names = make_author_names(n)
+    for size in (n // 100, n // 10, n):
+        cites = [Cite(' '.join(rng.choice(TITLE_WORDS) for _ in range(4)), authors=names[i:i + rng.randrange(1, 4)],
+                      year=rng.randrange(1990, 2000)) for i in range(size)]
+        for style in (Cite.STYLE_APA, Cite.STYLE_MLA):
+            registry = CitationRegistry(style)
+            timed('{} add n={}'.format(style, size), size, lambda: [registry.add(c) for c in cites])
+            timed('{} cite n={}'.format(style, size), size, lambda: [registry.cite(c, 25) for c in cites])
+
+
+async def load_test(address, n, clients):
+    """Send n format requests to a running server from 'clients' concurrent connections, each
+       waiting for one reply before sending the next. Returns (seconds, sorted latencies in
+       seconds, the server's stats)."""
+    records = [{'title': 'Incan Mythology {}'.format(i), 'authors': 'Bob Smith; Sheila Pearson',
+                'publisher': 'Macmillan', 'year': 2002, 'pages': '10-20'} for i in range(min(n, POOL_SIZE))]
+    latencies = []
+
+    async def connect():
+        if address.startswith('unix:'):
+            return await asyncio.open_unix_connection(address[len('unix:'):])
+        host, _, port = address.rpartition(':')
+        return await asyncio.open_connection(host, int(port))
+
+    async def client(count):
+        reader, writer = await connect()
+        for i in range(count):
+            start = time.perf_counter()
+            writer.write(json.dumps({'id': i, 'record': records[i % len(records)]}).encode('utf-8') + b'\n')
+            reply = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+            if 'error' in reply:
+                raise RuntimeError(reply['error'])
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(n // clients) for _ in range(clients)])
+    elapsed = time.perf_counter() - start
+    reader, writer = await connect()
+    writer.write(b'{"op": "stats"}\n')
+    stats = json.loads(await reader.readline())['stats']
+    writer.close()
+    return elapsed, sorted(latencies), stats
+
+
+def bench_server(n=20000, clients=64, address=None):
+    """Load test a local 'python -m cite --serve' (at 'address' if given, otherwise one started
+       per batch size)"""
+    def report(label, elapsed, latencies, stats):
+        timed_label = '{:<40} {:>10.0f} requests/s'.format(label, len(latencies) / elapsed)
+        print(timed_label)
+        print('{:<40} p50 {:.2f} p99 {:.2f} max {:.2f} ms'.format(
+            '  client latency', *[latencies[min(len(latencies) - 1, int(f * len(latencies)))] * 1e3
+                                  for f in (0.5, 0.99, 1.0)]))
+        print('{:<40} p50 {:.2f} p99 {:.2f} ms, mean batch {:.1f}'.format(
+            '  server latency', stats['latency_p50_ms'], stats['latency_p99_ms'], stats['mean_batch_size']))
+
+    if address is not None:
+        report('server at ' + address, *asyncio.run(load_test(address, n, clients)))
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        for batch_size in (1, 256):
+            address = 'unix:' + os.path.join(tmp, 'cite-{}.sock'.format(batch_size))
+            server = subprocess.Popen([sys.executable, '-m', 'cite', '--serve', address, '--style', 'apa',
+                                       '--batch-size', str(batch_size)],
+                                      stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+            try:
+                server.stderr.readline()  # 'listening on ...'
+                result = asyncio.run(load_test(address, n, clients))
+                report('batch size {}, {} clients'.format(batch_size, clients), *result)
+            finally:
+                server.terminate()
+                server.wait()
+
+
+def bench_store(n=1000000):
+    """CiteStore bulk load, indexed queries and the render cache, on disk"""
+    rng = random.Random(1)
+    names = make_author_names(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        with CiteStore(os.path.join(tmp, 'bench.db')) as store:
+            elapsed = 0.0
+            for start in range(0, n, POOL_SIZE):
+                cites = [Cite(' '.join(rng.choice(TITLE_WORDS) for _ in range(4)).capitalize(),
+                              authors=names[i:i + 1 + i % 3], year=rng.randrange(1950, 2025),
+                              in_title=rng.choice(TITLE_WORDS).capitalize() + ' Review', pages='10-20')
+                         for i in range(start, min(n, start + POOL_SIZE))]
+                began = time.perf_counter()
+                store.add_many(cites)
+                elapsed += time.perf_counter() - began
+            print('{:<40} {:>10.3f} ms {:>10.2f} us/record'.format('add_many', elapsed * 1e3, elapsed / n * 1e6))
+            print('{:<40} {:>10.1f} MiB'.format('database size', os.path.getsize(store.path) / (1 << 20)))
+            for label, query in (('query author and year', {'author': 'Tanaka', 'year': 2000}),
+                                 ('query year range', {'year': (2000, 2001)}),
+                                 ('query title prefix', {'title': 'landscape gardening'}),
+                                 ('query in_title and year', {'in_title': 'river review', 'year': 1999})):
+                rows = sum(1 for _ in store.query(**query))
+                timed('{} ({} rows)'.format(label, rows), rows, lambda: list(store.query(**query)))
+            rows = sum(1 for _ in store.query(year=(2000, 2009)))
+            timed('render, cold', rows, lambda: list(store.render(Cite.STYLE_APA, year=(2000, 2009))))
+            timed('render, cached', rows, lambda: list(store.render(Cite.STYLE_APA, year=(2000, 2009))))
+            timed('query everything', n, lambda: sum(1 for _ in store.query()))
+
+
+def bench_snapshot(n=200000):
+    """Startup time: loading a pickled list of citations against opening a snapshot"""
+    cites = make_cites(n)
+    names = make_author_names(n)
+    for i, cite in enumerate(cites):
+        cite.authors = names[i:i + 1 + i % 3]
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = os.path.join(tmp, 'cites.pickle')
+        snapshot_path = os.path.join(tmp, 'cites.snapshot')
+
+        def write_pickle():
+            with open(pickle_path, 'wb') as f:
+                pickle.dump(cites, f, pickle.HIGHEST_PROTOCOL)
+        timed('write pickle', n, write_pickle)
+        timed('write_snapshot', n, lambda: write_snapshot(cites, snapshot_path))
+        for label, path in (('pickle', pickle_path), ('snapshot', snapshot_path)):
+            print('{:<40} {:>10.1f} MiB'.format(label + ' size', os.path.getsize(path) / (1 << 20)))
+        del cites
+        gc.collect()
+
+        def load_pickle():
+            with open(pickle_path, 'rb') as f:
+                return pickle.load(f)
+        timed('pickle.load, then cites[n // 2].to_mla()', 1, lambda: load_pickle()[n // 2].to_mla())
+        timed('Snapshot(), then [n // 2].to_mla()', 1, lambda: Snapshot(snapshot_path)[n // 2].to_mla())
+        with Snapshot(snapshot_path) as snapshot:
+            rng = random.Random(1)
+            indexes = [rng.randrange(n) for _ in range(10000)]
+            timed('random access .title', len(indexes), lambda: [snapshot[i].title for i in indexes])
+            timed('random access .to_mla()', len(indexes), lambda: [snapshot[i].to_mla() for i in indexes])
+            timed('iterate, .to_mla()', n, lambda: [view.to_mla() for view in snapshot])
+            timed('iterate, .to_cite()', n, lambda: [view.to_cite() for view in snapshot])
+
+
+def make_words(n, seed=1):
+    """n distinct made-up words"""
+    rng = random.Random(seed)
+    syllables = [c + v for c in 'bcdfghklmnprstvz' for v in 'aeiou'] + ['the', 'ing', 'ion', 'ers']
+    words = set()
+    while len(words) < n:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randrange(1, 5))))
+    return sorted(words)
+
+
+def bench_search(n=1000000, queries=2000):
+    """SearchIndex build time and query latency, against a linear scan"""
+    rng = random.Random(1)
+    vocabulary = make_words(20000)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    names = make_author_names(n)
+    cites = [Cite(' '.join(rng.choices(vocabulary, weights, k=rng.randrange(2, 7))).capitalize(),
+                  authors=names[i:i + 1 + i % 3], year=rng.randrange(1950, 2025)) for i in range(n)]
+    index = SearchIndex()
+    timed('SearchIndex.add_many', n, lambda: index.add_many(cites))
+
+    # What someone might type: the start of a title word, an author and a title word, a
+    # title word and a year, two title words
+    typed = []
+    for _ in range(queries):
+        cite = rng.choice(cites)
+        words = cite.title.lower().split()
+        kind = rng.randrange(4)
+        if kind == 0:
+            query = words[0][:rng.randrange(1, len(words[0]) + 1)]
+        elif kind == 1:
+            query = cite.authors[0].family_name + ' ' + words[-1][:3]
+        elif kind == 2:
+            query = words[0] + ' ' + str(cite.year)
+        else:
+            query = ' '.join(words[:2])
+        typed.append(query)
+    latencies = []
+    for query in typed:
+        start = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print('{:<40} p50 {:.3f} p99 {:.3f} max {:.3f} ms (budget {:.0f} ms)'.format(
+        'search', *[latencies[min(len(latencies) - 1, int(f * len(latencies)))] * 1e3 for f in (0.5, 0.99, 1.0)],
+        SearchIndex.BUDGET * 1e3))
+    timed('complete', queries, lambda: [index.complete(query) for query in typed])
+
+    def scan(query):
+        needle = query.lower()
+        return [c for c in cites if needle in c.title.lower() or any(needle in a.name.lower() for a in c.authors)][:10]
+    timed('linear scan (per query)', 1, lambda: scan(typed[0]))
+    removed = cites[:n // 10]
+    timed('remove', len(removed), lambda: [index.remove(c) for c in removed])
+    timed('add', len(removed), lambda: index.add_many(removed))
+
+
+def bench_live(n=50000, edits=1000):
+    """One edit to a large reference list: LiveBibliography.refresh() against re-rendering it all"""
+    rng = random.Random(1)
+    names = make_author_names(n)
+    cites = [Cite(' '.join(rng.choice(TITLE_WORDS) for _ in range(4)), authors=names[i:i + rng.randrange(1, 4)],
+                  publisher='Macmillan', year=rng.randrange(1990, 2000)) for i in range(n)]
+    bib = None
+
+    def build():
+        nonlocal bib
+        bib = LiveBibliography(cites, Cite.STYLE_APA)
+    timed('LiveBibliography build', n, build)
+    timed('render_bibliography (per edit)', 1, lambda: render_bibliography(cites, Cite.STYLE_APA))
+    edited = rng.sample(cites, edits)
+
+    def edit_one(field):
+        for cite in edited:
+            if field == 'year':
+                cite.year += 1
+            else:
+                cite.title = rng.choice(TITLE_WORDS) + ' ' + cite.title
+            bib.refresh()
+    timed('edit year + refresh', edits, lambda: edit_one('year'))
+    timed('edit title + refresh (moves)', edits, lambda: edit_one('title'))
+
+    def edit_batch():
+        for cite in edited:
+            cite.year += 1
+        bib.refresh()
+    timed('{} edits, one refresh'.format(edits), edits, edit_batch)
+    bib.close()
+
+
+def bench_sort(n=1000000):
+    """Ordering a reference list by the style's sort key: first with the keys computed, then
+       with them cached on the citations, against sorting by the rendered entry"""
+    rng = random.Random(1)
+    names = make_author_names(n + 3)
+    articles = ('', '', '', 'The ', 'A ')
+    cites = [Cite(rng.choice(articles) + ' '.join(rng.choice(TITLE_WORDS) for _ in range(4)).capitalize(),
+                  authors=names[i:i + rng.randrange(1, 4)], year=rng.randrange(1950, 2020)) for i in range(n)]
+    for style in (MLA, APA):
+        timed('{} sort, keys computed'.format(style.name), n, lambda: sorted(cites, key=style.sort_key))
+        timed('{} sort, keys cached'.format(style.name), n, lambda: sorted(cites, key=style.sort_key))
+    timed('mla sort by rendered entry', n, lambda: sorted(cites, key=lambda c: MLA.render(c, Cite.MARKUP_NONE).casefold()))
+
+
+def bench_read_formatted(n=100000):
+    """Reading reference lists back in from text, one citation per line"""
+    cites = make_cites(n)
+    for style, read in ((Cite.STYLE_MLA, read_mla), (Cite.STYLE_APA, read_apa)):
+        for markup, name in ((Cite.MARKUP_NONE, 'plain'), (Cite.MARKUP_HTML, 'html')):
+            text = render_bibliography(cites, style, markup)
+            timed('read_{} {}'.format(style, name), n, lambda: list(read(io.StringIO(text))))
+            timed('read_{} {}, markup given'.format(style, name), n, lambda: list(read(io.StringIO(text), markup)))
+
+
+def bench_from_records(n=200000):
+    """Building Cites from records, e.g. a CSV or database export: one at a time against in bulk"""
+    rng = random.Random(1)
+    names = make_author_names(1000)
+    records = [{'title': 'Incan Mythology {}'.format(i), 'subtitle': '', 'authors': '; '.join(rng.sample(names, 2)),
+                'pages': '{}-{}'.format(i % 500, i % 500 + 20), 'city': 'London', 'publisher': 'Macmillan',
+                'year': str(1990 + i % 30), 'edition': '', 'in_title': '', 'volume': '', 'issue': '', 'url': ''}
+               for i in range(n)]
+    timed('Cite.from_dict', n, lambda: [Cite.from_dict(record) for record in records])
+    timed('Cite.from_records', n, lambda: Cite.from_records(records))
+
+
+def bench_memory(n=100000):
+    """Bytes per record, measured with tracemalloc.
+
+       On CPython 3.11 (x86-64), for the original __dict__ layout, plain __slots__, __slots__
+       plus the render cache's revision tracking, and then Cite.pages stored as a PageSet:
+
+                                          __dict__   __slots__   + revisions   + PageSet
+       PageRange                             200        120          120          120
+       Author                                 96         56           92           92
+       Cite (title only)                     408        360          460          444
+       Cite (2 authors, 2 page ranges)       872        584          756          740
+    """
+    def measure(label, make):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        objs = [make(i) for i in range(n)]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        print('{:<40} {:>10.1f} bytes/record'.format(label, size / n))
+        return objs
+
+    measure('PageRange', lambda i: PageRange(i, i + 10))
+    measure('Author', lambda i: Author('Cynthia Davis'))
+    measure('Cite (title only)', lambda i: Cite('Landscape Gardening'))
+    measure('Cite (2 authors, 2 page ranges)',
+            lambda i: Cite('Landscape Gardening', authors=['Cynthia Davis', 'Jack Brown'], city='London',
+                           publisher='Wiley & Sons', year=1994, pages=[PageRange(10, 20), PageRange(25, 40)]))
+
+
+REPORTS = {
+    'bibliography': bench_bibliography,
+    'templates': bench_templates,
+    'render_cache': bench_render_cache,
+    'authors': bench_authors,
+    'parallel': bench_parallel,
+    'threads': bench_threads,
+    'bibtex': bench_bibtex,
+    'pages': bench_pages,
+    'dedup': bench_dedup,
+    'in_text': bench_in_text,
+    'server': bench_server,
+    'store': bench_store,
+    'snapshot': bench_snapshot,
+    'search': bench_search,
+    'live': bench_live,
+    'sort': bench_sort,
+    'read_formatted': bench_read_formatted,
+    'from_records': bench_from_records,
+    'memory': bench_memory,
+}
+
+
+# Regression suite
+#
+# Each entry in SUITE takes a record count n, does its setup, and returns a function that
+# processes n records. Inputs are drawn from a pool of at most POOL_SIZE distinct objects,
+# reused as often as needed, so that the 1M-record runs don't need 1M objects in memory.
+
+POOL_SIZE = 10000
+SIZES = (1000, 100000, 1000000)
+
+
+def cycled(pool, n):
+    return itertools.islice(itertools.cycle(pool), n)
+
+
+def cite_kwargs(i):
+    if i % 2:
+        return dict(title='Incan Mythology {}'.format(i), authors=['Bob Smith', 'Sheila Pearson', 'James McDonald'],
+                    publisher='Macmillan', year=2002, in_title='All the Worlds Mythology',
+                    in_authors='Neil Tavistock', pages=[PageRange(10, 20), '25-40'])
+    return dict(title='Landscape Gardening {}'.format(i), authors=['Cynthia Davis', 'Jack Brown'],
+                city='London', publisher='Wiley & Sons', year=1994)
+
+
+def suite_construct(n):
+    pool = [cite_kwargs(i) for i in range(min(n, POOL_SIZE))]
+
+    def run():
+        for kwargs in cycled(pool, n):
+            Cite(**kwargs)
+    return run
+
+
+def suite_render(method):
+    def setup(n):
+        pool = make_cites(min(n, POOL_SIZE))
+
+        def run():
+            # Every citation renders from scratch: the render cache is emptied before each pass
+            left = n
+            while left > 0:
+                render_cache_clear()
+                for cite in pool[:left]:
+                    method(cite)
+                left -= len(pool)
+        return run
+    return setup
+
+
+def suite_author_iter(n):
+    pool = [Author(name, initials=bool(i % 2)) for i, name in enumerate(make_author_names(min(n, POOL_SIZE)))]
+
+    def run():
+        for author in cycled(pool, n):
+            list(author)
+    return run
+
+
+def suite_author_reversed(n):
+    pool = [Author(name, initials=bool(i % 2)) for i, name in enumerate(make_author_names(min(n, POOL_SIZE)))]
+
+    def run():
+        for author in cycled(pool, n):
+            list(reversed(author))
+    return run
+
+
+def suite_page_range_parse(n):
+    rng = random.Random(1)
+    pool = []
+    for _ in range(min(n, POOL_SIZE)):
+        begin = rng.randrange(1, 2000)
+        kind = rng.random()
+        if kind < 0.4:
+            pool.append(str(begin))
+        elif kind < 0.8:
+            pool.append('{}-{}'.format(begin, begin + rng.randrange(1, 30)))
+        else:
+            pool.append('{} - {}'.format(begin, begin + rng.randrange(1, 30)))
+
+    def run():
+        for s in cycled(pool, n):
+            PageRange(s)
+    return run
+
+
+SUITE = {
+    'construct': suite_construct,
+    'to_mla': suite_render(Cite.to_mla),
+    'to_apa': suite_render(Cite.to_apa),
+    'author_iter': suite_author_iter,
+    'author_reversed': suite_author_reversed,
+    'page_range_parse': suite_page_range_parse,
+}
+
+
+def run_suite(names, sizes, repeat):
+    """{name: {str(size): microseconds per record}}, best of 'repeat' runs each"""
+    results = {}
+    for name in names:
+        results[name] = {}
+        for n in sizes:
+            run = SUITE[name](n)
+            best = None
+            for _ in range(repeat):
+                gc.collect()
+                gc.disable()
+                try:
+                    start = time.perf_counter()
+                    run()
+                    elapsed = time.perf_counter() - start
+                finally:
+                    gc.enable()
+                best = elapsed if best is None else min(best, elapsed)
+            results[name][str(n)] = best / n * 1e6
+            print('{:<20} {:>9} {:>12.3f} us/record'.format(name, n, results[name][str(n)]))
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """(name, size, baseline us, current us) for each measurement slower than the baseline by
+       more than 'threshold'. Measurements missing from either side are skipped."""
+    regressions = []
+    for name, by_size in results.items():
+        for size, current in by_size.items():
+            before = baseline.get(name, {}).get(size)
+            if before is not None and current > before * (1 + threshold):
+                regressions.append((name, size, before, current))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pycite benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--report', action='store_true', help='run the one-off comparisons in REPORTS')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help='comma-separated record counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, as a fraction (default 0.2)')
+    parser.add_argument('--address', help="with --report server: load test the server already running here "
+                                          "('host:port' or 'unix:/path') instead of starting one")
+    args = parser.parse_args(argv)
+
+    if args.report:
+        for name in args.names or list(REPORTS):
+            print('== ' + name)
+            if name == 'server' and args.address:
+                bench_server(address=args.address)
+            else:
+                REPORTS[name]()
+        return 0
+
+    unknown = [name for name in args.names if name not in SUITE]
+    if unknown:
+        parser.error('unknown benchmark(s): {}. Choose from: {}'.format(' '.join(unknown), ' '.join(SUITE)))
+    sizes = [int(x) for x in args.sizes.split(',')]
+    results = run_suite(args.names or list(SUITE), sizes, args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'unit': 'us/record', 'results': results}, f, indent=2)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, size, before, current in regressions:
+            print('REGRESSION {} at {}: {:.3f} -> {:.3f} us/record (+{:.0%})'.format(
+                name, size, before, current, current / before - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,30 @@
+import argparse
+import array
+import bisect
+import codecs
+import collections
+import csv
 import datetime
+import functools
+import heapq
+import itertools
+import json
+import math
+import mmap
+import operator
+import os
+import re
+import sqlite3
+import struct
+import sys
+import time
+import unicodedata
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows; --stats then reports no peak memory
+    resource = None
 
 # Types of referencing:
 # Chicago
@@ -17,6 +43,33 @@ import datetime
 #  In-text vs page footnote vs end-of-document reference list, 
 # 
 
+# Every change to a Cite or Author takes the next number from here, so a cached rendering is
+# still good as long as nothing it was made from has a later revision.
+_revisions = itertools.count(1)
+
+# Renderings cached before this revision are stale (see render_cache_clear())
+_render_cache_epoch = 0
+_render_cache_counts = [0, 0]   # hits, misses
+
+# Cites and Authors that a LiveBibliography is watching -> the bibliographies watching them
+_watchers = {}
+
+RenderCacheInfo = collections.namedtuple('RenderCacheInfo', 'hits misses')
+
+
+def render_cache_info():
+    """Hits and misses of the per-citation render cache since the last render_cache_clear()"""
+    return RenderCacheInfo(*_render_cache_counts)
+
+
+def render_cache_clear():
+    """Drop every citation's cached renderings, e.g. after changing Cite.PAGE_ABBREV, and reset
+       the counters"""
+    global _render_cache_epoch
+    _render_cache_epoch = next(_revisions)
+    _render_cache_counts[:] = [0, 0]
+
+
 class Cite:
     """Class for any type of citation."""
     SUPPORTED_ATTRS = ('title', 'subtitle', 'authors', 'pages',
@@ -24,6 +77,8 @@ class Cite:
                     'in_title', 'in_subtitle', 'in_authors', 'in_authors_role', 
                     'journal', 'volume', 'issue', 'date', 'url', 'retrieved_date', 
                     'markup')
+    # No per-instance __dict__: with millions of citations in memory it costs more than the fields
+    __slots__ = SUPPORTED_ATTRS + ('_rev', '_render_cache', '_render_rev')
 
     MARKUP_NONE = 0
     MARKUP_MARKDOWN = 1
@@ -42,6 +97,19 @@ class Cite:
         MARKUP_MARKDOWN: '*',
         MARKUP_HTML: '</em>'
     }
+    OPENING_QUOTE = {
+        MARKUP_NONE: '"',
+        MARKUP_MARKDOWN: '"',
+        MARKUP_HTML: '&ldquo;'
+    }
+    CLOSING_QUOTE = {
+        MARKUP_NONE: '"',
+        MARKUP_MARKDOWN: '"',
+        MARKUP_HTML: '&rdquo;'
+    }
+
+    STYLE_MLA = 'mla'
+    STYLE_APA = 'apa'
 
     # Plural properties are lists
     def __init__(self, title, subtitle=None, authors=None, pages=None,
@@ -50,6 +118,7 @@ class Cite:
                     volume=None, issue=None, date=None, url=None, retrieved_date=None,
                     markup=MARKUP_NONE):
         # Careful when adding new attributes because of __setattr__()
+        object.__setattr__(self, '_render_cache', None)
         self.title = title
         self.subtitle = subtitle
         self.authors = authors
@@ -77,280 +146,484 @@ class Cite:
         if name not in self.SUPPORTED_ATTRS:
             raise AttributeError("The attribute '{}' is unsupported. Supported attributes: {}".format(
                 name, ' '.join(self.SUPPORTED_ATTRS)))
-        if name[-1] == 's':
+        if name == 'pages':
+            if type(value) is not PageSet or value._owner is not self:
+                value = PageSet(value, self)
+        elif name[-1] == 's':
             if value is None:
                 value = []
-            if type(value) is not list:
+            if not isinstance(value, list):
                 value = [value]
-        if name == 'authors':
-            for idx, a in enumerate(value):
-                if type(a) is not Author:
-                    author = Author(a)
-                    value[idx] = author
-        if name == 'pages':
-            for idx, elem in enumerate(value):
-                if type(elem) is not PageRange:
-                    pr = PageRange(elem)
-                    value[idx] = pr
+            # authors or in_authors: pages is the only other plural
+            value = _AttrList(self, _to_author, value)
         super().__setattr__(name, value)
+        # The render cache is keyed by markup, so changing it doesn't make anything stale
+        if name != 'markup':
+            self._changed()
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.SUPPORTED_ATTRS if hasattr(self, name)}
 
-    def to_mla(self):
-        in_larger = bool(self.in_title or self.in_authors)
-        output = ''
-        if self.authors:
-            except_final_authors = self.authors[:-1]
-            efa_len = len(except_final_authors)
-            for idx, author in enumerate(except_final_authors):
-                if author.name == '' and author.lastname == '': 
-                    continue
-                tmp = list(reversed(author))
-                output += tmp[0] + ', ' + ' '.join(tmp[1:])
-                if efa_len > 1 and idx < efa_len - 1:
-                    output += ', '
-            if len(self.authors) > 1:
-                output += ', and '
-            last_author = self.authors[-1]
-            if not (last_author.name == '' and last_author.lastname == ''):
-                tmp = list(reversed(last_author))
-                output += tmp[0] + ', ' + ' '.join(tmp[1:])
-            output += '. '
-
-        if not in_larger:
-            output += self.OPENING_ITALICS[self.markup]
-        if in_larger:
-            if self.markup == self.MARKUP_HTML:
-                output += '&ldquo;'
-            else:
-                output += '"'
-        output += self.title
-        if self.subtitle:
-            output += ': ' + self.subtitle
-        output += '.'
-        if not in_larger:
-            output += self.CLOSING_ITALICS[self.markup]
-        if in_larger:
-            if self.markup == self.MARKUP_HTML:
-                output += '&rdquo;'
-            else:
-                output += '"'
-
-        if in_larger:
-            output += ' '
-            output += self.OPENING_ITALICS[self.markup]
-            output += self.in_title
-            if self.in_subtitle:
-                output += ': ' + self.in_subtitle
-            output += '.'
-            output += self.CLOSING_ITALICS[self.markup]
-
-        if self.edition:
-            output += ' '
-            output += self.edition + ' ed.'
-
-        if self.in_authors_role and self.in_authors:
-            output += ' '
-            output += self.in_authors_role
-        if self.in_authors:
-            output += ' '
-            except_final_authors = self.in_authors[:-1]
-            efa_len = len(except_final_authors)
-            for idx, author in enumerate(except_final_authors):
-                output += str(author)
-                if idx < efa_len - 2:
-                    output += ', '
-                elif idx < efa_len - 1:
-                    output += ', and '
-            output += str(self.in_authors[-1])
-            output += '.'
-
-        if self.city:
-            output += ' ' + self.city
-        if self.city and self.publisher:
-            output += ':'
-        elif self.city and self.year:
-            output += ','
-        elif self.city:
-            output += '.'
-        if self.publisher:
-            output += ' ' + self.publisher
-        if self.year and self.publisher:
-            output += ','
-        elif self.publisher:
-            output += '.'
-        if self.year:
-            output += ' ' + str(self.year) + '.'
-        elif self.date:
-            output += ' ' + str(self.date.year) + '.'
-
-        if self.pages:
-            output += ' '
-            pages_len = len(self.pages)
-            if pages_len == 1 and len(self.pages[0]) == 1:
-                output += self.PAGE_ABBREV + '. '
-            else:
-                output += self.PAGES_ABBREV + '. '
-            for idx, pr in enumerate(self.pages):
-                if idx < pages_len - 1:
-                    output += str(pr) + ', '
-                else:
-                    output += str(pr)
-            output += '.'
+    def __setstate__(self, state):
+        object.__setattr__(self, '_render_cache', None)
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def _changed(self):
+        object.__setattr__(self, '_rev', next(_revisions))
+        if _watchers:
+            for watcher in _watchers.get(self, ()):
+                watcher._touched(self)
+
+    def _revision(self):
+        """Latest revision of this citation or any of its authors"""
+        rev = self._rev
+        for author in self.authors:
+            if author._rev > rev:
+                rev = author._rev
+        for author in self.in_authors:
+            if author._rev > rev:
+                rev = author._rev
+        return rev
+
+    def _cache(self):
+        """The render cache, emptied first if anything it was made from has changed"""
+        rev = self._revision()
+        if rev < _render_cache_epoch:
+            rev = _render_cache_epoch
+        cache = self._render_cache
+        if cache is None or self._render_rev != rev:
+            cache = {}
+            object.__setattr__(self, '_render_cache', cache)
+            object.__setattr__(self, '_render_rev', rev)
+        return cache
 
+    def _cached_render(self, style, markup):
+        cache = self._cache()
+        key = (style, markup)
+        try:
+            output = cache[key]
+            _render_cache_counts[0] += 1
+        except KeyError:
+            output = cache[key] = style.render(self, markup)
+            _render_cache_counts[1] += 1
         return output
 
+    def _cached_sort_key(self, style):
+        # Kept beside the renderings, keyed by the style alone
+        cache = self._cache()
+        try:
+            return cache[style]
+        except KeyError:
+            key = cache[style] = style._collate(self)
+            return key
+
+    @classmethod
+    def from_dict(cls, record):
+        """Build a Cite from a dict of attribute names to values, e.g. a JSON object or CSV row.
+
+           Values may all be strings: authors and in_authors are separated by ';', pages are a
+           page list like '5--9, 12', numbers and ISO dates are converted, and empty strings
+           count as missing. Numbers given for text attributes (e.g. an edition of 2) become
+           strings; other values that wouldn't render raise TypeError or ValueError.
+        """
+        kwargs = {}
+        for name, value in record.items():
+            if name not in cls.SUPPORTED_ATTRS:
+                raise AttributeError("The attribute '{}' is unsupported. Supported attributes: {}".format(
+                    name, ' '.join(cls.SUPPORTED_ATTRS)))
+            if value is None or value == '':
+                continue
+            if type(value) is not str:
+                value = _checked_value(name, value)
+            elif name in _FIELD_PARSERS:
+                value = _FIELD_PARSERS[name](value)
+            kwargs[name] = value
+        if 'title' not in kwargs:
+            raise ValueError('Record has no title')
+        journal = kwargs.pop('journal', None)
+        cite = cls(**kwargs)
+        if journal is not None:
+            cite.journal = journal
+        return cite
+
+    @classmethod
+    def from_records(cls, records):
+        """Build Cites from many records, read as from_dict() reads them but faster: the
+           attribute names are checked once per distinct set of them rather than per record,
+           and the values are stored without going through __setattr__(). A bad record doesn't
+           stop the rest. Returns a RecordsReport: the Cites built, in order, and an (index,
+           message) pair for each record that couldn't be read.
+        """
+        cites = []
+        errors = []
+        plans = {}
+        for index, record in enumerate(records):
+            try:
+                keys = tuple(record.keys())
+                plan = plans.get(keys)
+                if plan is None:
+                    plan = plans[keys] = _bulk_plan(keys)
+                if type(plan) is str:
+                    raise AttributeError(plan)
+                values = _BULK_DEFAULTS.copy()
+                for (i, name, parse), value in zip(plan, record.values()):
+                    if value is None or value == '':
+                        continue
+                    if type(value) is not str:
+                        value = _checked_value(name, value)
+                    elif parse is not None:
+                        value = parse(value)
+                    values[i] = value
+                if values[0] is None:
+                    raise ValueError('Record has no title')
+                cites.append(_bulk_cite(cls, values))
+            except (ValueError, TypeError, AttributeError) as e:
+                errors.append((index, str(e)))
+        return RecordsReport(cites, errors)
+
+    @classmethod
+    def from_mla(cls, text, markup=None):
+        """Read back a citation as to_mla() writes it, in any markup (worked out from the text
+           unless given). Raises ValueError if it can't be read."""
+        return _read_formatted(cls.STYLE_MLA, text, markup)
+
+    @classmethod
+    def from_apa(cls, text, markup=None):
+        """Read back a citation as to_apa() writes it (see from_mla())"""
+        return _read_formatted(cls.STYLE_APA, text, markup)
+
+    def freeze(self):
+        """An immutable, hashable copy of this citation (see FrozenCite)"""
+        values = [getattr(self, name, None) for name in self.SUPPORTED_ATTRS]
+        values[_FROZEN_AUTHORS_IDX] = tuple([FrozenAuthor(a._parsed.name, a._initials) for a in self.authors])
+        values[_FROZEN_IN_AUTHORS_IDX] = tuple([FrozenAuthor(a._parsed.name, a._initials) for a in self.in_authors])
+        values[_FROZEN_PAGES_IDX] = FrozenPageSet(self.pages)
+        return FrozenCite._make(values)
+
+    def to_mla(self):
+        return self._cached_render(MLA, self.markup)
 
     def to_apa(self):
-        output = ''
-        in_larger = bool(self.in_title or self.in_authors)
-
-        if self.authors:
-            tmp_copy = [x for x in self.authors]
-            for idx, _ in enumerate(tmp_copy):
-                tmp_copy[idx].initials = True
-            authors_reversed_copy = [reversed(x) for x in tmp_copy]
-            output += ', '.join([str(x) for x in authors_reversed_copy[:-1]])
-            if len(self.authors) > 1:
-                output += ', & ' 
-            output += str(authors_reversed_copy[-1])
-
-        if self.year:
-            output += ' (' + str(self.year) + ').'
-        elif self.date:
-            output += ' (' + str(self.date.year) + ').'
-
-        output += ' '
-        if not in_larger: 
-            output += self.OPENING_ITALICS[self.markup]
-        output += self.title
-        if self.subtitle:
-            output += ': ' + self.subtitle
-        output += '.'
-        if not in_larger:
-            output += self.CLOSING_ITALICS[self.markup]
-
-        if self.city or self.publisher:
-            output += ' '
-        if self.city:
-            output += self.city
-            if self.publisher:
-                output += ': '
-            else:
-                output += '.'
-        if self.publisher:
-            output += self.publisher + '.'
-
-        if in_larger:
-            output += ' '
-            output += self.OPENING_ITALICS[self.markup]
-            output += self.in_title
-            if self.in_subtitle:
-                output += ': ' + self.in_subtitle
-            if self.volume:
-                output += ', ' + str(self.volume)
-            output += self.CLOSING_ITALICS[self.markup]
-            if self.issue:
-                output += '(' + str(self.issue) + ')'
-                if self.pages:
-                    output += ', '
-        if self.pages:
-            output += ', '.join([str(x) for x in self.pages])
-            output += '.'
-
-        if self.url:
-            output += ' ' + self.url
-
-        return output 
+        return self._cached_render(APA, self.markup)
 
-    
-    def to_bibtex(self, strict=False):
-        # TODO use template
-        output = '@'
-        
-        if self.in_title and self.volume:
-            output += 'article' 
-
-        output += '{'
-        output += '  author\t\t= "' + ', '.join([str(x) for x in self.authors]) + '",\n'
-        output += '  title\t\t= ",' + self.title
-        if self.subtitle:
-            output += ': ' + self.subtitle
-        output += '",\n'
-        output += '  journal\t\t= "' + self.in_title + '",\n'
-        if self.year:
-            str_year = str(self.year)
-        elif self.date:
-            str_year = str(self.date.year)
-        if str_year:
-            output += '  year\t\t= "' + str_year + '",\n'
-        output += '}\n'
+    def to_apa_in_text(self, pages=None):
+        """APA parenthetical citation, e.g. '(Smith & Pearson, 2002, p. 25)'. Use a
+           CitationRegistry to tell apart works by the same authors in the same year."""
+        return CitationRegistry(self.STYLE_APA, self.markup).cite(self, pages)
+
+    def to_mla_in_text(self, pages=None):
+        """MLA parenthetical citation, e.g. '(Smith and Pearson 25)'"""
+        return CitationRegistry(self.STYLE_MLA, self.markup).cite(self, pages)
+
+    def to_bibtex(self, strict=False, key=None):
+        if key is None:
+            key = _bibtex_key(self)
+        style = BIBTEX_STRICT if strict else BIBTEX
+        return '@' + _bibtex_type(self) + '{' + key + ',\n' + style.render(self, self.MARKUP_NONE) + '}\n'
+
+
+# Where Cite.freeze() finds the fields it converts
+_FROZEN_AUTHORS_IDX = Cite.SUPPORTED_ATTRS.index('authors')
+_FROZEN_IN_AUTHORS_IDX = Cite.SUPPORTED_ATTRS.index('in_authors')
+_FROZEN_PAGES_IDX = Cite.SUPPORTED_ATTRS.index('pages')
+
+
+def _to_author(value):
+    if type(value) is Author:
+        return value
+    if type(value) is FrozenAuthor:
+        return Author(value.name, value.initials)
+    return Author(value)
+
+
+def _to_number(value):
+    return int(value) if value.isdigit() else value
+
+
+def _split_names(value):
+    return [x.strip() for x in value.split(';') if x.strip()]
+
+
+def _to_markup(value):
+    if type(value) is str:
+        value = int(value)
+    if value not in Cite.OPENING_ITALICS:
+        raise ValueError('Unknown markup: {!r}'.format(value))
+    return value
+
+
+# How Cite.from_dict() reads attributes given as strings
+_FIELD_PARSERS = {
+    'authors': _split_names,
+    'in_authors': _split_names,
+    'year': _to_number,
+    'volume': _to_number,
+    'issue': _to_number,
+    'date': datetime.date.fromisoformat,
+    'retrieved_date': datetime.date.fromisoformat,
+    'markup': _to_markup,
+}
+
+# Attributes the style templates write out as they are, so they must be text
+_TEXT_FIELDS = frozenset(['title', 'subtitle', 'city', 'publisher', 'edition', 'in_title', 'in_subtitle',
+                          'in_authors_role', 'journal', 'url'])
+
+
+def _checked_value(name, value):
+    """A record's value given as something other than a string, e.g. a JSON number, checked
+       or converted so that the citation renders"""
+    if name in _TEXT_FIELDS:
+        if type(value) not in (int, float):
+            raise TypeError("The attribute '{}' must be text, not {}".format(name, type(value).__name__))
+        return str(value)
+    if name in ('date', 'retrieved_date') and not isinstance(value, datetime.date):
+        raise TypeError("The attribute '{}' must be a date, not {}".format(name, type(value).__name__))
+    if name == 'markup':
+        return _to_markup(value)
+    return value
+
+
+# Cite.from_records() collects each record's values in this order, then stores them straight into
+# the new Cite's slots. journal goes last, as it is only set if given.
+_BULK_FIELDS = tuple([name for name in Cite.SUPPORTED_ATTRS if name != 'journal']) + ('journal',)
+_BULK_SETTERS = [getattr(Cite, name).__set__ for name in _BULK_FIELDS[:-1]]
+_BULK_DEFAULTS = [None] * len(_BULK_FIELDS)
+_BULK_DEFAULTS[_BULK_FIELDS.index('markup')] = Cite.MARKUP_NONE
+_BULK_AUTHORS_IDX = _BULK_FIELDS.index('authors')
+_BULK_IN_AUTHORS_IDX = _BULK_FIELDS.index('in_authors')
+_BULK_PAGES_IDX = _BULK_FIELDS.index('pages')
+_set_journal = Cite.journal.__set__
+_set_render_cache = Cite._render_cache.__set__
+_set_rev = Cite._rev.__set__
+
+# What Cite.from_records() built, and (index, message) for each record it couldn't
+RecordsReport = collections.namedtuple('RecordsReport', 'cites errors')
+
+
+def _bulk_plan(keys):
+    """(value index, name, string parser) for each of these record keys, or the error message
+       if one isn't an attribute"""
+    plan = []
+    for name in keys:
+        if name not in Cite.SUPPORTED_ATTRS:
+            return "The attribute '{}' is unsupported. Supported attributes: {}".format(
+                name, ' '.join(Cite.SUPPORTED_ATTRS))
+        plan.append((_BULK_FIELDS.index(name), name, _FIELD_PARSERS.get(name)))
+    return plan
+
+
+def _bulk_cite(cls, values):
+    # The same coercion as Cite.__setattr__(), once per attribute that needs it
+    cite = object.__new__(cls)
+    for i in (_BULK_AUTHORS_IDX, _BULK_IN_AUTHORS_IDX):
+        value = values[i]
+        if value is None:
+            value = []
+        elif not isinstance(value, list):
+            value = [value]
+        values[i] = _AttrList(cite, _to_author, value)
+    values[_BULK_PAGES_IDX] = PageSet(values[_BULK_PAGES_IDX], cite)
+    for set_value, value in zip(_BULK_SETTERS, values):
+        set_value(cite, value)
+    if values[-1] is not None:
+        _set_journal(cite, values[-1])
+    _set_render_cache(cite, None)
+    _set_rev(cite, next(_revisions))
+    return cite
+
+
+class _AttrList(list):
+    """List for a plural Cite attribute. Coerces what is put in it and tells its Cite when it
+       changes in place, e.g. cite.authors.append(...)."""
+    __slots__ = ('_owner', '_coerce')
+
+    def __init__(self, owner, coerce, values):
+        self._owner = owner
+        self._coerce = coerce
+        if coerce is not None:
+            values = [coerce(v) for v in values]
+        list.__init__(self, values)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def _coerced(self, values):
+        if self._coerce is None:
+            return values
+        return [self._coerce(v) for v in values]
+
+    def append(self, value):
+        list.append(self, self._coerce(value) if self._coerce else value)
+        self._owner._changed()
+
+    def insert(self, index, value):
+        list.insert(self, index, self._coerce(value) if self._coerce else value)
+        self._owner._changed()
+
+    def extend(self, values):
+        list.extend(self, self._coerced(values))
+        self._owner._changed()
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._owner._changed()
+        return self
+
+    def __setitem__(self, index, value):
+        if type(index) is slice:
+            value = self._coerced(value)
+        elif self._coerce:
+            value = self._coerce(value)
+        list.__setitem__(self, index, value)
+        self._owner._changed()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._owner._changed()
+
+    def pop(self, index=-1):
+        value = list.pop(self, index)
+        self._owner._changed()
+        return value
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._owner._changed()
+
+    def clear(self):
+        list.clear(self)
+        self._owner._changed()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._owner._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._owner._changed()
+
+
+# Parsed form of an author's name: the given names, the family name, the given names as initials
+# ('J.', 'K.'), and the strings the renderers ask for, built once.
+ParsedName = collections.namedtuple('ParsedName',
+    'name given family initials with_initials reversed reversed_initials')
+
+# How many distinct names _parse_name() remembers
+AUTHOR_NAME_CACHE_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=AUTHOR_NAME_CACHE_SIZE)
+def _parse_name(name):
+    """Parse a name once. Every Author with the same name shares the result while it stays in
+       the cache, including the name string itself."""
+    if type(name) is not str:
+        raise TypeError("Author name must be a str, not {}".format(type(name).__name__))
+    chunks = name.split()
+    if not chunks:
+        return ParsedName(name, (), '', (), '', '', '')
+    given = tuple(chunks[:-1])
+    family = chunks[-1]
+    initials = tuple([x[0].upper() + '.' for x in given])
+    if given:
+        return ParsedName(name, given, family, initials, ' '.join(initials + (family,)),
+                          family + ', ' + ' '.join(given), family + ', ' + ' '.join(initials))
+    return ParsedName(name, given, family, initials, family, family, family)
+
+
+def author_cache_info():
+    """Hits, misses and size of the shared cache of parsed author names"""
+    return _parse_name.cache_info()
 
 
 class AuthorIterator:
     def __init__(self, author):
-        self.i = 0
-        self.chunks = author.name.split()
-        if author.initials:
-            tmp = []
-            for chunk in self.chunks[:-1]:
-                tmp.append(author._to_initials(chunk))
-                tmp.append(self.chunks[-1])
-            self.chunks = tmp
-            self.chunks_len = len(self.chunks)
+        self.author = author
+        parsed = author._parsed
+        if parsed.family:
+            self.chunks = (parsed.initials if author.initials else parsed.given) + (parsed.family,)
+        else:
+            self.chunks = ()
+        self.chunks_len = len(self.chunks)
+        self._it = iter(self.chunks)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.i < self.chunks_len:
-            self.i += 1
-            return self.chunks[self.i - 1]
-        else:
-            raise StopIteration()
+        return next(self._it)
 
     def __str__(self):
-        return ' '.join(self.chunks)
+        return str(self.author)
     
 class AuthorReverseIterator:
     def __init__(self, author):
         self.author = author
-        self.chunks = author.name.split()
-        tmp = [self.chunks[-1]]
-        for chunk in self.chunks[:-1]:
-            if author.initials:
-                tmp.append(author._to_initials(chunk))
-            else:
-                tmp.append(chunk)
-        self.chunks = tmp
+        parsed = author._parsed
+        if parsed.family:
+            self.chunks = (parsed.family,) + (parsed.initials if author.initials else parsed.given)
+        else:
+            self.chunks = ()
         self.chunks_len = len(self.chunks)
-        self.i = 0
+        self._it = iter(self.chunks)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.i < self.chunks_len:
-            self.i += 1
-            return self.chunks[self.i - 1]
-        else:
-            raise StopIteration()
+        return next(self._it)
 
     def __str__(self):
-        if self.chunks_len < 1:
-            return ''
-        s = self.chunks[0]
-        if self.chunks_len > 1:
-            s += ', '
-            s += ' '.join(self.chunks[1:]) 
-        return s
+        return self.author._reversed_str()
 
 # https://www.kalzumeus.com/2010/06/17/falsehoods-programmers-believe-about-names/
 class Author:
-    """Class for an author"""
+    """Class for an author. The name is parsed once (see _parse_name()), and again only when
+       it changes."""
+    __slots__ = ('_parsed', '_initials', '_rev')
 
     def __init__(self, name, initials=False):
-        self.name = name
-        self.initials = initials
+        self._parsed = _parse_name(name)
+        self._initials = initials
+        self._rev = next(_revisions)
+
+    @property
+    def name(self):
+        return self._parsed.name
+
+    @name.setter
+    def name(self, value):
+        if value != self._parsed.name:
+            self._parsed = _parse_name(value)
+            self._rev = next(_revisions)
+            if _watchers:
+                for watcher in _watchers.get(self, ()):
+                    watcher._touched(self)
+
+    @property
+    def initials(self):
+        return self._initials
+
+    @initials.setter
+    def initials(self, value):
+        if value != self._initials:
+            self._initials = value
+            self._rev = next(_revisions)
+            if _watchers:
+                for watcher in _watchers.get(self, ()):
+                    watcher._touched(self)
+
+    @property
+    def given_names(self):
+        return self._parsed.given
+
+    @property
+    def family_name(self):
+        return self._parsed.family
 
     def __repr__(self):
         return "Author(name='{}'{})".format(
@@ -359,12 +632,10 @@ class Author:
         )
 
     def __str__(self):
-        if self.initials:
-            tmp = self.name.split()
-            initials = [self._to_initials(x) for x in tmp[:-1]]
-            return ' '.join(initials) + ' ' + tmp[-1]
+        if self._initials:
+            return self._parsed.with_initials
         else:
-            return self.name
+            return self._parsed.name
 
     def __iter__(self):
         return AuthorIterator(self)
@@ -372,6 +643,12 @@ class Author:
     def __reversed__(self):
         return AuthorReverseIterator(self)
 
+    def _reversed_str(self):
+        """'Family, Given' (or 'Family, G.' with initials)"""
+        if self._initials:
+            return self._parsed.reversed_initials
+        return self._parsed.reversed
+
     def _to_initials(self, components):
         if type(components) is not list:
             components = [components]
@@ -379,6 +656,34 @@ class Author:
         return ' '.join(tmp) 
 
 
+class FrozenAuthor(Author):
+    """An Author that can't be changed, so it can be shared between threads and used as a dict
+       key. Equal to another FrozenAuthor with the same name and initials."""
+    __slots__ = ()
+
+    def __init__(self, name, initials=False):
+        object.__setattr__(self, '_parsed', _parse_name(name))
+        object.__setattr__(self, '_initials', initials)
+        object.__setattr__(self, '_rev', 0)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenAuthor is immutable')
+
+    def __reduce__(self):
+        return (FrozenAuthor, (self._parsed.name, self._initials))
+
+    def __eq__(self, other):
+        if type(other) is not FrozenAuthor:
+            return NotImplemented
+        return self._parsed.name == other._parsed.name and self._initials == other._initials
+
+    def __hash__(self):
+        return hash((self._parsed.name, self._initials))
+
+    def __repr__(self):
+        return 'Frozen' + super().__repr__()
+
+
 class PageRange:
     """A 'range' analogue that support ordering (by .begin), and has [begin,end] semantics
        (includes 'end' value).
@@ -390,6 +695,8 @@ class PageRange:
         * len(PageRange(x)) == 1
         * PageRanges are comparable to each other and to integers based on .begin
     """
+    # Two ints rather than a range object: PageRange is the most numerous object in a corpus
+    __slots__ = ('_begin', '_end')
 
     def __init__(self, begin, end=None):
         # Handle various string formats
@@ -400,54 +707,3151 @@ class PageRange:
                     raise TypeError("Bad string argument to PageRange(): Needs form 'x - y'")
                 begin = int(tmp[0])
                 end = int(tmp[1])
+            else:
+                begin = int(begin)
         if end is None:
             end = begin
-        self.r = range(begin, end + 1)
+        self._begin = begin
+        self._end = end
 
     def __repr__(self):
-        if self.r.step != 1:
-            tmp = ', ' + self.r.step
+        if self._end != self._begin:
+            return 'PageRange({}, {})'.format(self._begin, self._end)
         else:
-            tmp = ''
-        if abs(self.r.stop - self.r.start) > 1:
-            return 'PageRange({}, {}{})'.format(self.r.start, self.r.stop - 1, tmp)
-        else:
-            return 'PageRange({})'.format(self.r.start)
+            return 'PageRange({})'.format(self._begin)
 
     def __str__(self):
-        if abs(self.r.stop - self.r.start) > 1:
-            return str(self.r.start) + '-' + str(self.r.stop - 1)
+        if self._end != self._begin:
+            return str(self._begin) + '-' + str(self._end)
         else:
-            return str(self.r.start)
+            return str(self._begin)
+
+    @property
+    def begin(self):
+        return self._begin
 
-    def __getattr__(self, name):
-        if name == 'begin':
-            return self.r.start
-        if name == 'end':
-            return self.r.stop - 1
-        raise AttributeError("PageRange supports 'begin' and 'end' attributes")
+    @property
+    def end(self):
+        return self._end
+
+    @property
+    def r(self):
+        return range(self._begin, self._end + 1)
 
     def __len__(self):
-        return len(self.r)
+        return max(0, self._end - self._begin + 1)
 
     def __contains__(self, item):
+        if type(item) is int:
+            return self._begin <= item <= self._end
         return item in self.r
 
     def __iter__(self):
-        return self.r.__iter__()
+        return iter(range(self._begin, self._end + 1))
 
     def __lt__(self, other):
         if type(other) is not PageRange:
-            return self.r.start < int(other)
-        return self.r.start < other.r.start
+            return self._begin < int(other)
+        return self._begin < other._begin
 
     def __le__(self, other):
         if type(other) is not PageRange:
-            return self.r.start <= int(other)
-        return self.r.start <= other.r.start
+            return self._begin <= int(other)
+        return self._begin <= other._begin
 
     def __eq__(self, other):
         if type(other) is not PageRange:
-            return self.r.start == int(other)
-        return self.r.start == other.r.start
+            return self._begin == int(other)
+        return self._begin == other._begin
+
+    def __gt__(self, other):
+        if type(other) is not PageRange:
+            return self._begin > int(other)
+        return self._begin > other._begin
+
+    def __ge__(self, other):
+        if type(other) is not PageRange:
+            return self._begin >= int(other)
+        return self._begin >= other._begin
+
+    # Consistent with __eq__, which compares .begin (also to plain ints)
+    def __hash__(self):
+        return hash(self._begin)
+
+
+# A page list such as '10-20, 15-25, 26': items like '12', '12-15', '12--15' or '12 – 15',
+# separated by commas, any of them empty
+_PAGE_LIST_ITEM = r'\s*(?:\d+\s*(?:[-\u2013]+\s*\d+\s*)?)?'
+_PAGE_LIST = re.compile(_PAGE_LIST_ITEM + '(?:,' + _PAGE_LIST_ITEM + ')*')
+_PAGE_ITEMS = re.compile(r'(\d+)\s*(?:[-\u2013]+\s*(\d+))?')
+
+
+def _parse_pages(text):
+    """(begin, end) pairs from a page list such as '10-20, 15-25, 26'"""
+    # Validating the whole string and then splitting it with findall() keeps the per-item work
+    # down to two int() calls
+    if _PAGE_LIST.fullmatch(text) is None:
+        raise ValueError("Bad page list: {!r}".format(text))
+    pairs = []
+    for begin, end in _PAGE_ITEMS.findall(text):
+        begin = int(begin)
+        pairs.append((begin, int(end) if end else begin))
+    return pairs
+
+
+def _page_pairs(values):
+    """(begin, end) pairs for an int, page string, PageRange, PageSet or an iterable of them"""
+    if values is None:
+        return []
+    if type(values) in (int, str, PageRange):
+        values = (values,)
+    elif isinstance(values, PageSet):
+        return list(zip(values._begins, values._ends))
+    pairs = []
+    for value in values:
+        kind = type(value)
+        if kind is int:
+            pairs.append((value, value))
+        elif kind is PageRange:
+            pairs.append((value._begin, value._end))
+        elif kind is str:
+            pairs.extend(_parse_pages(value))
+        elif kind is tuple and len(value) == 2:
+            pairs.append(value)
+        elif kind is PageSet:
+            pairs.extend(zip(value._begins, value._ends))
+        else:
+            value = PageRange(value)
+            pairs.append((value._begin, value._end))
+    return pairs
+
+
+class PageSet:
+    """A sorted set of pages, stored as disjoint PageRanges: overlapping and adjacent ranges are
+       merged as they're added, so '10-20, 15-25, 26' becomes '10-26'.
+
+       Behaves as a sequence of its ranges (pages[0], len(pages), iteration, pages[0] = ...,
+       del pages[0]), so it can stand in for a list of PageRange, though what is put in is
+       merged like anything else added. Cite.pages is a PageSet.
+
+       >>> pages = PageSet('10-20, 15-25, 26')
+       >>> pages.add(40)
+       >>> str(pages), 22 in pages, PageRange(18, 30) in pages
+       ('10-26, 40', True, False)
+    """
+    __slots__ = ('_begins', '_ends', '_owner')
+
+    # The ranges are kept as two exactly-sized tuples (an empty set shares the empty tuple, and
+    # most citations have no pages), and only turned into lists when changed in place.
+    def __init__(self, pages=None, owner=None):
+        self._owner = owner
+        self._begins = ()
+        self._ends = ()
+        if pages is not None:
+            self._merge(_page_pairs(pages))
+
+    @classmethod
+    def parse(cls, text):
+        """Build a PageSet from a page list string, e.g. '5--9, 12'"""
+        pages = cls()
+        pages._merge(_parse_pages(text))
+        return pages
+
+    def _merge(self, pairs):
+        # Sort everything and sweep once. Existing ranges are already in order, which timsort
+        # handles in linear time.
+        if self._begins:
+            pairs.extend(zip(self._begins, self._ends))
+        pairs.sort()
+        begins = []
+        ends = []
+        for begin, end in pairs:
+            if end < begin:
+                continue
+            if ends and begin <= ends[-1] + 1:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                begins.append(begin)
+                ends.append(end)
+        self._begins = tuple(begins)
+        self._ends = tuple(ends)
+
+    def _lists(self):
+        if type(self._begins) is tuple:
+            self._begins = list(self._begins)
+            self._ends = list(self._ends)
+        return self._begins, self._ends
+
+    def _changed(self):
+        if self._owner is not None:
+            self._owner._changed()
+
+    def __reduce__(self):
+        return (PageSet, (list(zip(self._begins, self._ends)),))
+
+    def add(self, page):
+        """Add a page or range of pages, merging it with any ranges it overlaps or touches"""
+        if type(page) is int:
+            begin = end = page
+        else:
+            if type(page) is not PageRange:
+                page = PageRange(page)
+            begin, end = page._begin, page._end
+            if end < begin:
+                return
+        begins, ends = self._lists()
+        # Ranges [i, j) overlap or are adjacent to [begin, end]
+        i = bisect.bisect_left(ends, begin - 1)
+        j = bisect.bisect_right(begins, end + 1)
+        if i < j:
+            begin = min(begin, begins[i])
+            end = max(end, ends[j - 1])
+        begins[i:j] = [begin]
+        ends[i:j] = [end]
+        self._changed()
+
+    def update(self, pages):
+        """Add many pages or ranges (anything PageSet() accepts) at once"""
+        self._merge(_page_pairs(pages))
+        self._changed()
+
+    # List-style names, for code written when Cite.pages was a list
+    append = add
+    extend = update
+
+    def __iadd__(self, pages):
+        self.update(pages)
+        return self
+
+    __ior__ = __iadd__
+
+    def union(self, *others):
+        pages = PageSet(self)
+        pairs = []
+        for other in others:
+            pairs.extend(_page_pairs(other))
+        pages._merge(pairs)
+        return pages
+
+    def __or__(self, other):
+        if not isinstance(other, PageSet):
+            return NotImplemented
+        return self.union(other)
+
+    def clear(self):
+        self._begins = ()
+        self._ends = ()
+        self._changed()
+
+    def __contains__(self, item):
+        """Whether a page, or every page of a PageRange or PageSet, is in this set"""
+        if type(item) is int:
+            i = bisect.bisect_right(self._begins, item) - 1
+            return i >= 0 and item <= self._ends[i]
+        if isinstance(item, PageSet):
+            return all([PageRange(b, e) in self for b, e in zip(item._begins, item._ends)])
+        if type(item) is not PageRange:
+            item = PageRange(item)
+        i = bisect.bisect_right(self._begins, item._begin) - 1
+        return i >= 0 and item._end <= self._ends[i]
+
+    def __len__(self):
+        return len(self._begins)
+
+    def __iter__(self):
+        return map(PageRange, self._begins, self._ends)
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return list(map(PageRange, self._begins[index], self._ends[index]))
+        return PageRange(self._begins[index], self._ends[index])
+
+    def __setitem__(self, index, value):
+        """Replace a range, or a slice of them, merging what replaces it with the rest"""
+        pairs = _page_pairs(value if type(index) is slice else [value])
+        begins, ends = self._lists()
+        del begins[index]
+        del ends[index]
+        self._merge(pairs)
+        self._changed()
+
+    def __delitem__(self, index):
+        begins, ends = self._lists()
+        del begins[index]
+        del ends[index]
+        self._changed()
+
+    def __eq__(self, other):
+        if not isinstance(other, PageSet):
+            if not isinstance(other, (list, tuple)):
+                return NotImplemented
+            other = PageSet(other)
+        return tuple(self._begins) == tuple(other._begins) and tuple(self._ends) == tuple(other._ends)
+
+    # Mutable
+    __hash__ = None
+
+    def __str__(self):
+        return ', '.join([str(b) if b == e else '{}-{}'.format(b, e) for b, e in zip(self._begins, self._ends)])
+
+    def __repr__(self):
+        return 'PageSet({!r})'.format(str(self))
+
+
+
+class FrozenPageSet(PageSet):
+    """A PageSet that can't be changed, and so is hashable. union() and | still work, returning
+       a new PageSet."""
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (FrozenPageSet, (list(zip(self._begins, self._ends)),))
+
+    def _immutable(self, *args):
+        raise TypeError('FrozenPageSet is immutable')
+
+    add = update = append = extend = clear = __setitem__ = __delitem__ = __iadd__ = __ior__ = _immutable
+
+    def __hash__(self):
+        return hash((self._begins, self._ends))
+
+    def __repr__(self):
+        return 'FrozenPageSet({!r})'.format(str(self))
+
+
+# Frozen citations
+#
+# Rendering only reads a citation, so any number of threads can render the same one, but a Cite
+# can still be changed under them. A FrozenCite is an immutable copy - a tuple of the fields,
+# with FrozenAuthors and a FrozenPageSet - that is safe to share and hashes by value, so it can
+# key a dict or cache. Styles render it just like a Cite, without the per-citation cache.
+
+class FrozenCite(collections.namedtuple('FrozenCite', Cite.SUPPORTED_ATTRS)):
+    """An immutable, hashable citation, equal to any other with the same fields. Takes the same
+       arguments as Cite(); Cite.freeze() and to_cite() convert between the two."""
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        journal = kwargs.pop('journal', None)
+        cite = Cite(*args, **kwargs)
+        if journal is not None:
+            cite.journal = journal
+        return cite.freeze()
+
+    def __reduce__(self):
+        return (FrozenCite._make, (tuple(self),))
+
+    def _replace(self, **fields):
+        cite = self.to_cite()
+        for name, value in fields.items():
+            setattr(cite, name, value)
+        return cite.freeze()
+
+    def to_cite(self):
+        """A mutable Cite with the same fields"""
+        fields = self._asdict()
+        journal = fields.pop('journal')
+        fields['authors'] = list(self.authors)
+        fields['in_authors'] = list(self.in_authors)
+        cite = Cite(**fields)
+        if journal is not None:
+            cite.journal = journal
+        return cite
+
+    def to_mla(self):
+        return MLA.render(self, self.markup)
+
+    def to_apa(self):
+        return APA.render(self, self.markup)
+
+    def to_bibtex(self, strict=False, key=None):
+        return self.to_cite().to_bibtex(strict, key)
+
+
+# Style templates
+#
+# A style is declared once as a tree of nodes: plain strings, Field(), Italic(), Quoted() and
+# If(). Whether a field is populated is the only thing the If() conditions can test, so for a
+# given markup and set of populated fields (the citation's "shape") the whole tree resolves to
+# a flat run of literal text and field formatters. Style.render() compiles that run into a
+# Python function once per (markup, shape) and caches it, so citations with the same shape
+# skip all of the branching.
+
+class Field:
+    """Template node for the value of a Cite attribute, passed through 'fmt' if given.
+       Renders nothing when the attribute is empty."""
+
+    def __init__(self, name, fmt=None):
+        if name not in Cite.SUPPORTED_ATTRS:
+            raise AttributeError("The attribute '{}' is unsupported. Supported attributes: {}".format(
+                name, ' '.join(Cite.SUPPORTED_ATTRS)))
+        self.name = name
+        self.fmt = fmt
+
+    def __repr__(self):
+        return 'Field({!r})'.format(self.name)
+
+
+class Italic:
+    """Template node wrapping its children in the markup's italics"""
+
+    def __init__(self, *children):
+        self.children = children
+
+
+class Quoted:
+    """Template node wrapping its children in the markup's quotation marks"""
+
+    def __init__(self, *children):
+        self.children = children
+
+
+class If:
+    """Template node choosing between children on which fields are populated.
+
+       'cond' is a Python expression over attribute names, e.g. 'city and not publisher',
+       where each name is True if that attribute is populated on the citation.
+    """
+
+    def __init__(self, cond, *then, otherwise=()):
+        self.cond = cond
+        self.code = compile(cond, '<If {!r}>'.format(cond), 'eval')
+        for name in self.code.co_names:
+            if name not in Cite.SUPPORTED_ATTRS:
+                raise AttributeError("The attribute '{}' is unsupported. Supported attributes: {}".format(
+                    name, ' '.join(Cite.SUPPORTED_ATTRS)))
+        self.then = then
+        if type(otherwise) not in (tuple, list):
+            otherwise = (otherwise,)
+        self.otherwise = otherwise
+
+
+class Style:
+    """A citation style declared as a template, compiled per (markup, shape) on first use.
+
+       collate(cite), if given, returns the key reference lists in this style are sorted by.
+    """
+
+    def __init__(self, name, *template, collate=None):
+        self.name = name
+        self.template = template
+        self.collate = collate
+        fields = []
+        self._collect_fields(template, fields)
+        self.fields = tuple(fields)
+        self._shape_values = operator.attrgetter(*self.fields)
+        self._compiled = {}
+
+    def __repr__(self):
+        return 'Style({!r})'.format(self.name)
+
+    def render(self, cite, markup):
+        if _profiler is not None:
+            return _profiler._render(self, cite, markup)
+        key = (markup, tuple(map(bool, self._shape_values(cite))))
+        try:
+            func = self._compiled[key]
+        except KeyError:
+            func = self._compiled[key] = self.compile(markup, key[1])
+        return func(cite)
+
+    def sort_key(self, cite):
+        """Where the citation goes in a reference list: collate(cite), or without a collate
+           function the folded plain text rendering. Cached on Cite objects until they change."""
+        if isinstance(cite, Cite):
+            return cite._cached_sort_key(self)
+        return self._collate(cite)
+
+    def _collate(self, cite):
+        if self.collate is None:
+            return _fold(self.render(cite, Cite.MARKUP_NONE))
+        return self.collate(cite)
+
+    def compile(self, markup, shape, wrap=None):
+        """Build the render function for citations with the given markup and shape. 'shape' is a
+           tuple of booleans, one per name in self.fields, saying whether it is populated.
+           If given, wrap(field name, formatter) replaces each field's formatter."""
+        present = dict(zip(self.fields, shape))
+        parts = []
+        self._flatten(self.template, markup, present, parts)
+
+        namespace = {}
+        exprs = []
+        for part in parts:
+            if type(part) is str:
+                if exprs and exprs[-1] in namespace and type(namespace[exprs[-1]]) is str:
+                    namespace[exprs[-1]] += part
+                    continue
+                var = 'K{}'.format(len(namespace))
+                namespace[var] = part
+                exprs.append(var)
+            elif part.fmt is None:
+                exprs.append('c.' + part.name)
+            else:
+                var = 'F{}'.format(len(namespace))
+                namespace[var] = part.fmt if wrap is None else wrap(part.name, part.fmt)
+                exprs.append('{}(c.{})'.format(var, part.name))
+        if not exprs:
+            body = "''"
+        elif len(exprs) == 1:
+            body = exprs[0]
+        else:
+            body = "''.join(({},))".format(', '.join(exprs))
+        source = 'def render(c):\n    return {}\n'.format(body)
+        exec(compile(source, '<{} style>'.format(self.name), 'exec'), namespace)
+        return namespace['render']
+
+    def _flatten(self, nodes, markup, present, parts):
+        for node in nodes:
+            if type(node) is str:
+                if node:
+                    parts.append(node)
+            elif type(node) is Field:
+                if present[node.name]:
+                    parts.append(node)
+            elif type(node) is If:
+                if eval(node.code, {'__builtins__': {}}, present):
+                    self._flatten(node.then, markup, present, parts)
+                else:
+                    self._flatten(node.otherwise, markup, present, parts)
+            elif type(node) is Italic:
+                parts.append(Cite.OPENING_ITALICS[markup])
+                self._flatten(node.children, markup, present, parts)
+                parts.append(Cite.CLOSING_ITALICS[markup])
+            elif type(node) is Quoted:
+                parts.append(Cite.OPENING_QUOTE[markup])
+                self._flatten(node.children, markup, present, parts)
+                parts.append(Cite.CLOSING_QUOTE[markup])
+            elif type(node) in (tuple, list):
+                self._flatten(node, markup, present, parts)
+            else:
+                raise TypeError('Unknown template node {!r}'.format(node))
+
+    def _collect_fields(self, nodes, fields):
+        for node in nodes:
+            if type(node) is Field:
+                names = [node.name]
+            elif type(node) is If:
+                names = node.code.co_names
+                self._collect_fields(node.then, fields)
+                self._collect_fields(node.otherwise, fields)
+            elif type(node) in (Italic, Quoted):
+                names = ()
+                self._collect_fields(node.children, fields)
+            elif type(node) in (tuple, list):
+                names = ()
+                self._collect_fields(node, fields)
+            else:
+                names = ()
+            for name in names:
+                if name not in fields:
+                    fields.append(name)
+
+
+def _year_of(date):
+    return str(date.year)
+
+
+def _mla_authors(authors):
+    output = ', '.join([a._reversed_str() for a in authors[:-1] if a.name != ''])
+    if len(authors) > 1:
+        output += ', and '
+    return output + authors[-1]._reversed_str()
+
+
+def _mla_in_authors(authors):
+    names = [str(a) for a in authors]
+    if len(names) < 3:
+        return ' and '.join(names)
+    return ', '.join(names[:-1]) + ', and ' + names[-1]
+
+
+def _mla_pages(pages):
+    if len(pages) == 1 and len(pages[0]) == 1:
+        abbrev = Cite.PAGE_ABBREV
+    else:
+        abbrev = Cite.PAGES_ABBREV
+    return abbrev + '. ' + str(pages)
+
+
+def _apa_authors(authors):
+    # Always initials, whatever the authors' own .initials say
+    authors_reversed = [x._parsed.reversed_initials for x in authors]
+    output = ', '.join(authors_reversed[:-1])
+    if len(authors) > 1:
+        output += ', & '
+    return output + authors_reversed[-1]
+
+
+def _pages(pages):
+    return str(pages)
+
+
+# Collation
+#
+# Reference lists are ordered by author, title and year, compared without regard to case,
+# accents, punctuation or a leading article. A style's sort key is built once per citation and
+# cached with its renderings (see Cite._cached_sort_key()). It is a single string, the folded
+# parts joined by control characters that sort before any text, because comparing one string
+# is several times faster than comparing nested tuples: '\x01' after a family name, '\x02'
+# between authors and '\x00' between the author, title and year parts. So 'smith\x01bob\x00...'
+# comes before 'smith\x01bob\x02jones...', as Smith alone comes before Smith and Jones.
+
+def _fold(text):
+    """'Éléments' -> 'elements': casefolded, with accents removed"""
+    if text.isascii():
+        return text.casefold()
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join([c for c in text if not unicodedata.combining(c)]).casefold()
+
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+_LEADING_ARTICLES = ('the ', 'an ', 'a ')
+
+
+def _collation(text):
+    """'The Élan of "Things"' -> 'elan of things'"""
+    text = _NON_WORD.sub(' ', _fold(text)).strip()
+    if text.startswith(_LEADING_ARTICLES):
+        return text.partition(' ')[2]
+    return text
+
+
+@functools.lru_cache(maxsize=AUTHOR_NAME_CACHE_SIZE)
+def _collation_name(name):
+    parsed = _parse_name(name)
+    return _collation(parsed.family) + '\x01' + _collation(' '.join(parsed.given))
+
+
+def _collation_authors(cite, title):
+    """The authors' names, or the title in their place if there are none"""
+    if not cite.authors:
+        return title + '\x01'
+    return '\x02'.join([_collation_name(a.name) for a in cite.authors])
+
+
+def _collation_title(cite):
+    if cite.subtitle:
+        return _collation(cite.title + ' ' + cite.subtitle)
+    return _collation(cite.title)
+
+
+def _collation_year(cite):
+    """The year as four digits, '0000' (first) if there is none"""
+    year = cite.year
+    if type(year) is int and year >= 0:
+        return '{:04d}'.format(year)
+    if year is None and cite.date is not None:
+        year = cite.date.year
+    try:
+        return '{:04d}'.format(max(int(year), 0))
+    except (TypeError, ValueError):
+        return '0000'
+
+
+def _mla_sort_key(cite):
+    title = _collation_title(cite)
+    return _collation_authors(cite, title) + '\x00' + title + '\x00' + _collation_year(cite)
+
+
+def _apa_sort_key(cite):
+    """By author, then year (n.d. first), then title"""
+    title = _collation_title(cite)
+    return _collation_authors(cite, title) + '\x00' + _collation_year(cite) + '\x00' + title
+
+
+# https://guides.lib.uw.edu/c.php?g=341448&p=4076094
+MLA = Style(Cite.STYLE_MLA,
+    If('authors', Field('authors', _mla_authors), '. '),
+    If('in_title or in_authors',
+        Quoted(Field('title'), If('subtitle', ': ', Field('subtitle')), '.'),
+        ' ', Italic(Field('in_title'), If('in_subtitle', ': ', Field('in_subtitle')), '.'),
+        otherwise=Italic(Field('title'), If('subtitle', ': ', Field('subtitle')), '.')),
+    If('edition', ' ', Field('edition'), ' ed.'),
+    If('in_authors_role and in_authors', ' ', Field('in_authors_role')),
+    If('in_authors', ' ', Field('in_authors', _mla_in_authors), '.'),
+    If('city', ' ', Field('city')),
+    If('city and publisher', ':', otherwise=If('city and year', ',', otherwise=If('city', '.'))),
+    If('publisher', ' ', Field('publisher')),
+    If('year and publisher', ',', otherwise=If('publisher', '.')),
+    If('year', ' ', Field('year', str), '.', otherwise=If('date', ' ', Field('date', _year_of), '.')),
+    If('pages', ' ', Field('pages', _mla_pages), '.'),
+    collate=_mla_sort_key,
+)
+
+# https://apastyle.apa.org/
+APA = Style(Cite.STYLE_APA,
+    If('authors', Field('authors', _apa_authors)),
+    If('year', ' (', Field('year', str), ').', otherwise=If('date', ' (', Field('date', _year_of), ').')),
+    ' ',
+    If('in_title or in_authors',
+        Field('title'), If('subtitle', ': ', Field('subtitle')), '.',
+        otherwise=Italic(Field('title'), If('subtitle', ': ', Field('subtitle')), '.')),
+    If('city or publisher', ' '),
+    If('city', Field('city'), If('publisher', ': ', otherwise='.')),
+    If('publisher', Field('publisher'), '.'),
+    If('in_title or in_authors',
+        ' ', Italic(Field('in_title'), If('in_subtitle', ': ', Field('in_subtitle')),
+                    If('volume', ', ', Field('volume', str))),
+        If('issue', '(', Field('issue', str), ')', If('pages', ', '))),
+    If('pages', Field('pages', _pages), '.'),
+    If('url', ' ', Field('url')),
+    collate=_apa_sort_key,
+)
+
+STYLES = {
+    MLA.name: MLA,
+    APA.name: APA,
+}
+
+
+# Profiling
+
+# The running Profiler, if any
+_profiler = None
+
+
+class Profiler:
+    """Call counts and cumulative time for each stage of rendering, per style.
+
+       with Profiler() as profiler:
+           render_bibliography(cites)
+       print(profiler.table())
+
+       The stages are 'shape' (choosing the compiled function for a citation), 'compile',
+       'render' (running it), and within 'render' one 'field:<name>' per formatted field
+       (authors, pages, ...) plus 'assemble' for everything else: literal text, markup and
+       joining. Output served from the render cache is not rendered and so is not counted here
+       (see render_cache_info()). While no Profiler is running, rendering pays for one global
+       lookup.
+    """
+    STAGE_ORDER = ('total', 'shape', 'compile', 'render', 'assemble')
+
+    def __init__(self):
+        self._stats = {}     # (style name, stage) -> [calls, seconds]
+        self._compiled = {}  # (style, markup, shape) -> instrumented render function
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        global _profiler
+        if _profiler is not None and _profiler is not self:
+            raise RuntimeError('Another Profiler is already running')
+        _profiler = self
+
+    def stop(self):
+        global _profiler
+        if _profiler is self:
+            _profiler = None
+
+    def reset(self):
+        self._stats.clear()
+
+    def _counter(self, style_name, stage):
+        try:
+            return self._stats[(style_name, stage)]
+        except KeyError:
+            counter = self._stats[(style_name, stage)] = [0, 0.0]
+            return counter
+
+    def _wrap(self, style_name, field_name, fmt):
+        counter = self._counter(style_name, 'field:' + field_name)
+        perf_counter = time.perf_counter
+
+        def timed(value):
+            start = perf_counter()
+            try:
+                return fmt(value)
+            finally:
+                counter[0] += 1
+                counter[1] += perf_counter() - start
+        return timed
+
+    def _render(self, style, cite, markup):
+        perf_counter = time.perf_counter
+        start = perf_counter()
+        shape = tuple(map(bool, style._shape_values(cite)))
+        key = (style, markup, shape)
+        func = self._compiled.get(key)
+        now = perf_counter()
+        self._add(style.name, 'shape', now - start)
+        if func is None:
+            func = self._compiled[key] = style.compile(markup, shape, functools.partial(self._wrap, style.name))
+            start, now = now, perf_counter()
+            self._add(style.name, 'compile', now - start)
+        start = now
+        output = func(cite)
+        self._add(style.name, 'render', perf_counter() - start)
+        return output
+
+    def _add(self, style_name, stage, seconds):
+        counter = self._counter(style_name, stage)
+        counter[0] += 1
+        counter[1] += seconds
+
+    def snapshot(self):
+        """{style name: {stage: {'calls': n, 'seconds': s}}}, including the derived 'assemble'
+           and 'total' stages"""
+        out = {}
+        for (style_name, stage), (calls, seconds) in self._stats.items():
+            out.setdefault(style_name, {})[stage] = {'calls': calls, 'seconds': seconds}
+        for stages in out.values():
+            render = stages.get('render', {'calls': 0, 'seconds': 0.0})
+            fields = sum([v['seconds'] for k, v in stages.items() if k.startswith('field:')])
+            stages['assemble'] = {'calls': render['calls'], 'seconds': max(0.0, render['seconds'] - fields)}
+            stages['total'] = {'calls': stages.get('shape', {'calls': 0})['calls'],
+                               'seconds': sum([stages[k]['seconds'] for k in ('shape', 'compile', 'render')
+                                               if k in stages])}
+        return out
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def table(self):
+        """The snapshot as a plain text table"""
+        lines = ['{:<10} {:<22} {:>10} {:>12} {:>10}'.format('style', 'stage', 'calls', 'total ms', 'us/call')]
+        for style_name, stages in sorted(self.snapshot().items()):
+            order = [s for s in self.STAGE_ORDER if s in stages] + sorted([s for s in stages if s.startswith('field:')])
+            for stage in order:
+                calls, seconds = stages[stage]['calls'], stages[stage]['seconds']
+                lines.append('{:<10} {:<22} {:>10} {:>12.3f} {:>10.3f}'.format(
+                    style_name, stage, calls, seconds * 1e3, seconds / calls * 1e6 if calls else 0.0))
+        return '\n'.join(lines) + '\n'
+
+
+# BibTeX
+
+BIBTEX_MONTHS = {
+    'jan': 'January', 'feb': 'February', 'mar': 'March', 'apr': 'April', 'may': 'May', 'jun': 'June',
+    'jul': 'July', 'aug': 'August', 'sep': 'September', 'oct': 'October', 'nov': 'November', 'dec': 'December',
+}
+
+_BIBTEX_SPECIAL = re.compile(r'([&%$#_{}])')
+_BIBTEX_UNESCAPE = re.compile(r'\\([&%$#_{}])|[{}]')
+# LaTeX accent commands and the combining characters they stand for: {\"o}, \'{e}, \c c, ...
+_BIBTEX_ACCENTS = {
+    '"': '\u0308', "'": '\u0301', '`': '\u0300', '^': '\u0302', '~': '\u0303', '=': '\u0304', '.': '\u0307',
+    'u': '\u0306', 'v': '\u030c', 'H': '\u030b', 'r': '\u030a', 'c': '\u0327', 'k': '\u0328',
+}
+_BIBTEX_ACCENT = re.compile(r'\{?\\(["\'`^~=.]|[uvHrck](?=[\s{]))\s*\{?([A-Za-z])\}?\}?')
+_BIBTEX_DELIMITERS = re.compile(r'[{}()"]')
+_BIBTEX_ENTRY_TYPE = re.compile(r'@\s*([A-Za-z]+)\s*([{(])')
+_BIBTEX_FIELD_NAME = re.compile(r'[\s,]*([^\s=,{}"#]+)\s*=\s*')
+# A field whose value has no nested braces, macros or concatenation
+_BIBTEX_SIMPLE_FIELD = re.compile(r'[\s,]*([^\s=,{}"#]+)\s*=\s*(?:\{([^{}]*)\}|"([^"{}]*)"|([0-9]+))\s*(?=,|$)')
+_BIBTEX_BARE_VALUE = re.compile(r'[^\s,#{}"]+')
+_BIBTEX_CONCAT = re.compile(r'\s*#\s*')
+_BIBTEX_AUTHOR_SEPARATOR = re.compile(r'\s+and\s+')
+_BIBTEX_KEY_CHARS = re.compile(r'[^a-z0-9]')
+
+
+def _bibtex_escape(value):
+    return _BIBTEX_SPECIAL.sub(r'\\\1', str(value))
+
+
+def _bibtex_accent(m):
+    accent, letter = m.group(1, 2)
+    return unicodedata.normalize('NFC', letter + _BIBTEX_ACCENTS[accent])
+
+
+def _bibtex_unescape(value):
+    if '\\' in value:
+        value = _BIBTEX_ACCENT.sub(_bibtex_accent, value)
+    if '\\' in value or '{' in value or '}' in value:
+        value = _BIBTEX_UNESCAPE.sub(lambda m: m.group(1) or '', value)
+    if '  ' in value or '\n' in value or '\t' in value or value[:1].isspace() or value[-1:].isspace():
+        value = ' '.join(value.split())
+    return value
+
+
+def _bibtex_names(authors):
+    names = []
+    for author in authors:
+        tmp = author.name.split()
+        if len(tmp) > 1:
+            names.append(tmp[-1] + ', ' + ' '.join(tmp[:-1]))
+        else:
+            names.append(author.name)
+    return _bibtex_escape(' and '.join(names))
+
+
+def _bibtex_pages(pages):
+    return str(pages).replace('-', '--')
+
+
+def _bibtex_type(cite):
+    if cite.in_title and (cite.volume or cite.issue):
+        return 'article'
+    if cite.in_title:
+        return 'incollection'
+    if cite.publisher:
+        return 'book'
+    return 'misc'
+
+
+def _bibtex_key(cite):
+    if cite.authors and cite.authors[0].name:
+        key = cite.authors[0].name.split()[-1]
+    elif cite.title:
+        key = cite.title.split()[0]
+    else:
+        key = ''
+    if cite.year:
+        key += str(cite.year)
+    elif cite.date:
+        key += str(cite.date.year)
+    return _BIBTEX_KEY_CHARS.sub('', key.casefold()) or 'cite'
+
+
+def _bibtex_field(name, *value):
+    return ('  ', name, ' = {', value, '},\n')
+
+
+def _bibtex_style(strict):
+    """Template for the fields of a BibTeX entry. strict=True sticks to the classic BibTeX
+       fields, otherwise 'date', 'url' and 'urldate' are written too."""
+    in_title = (Field('in_title', _bibtex_escape), If('in_subtitle', ': ', Field('in_subtitle', _bibtex_escape)))
+    return Style('bibtex-strict' if strict else 'bibtex',
+        If('authors', _bibtex_field('author', Field('authors', _bibtex_names))),
+        If('title', _bibtex_field('title', Field('title', _bibtex_escape),
+                                  If('subtitle', ': ', Field('subtitle', _bibtex_escape)))),
+        If('in_title and (volume or issue)', _bibtex_field('journal', in_title),
+            otherwise=If('in_title', _bibtex_field('booktitle', in_title))),
+        If('in_authors', _bibtex_field('editor', Field('in_authors', _bibtex_names))),
+        If('edition', _bibtex_field('edition', Field('edition', _bibtex_escape))),
+        If('publisher', _bibtex_field('publisher', Field('publisher', _bibtex_escape))),
+        If('city', _bibtex_field('address', Field('city', _bibtex_escape))),
+        If('year', _bibtex_field('year', Field('year', _bibtex_escape)),
+            otherwise=If('date', _bibtex_field('year', Field('date', _year_of)))),
+        () if strict else If('date', _bibtex_field('date', Field('date', datetime.date.isoformat))),
+        If('volume', _bibtex_field('volume', Field('volume', _bibtex_escape))),
+        If('issue', _bibtex_field('number', Field('issue', _bibtex_escape))),
+        If('pages', _bibtex_field('pages', Field('pages', _bibtex_pages))),
+        () if strict else (
+            If('url', _bibtex_field('url', Field('url'))),
+            If('retrieved_date', _bibtex_field('urldate', Field('retrieved_date', datetime.date.isoformat)))),
+    )
+
+BIBTEX = _bibtex_style(strict=False)
+BIBTEX_STRICT = _bibtex_style(strict=True)
+
+
+def write_bibtex(cites, out, strict=False):
+    """Write citations to a file-like object as BibTeX, one entry at a time. Keys are
+       generated from the first author's family name and the year, with a letter
+       appended where that would repeat an earlier key."""
+    seen = {}
+    for cite in cites:
+        key = _bibtex_key(cite)
+        count = seen.get(key, 0)
+        seen[key] = count + 1
+        if count:
+            key += _key_suffix(count - 1)
+        out.write(cite.to_bibtex(strict, key))
+        out.write('\n')
+
+
+def _key_suffix(n):
+    """0 -> 'a', 25 -> 'z', 26 -> 'aa', ..."""
+    suffix = ''
+    n += 1
+    while n:
+        n, rem = divmod(n - 1, 26)
+        suffix = chr(ord('a') + rem) + suffix
+    return suffix
+
+
+def read_bibtex(f, chunk_size=1 << 16, encoding='utf-8'):
+    """Generate a Cite for each entry in BibTeX read from 'f'.
+
+       'f' can be anything with a read(size) method returning str or bytes: a text or
+       binary file, or an mmap.mmap. Input is consumed chunk_size at a time and only the
+       entry being parsed is held in memory, so memory use doesn't grow with the file.
+       @string macros are expanded; @comment and @preamble are skipped. Page numbers
+       that aren't integers are dropped.
+    """
+    macros = dict(BIBTEX_MONTHS)
+    for entry_type, body in _bibtex_entries(f, chunk_size, encoding):
+        if entry_type == 'string':
+            fields = _bibtex_fields(body, macros)
+            macros.update(fields)
+            continue
+        if entry_type in ('comment', 'preamble'):
+            continue
+        comma = body.find(',')
+        if comma < 0:
+            continue
+        yield _bibtex_to_cite(entry_type, _bibtex_fields(body[comma + 1:], macros))
+
+
+def _bibtex_entries(f, chunk_size, encoding):
+    """Generate (entry type, body) for each entry, holding at most one entry plus one chunk"""
+    decoder = None
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buf, pos, decoder, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            if decoder:
+                buf = buf[pos:] + decoder.decode(b'', final=True)
+                pos = 0
+            return
+        if type(chunk) is not str:
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            chunk = decoder.decode(chunk)
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    while True:
+        at = buf.find('@', pos)
+        if at < 0:
+            pos = len(buf)
+            if eof:
+                return
+            read_more()
+            continue
+        m = _BIBTEX_ENTRY_TYPE.match(buf, at)
+        if m is None or m.end() == len(buf):
+            # Either not an entry or not enough buffered to tell
+            if eof or len(buf) - at > 256:
+                pos = at + 1
+                continue
+            pos = at
+            read_more()
+            continue
+
+        entry_type = m.group(1).casefold()
+        closing = '}' if m.group(2) == '{' else ')'
+        # Offsets are relative to 'pos', which moves when read_more() compacts the buffer
+        pos = at
+        body_start = m.end() - pos
+        scan = body_start
+        depth = 0
+        # Inside a "..." value outside braces, where a ')' doesn't end an @entry(...)
+        quoted = False
+        end = None
+        while end is None:
+            for d in _BIBTEX_DELIMITERS.finditer(buf, pos + scan):
+                c = d.group()
+                if c == '"':
+                    if depth == 0:
+                        quoted = not quoted
+                elif c == '{':
+                    depth += 1
+                elif c == '}':
+                    if depth == 0 and closing == '}':
+                        end = d.start() - pos
+                        break
+                    depth -= 1
+                elif c == ')' and depth == 0 and closing == ')' and not quoted:
+                    end = d.start() - pos
+                    break
+            else:
+                scan = len(buf) - pos
+                if eof:
+                    return
+                read_more()
+        yield entry_type, buf[pos + body_start:pos + end]
+        pos += end + 1
+
+
+def _bibtex_fields(body, macros):
+    """Parse 'name = value, ...' into a dict with casefolded names and unescaped values"""
+    fields = {}
+    pos = 0
+    length = len(body)
+    while pos < length:
+        m = _BIBTEX_SIMPLE_FIELD.match(body, pos)
+        if m is not None:
+            braced, quoted, number = m.group(2, 3, 4)
+            value = braced if braced is not None else (quoted if quoted is not None else number)
+            fields[m.group(1).casefold()] = _bibtex_unescape(value)
+            pos = m.end()
+            continue
+        m = _BIBTEX_FIELD_NAME.match(body, pos)
+        if m is None:
+            break
+        name = m.group(1).casefold()
+        pos = m.end()
+        parts = []
+        while pos < length:
+            c = body[pos]
+            if c == '{':
+                depth = 0
+                for d in _BIBTEX_DELIMITERS.finditer(body, pos):
+                    if d.group() == '{':
+                        depth += 1
+                    elif d.group() == '}':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                parts.append(body[pos + 1:d.start()])
+                pos = d.end()
+            elif c == '"':
+                end = pos + 1
+                depth = 0
+                while end < length:
+                    c = body[end]
+                    if c == '{':
+                        depth += 1
+                    elif c == '}':
+                        depth -= 1
+                    elif c == '"' and depth == 0 and body[end - 1] != '\\':
+                        break
+                    end += 1
+                parts.append(body[pos + 1:end])
+                pos = end + 1
+            else:
+                v = _BIBTEX_BARE_VALUE.match(body, pos)
+                if v is None:
+                    break
+                word = v.group()
+                parts.append(macros.get(word.casefold(), word))
+                pos = v.end()
+            m = _BIBTEX_CONCAT.match(body, pos)
+            if m is None:
+                break
+            pos = m.end()
+        fields[name] = _bibtex_unescape(''.join(parts))
+    return fields
+
+
+def _bibtex_split_title(value):
+    title, sep, subtitle = value.partition(': ')
+    return title, (subtitle if sep else None)
+
+
+def _bibtex_authors(value):
+    authors = []
+    for name in _BIBTEX_AUTHOR_SEPARATOR.split(value):
+        # 'Last, First', 'von Last, Jr, First' or 'First Last'
+        tmp = [x.strip() for x in name.split(',')]
+        if len(tmp) > 1:
+            name = tmp[-1] + ' ' + tmp[0]
+        authors.append(Author(name))
+    return authors
+
+
+def _bibtex_page_ranges(value):
+    pages = []
+    for piece in value.replace('--', '-').split(','):
+        try:
+            pages.append(PageRange(piece.strip()))
+        except ValueError:
+            pass
+    return pages
+
+
+def _bibtex_iso_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _bibtex_to_cite(entry_type, fields):
+    get = fields.get
+    title, subtitle = _bibtex_split_title(get('title', ''))
+    in_title = get('journal') or get('journaltitle') or get('booktitle')
+    in_subtitle = None
+    if in_title:
+        in_title, in_subtitle = _bibtex_split_title(in_title)
+    return Cite(title,
+                subtitle=get('subtitle', subtitle),
+                authors=_bibtex_authors(fields['author']) if 'author' in fields else None,
+                pages=_bibtex_page_ranges(fields['pages']) if 'pages' in fields else None,
+                city=get('address') or get('location'),
+                publisher=get('publisher'),
+                year=_to_number(fields['year']) if 'year' in fields else None,
+                edition=get('edition'),
+                in_title=in_title,
+                in_subtitle=in_subtitle,
+                in_authors=_bibtex_authors(fields['editor']) if 'editor' in fields else None,
+                volume=_to_number(fields['volume']) if 'volume' in fields else None,
+                issue=_to_number(fields['number']) if 'number' in fields else None,
+                date=_bibtex_iso_date(fields['date']) if 'date' in fields else None,
+                url=get('url'),
+                retrieved_date=_bibtex_iso_date(fields['urldate']) if 'urldate' in fields else None)
+
+
+# Formatted citations
+#
+# Reading back what to_mla() and to_apa() write. Each style's grammar mirrors its template and
+# is compiled to a regex once per markup; a citation that may or may not be contained in a
+# larger work is tried as one, then the other. Plain text leaves some choices open, so those
+# are settled the way the template reads most often: 'London, 1611.' is a publisher and year
+# rather than a city and year, and what comes before an MLA work's editors is only their role
+# if it ends in 'by' ('Edited by'). Whatever is chosen renders back to the same string.
+
+# The names as _mla_authors() writes them, 'Smith, Bob, Plato, and McDonald, James', read as
+# one span of comma-separated parts, so that there's only one way to match it. _mla_names()
+# then works out which parts are family names. A name as _apa_authors() writes it, 'Lopez, F. M.'
+_MLA_AUTHORS = r'[^\s,]+(?:(?:, (?!and )[^,]+)*, and [^,]+?)?(?:, (?!and )[^,]+?)?'
+_APA_NAME = r'[^\s,]+(?:, \S\.(?: \S\.)*)?'
+_APA_NAMES = re.compile(r'([^\s,]+)(?:, (\S\.(?: \S\.)*))?(?:, & |, |$)')
+_MLA_IN_NAMES = re.compile(r', and |, | and ')
+
+# Text in plain APA output that can't run on past the end of a sentence
+_APA_PHRASE = r'(?:[^.]|\.(?! |$))+?'
+_URL = r'(?:[A-Za-z][\w+.-]*:|www\.)\S+'
+
+
+def _markup_of(text):
+    if '<em>' in text or '&ldquo;' in text:
+        return Cite.MARKUP_HTML
+    if '*' in text:
+        return Cite.MARKUP_MARKDOWN
+    return Cite.MARKUP_NONE
+
+
+@functools.lru_cache(maxsize=None)
+def _formatted_grammar(style, markup):
+    """Compiled regexes for a style and markup: one for what opens every citation, read first
+       so that the others can't backtrack into it, then those for the rest, to be tried in
+       order. APA authors are unmistakable, so the first reads them and the year."""
+    oi = re.escape(Cite.OPENING_ITALICS[markup])
+    ci = re.escape(Cite.CLOSING_ITALICS[markup])
+    oq = re.escape(Cite.OPENING_QUOTE[markup])
+    cq = re.escape(Cite.CLOSING_QUOTE[markup])
+    pages = r'(?<![\d\-–])(?P<pages>\d[\d\s,\-–]*)'
+    if style == Cite.STYLE_MLA:
+        head = r'(?:(?P<authors>{})\. )?'.format(_MLA_AUTHORS)
+        title = r'(?P<title>.+?)\.'
+        in_title = r'(?P<in_title>.*?)\.'
+        edition = r'(?: (?P<edition>.+?) ed\.)?'
+        tail = (r'(?: (?P<publisher>.+?)(?:,(?= \d+\.)|\.(?! \d+\.)))?(?: (?P<year>\d+)\.)?'
+                r'(?: (?:{}|{})\. {}\.)?$'.format(re.escape(Cite.PAGE_ABBREV), re.escape(Cite.PAGES_ABBREV), pages))
+        contained = (head + oq + title + cq + ' ' + oi + in_title + ci + edition +
+                     r'(?: (?P<in_authors_role>[^.]*? by))?(?: (?P<in_authors>[^\d:]+?)(?<! \w)\.)?'
+                     r'(?: (?P<city>[^:]+?):)?' + tail)
+        book = head + oi + title + ci + edition + r'(?: (?P<city>[^:]+?):)?' + tail
+        # For when what looked like authors can't be split into names
+        anonymous = (re.compile(contained[len(head):]), re.compile(book[len(head):]))
+        # Where MLA authors end can depend on what follows, so they're read with the rest
+        head = ''
+    else:
+        head = r'(?:(?P<authors>{0}(?:(?:, {0})*, & {0})?)(?= ))?(?: ?\((?P<year>\d+)\)\.)? ?'.format(_APA_NAME)
+        title = r'(?P<title>.+?)\.'
+        place = r'(?: (?P<publisher>.+?)\.)'
+        tail = r'(?:{}\.)?(?: (?P<url>{}))?$'.format(pages, _URL)
+        if ci:
+            # Italics mark where the journal ends, whatever punctuation is in its name
+            in_title = r' {0}(?P<in_title>(?:(?!{1}).)+?)?(?<![\s,])(?:, (?P<volume>\w+))?{1}'.format(oi, ci)
+        else:
+            in_title = r' (?:(?!{}$)(?P<in_title>{}))?(?<![\s,])(?:, (?P<volume>\w+))?(?<!\.)'.format(
+                _URL, _APA_PHRASE)
+        issue = r'(?:\((?P<issue>[^)]+)\)(?:, (?=\S))?)?'
+        # Rather a journal than a publisher
+        contained = title + place + '??' + in_title + issue + tail
+        book = oi + title + ci + place + '?' + tail
+        anonymous = None
+    return re.compile(head), (re.compile(contained), re.compile(book)), anonymous
+
+
+def _read_formatted(style, text, markup):
+    if markup is None:
+        markup = _markup_of(text)
+    head, bodies, anonymous = _formatted_grammar(style, markup)
+    head = head.match(text)
+    for i, body in enumerate(bodies):
+        m = body.match(text, head.end())
+        if m is None:
+            continue
+        fields = m.groupdict()
+        fields.update(head.groupdict())
+        if anonymous is not None and fields['authors'] is not None:
+            names = _mla_names(fields['authors'])
+            if names is None:
+                m = anonymous[i].match(text)
+                if m is None:
+                    continue
+                fields = m.groupdict()
+            fields['authors'] = names
+        return _formatted_to_cite(style, fields, markup)
+    raise ValueError('Not an {} citation: {!r}'.format(style.upper(), text))
+
+
+def _mla_names(authors):
+    """'Smith, Bob, Plato, and Jones, Ann' -> ['Bob Smith', 'Plato', 'Ann Jones'], or None if it
+       can't be read as names. A family name is one word, and is taken to be followed by given
+       names where that leaves the rest readable."""
+    head, sep, last = authors.rpartition(', and ')
+    parts = head.split(', ') if sep else []
+    n = len(parts)
+    # Whether parts[i:] can be read as names, working back from the end
+    readable = [False] * (n + 2)
+    readable[n] = True
+    for i in range(n - 1, -1, -1):
+        readable[i] = ' ' not in parts[i] and (readable[i + 2] or readable[i + 1])
+    if not readable[0]:
+        return None
+    names = []
+    i = 0
+    while i < n:
+        if readable[i + 2]:
+            names.append(parts[i + 1] + ' ' + parts[i])
+            i += 2
+        else:
+            names.append(parts[i])
+            i += 1
+    family, _, given = last.partition(', ')
+    if ' ' in family:
+        return None
+    names.append(given + ' ' + family if given else family)
+    return names
+
+
+def _formatted_to_cite(style, fields, markup):
+    # MLA authors are already names (see _read_formatted())
+    authors = fields['authors']
+    if authors is not None and style == Cite.STYLE_APA:
+        authors = [Author(given + ' ' + family if given else family, initials=True)
+                   for family, given in _APA_NAMES.findall(authors)]
+    # Split here rather than in the regex, which is then much less given to backtracking
+    title, _, subtitle = fields['title'].partition(': ')
+    in_title, in_subtitle = fields.get('in_title'), None
+    if in_title:
+        in_title, _, in_subtitle = in_title.partition(': ')
+    city, publisher = fields.get('city'), fields['publisher']
+    if style == Cite.STYLE_APA and publisher is not None and ': ' in publisher:
+        city, publisher = publisher.split(': ', 1)
+    in_authors = fields.get('in_authors')
+    if in_authors is not None:
+        in_authors = _MLA_IN_NAMES.split(in_authors)
+    year = fields['year']
+    volume = fields.get('volume')
+    issue = fields.get('issue')
+    return Cite(title, subtitle=subtitle or None, authors=authors,
+                pages=PageSet.parse(fields['pages']) if fields['pages'] else None,
+                city=city, publisher=publisher,
+                year=int(year) if year is not None else None, edition=fields.get('edition'),
+                in_title=in_title or None, in_subtitle=in_subtitle or None,
+                in_authors=in_authors, in_authors_role=fields.get('in_authors_role'),
+                volume=_to_number(volume) if volume is not None else None,
+                issue=_to_number(issue) if issue is not None else None,
+                url=fields.get('url'), markup=markup)
+
+
+def _read_formatted_lines(style, f, markup, errors):
+    for number, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('<ul') or line == '</ul>':
+            continue
+        # As render_bibliography() writes them
+        if line.startswith('<li>') and line.endswith('</li>'):
+            line = line[4:-5]
+        elif line.startswith('- ') and (markup == Cite.MARKUP_MARKDOWN or markup is None and '*' in line):
+            line = line[2:]
+        try:
+            cite = _read_formatted(style, line, markup)
+        except ValueError as e:
+            if errors is None:
+                raise ValueError('Line {}: {}'.format(number, e)) from None
+            errors.append((number, str(e)))
+            continue
+        yield cite
+
+
+def read_mla(f, markup=None, errors=None):
+    """Generate a Cite for each MLA citation in 'f', one per line, e.g. a text file or a list
+       of strings. The markup is worked out line by line unless given. Blank lines and the
+       list markup render_bibliography() adds are skipped. A line that isn't an MLA citation
+       raises ValueError, or if 'errors' is a list, is skipped and added to it as (line
+       number, message), so that reading a large archive doesn't stop at the first."""
+    return _read_formatted_lines(Cite.STYLE_MLA, f, markup, errors)
+
+
+def read_apa(f, markup=None, errors=None):
+    """Generate a Cite for each APA citation in 'f', one per line (see read_mla())"""
+    return _read_formatted_lines(Cite.STYLE_APA, f, markup, errors)
+
+
+def _lookup_style(style):
+    try:
+        return STYLES[style]
+    except KeyError:
+        raise ValueError("Unsupported style '{}'. Supported styles: {}".format(
+            style, ' '.join(STYLES))) from None
+
+
+# (list opening, entry opening, entry closing, list closing) per markup. HTML gets a
+# hanging indent, Markdown a bulleted list, plain text one entry per line.
+BIBLIOGRAPHY_WRAPPERS = {
+    Cite.MARKUP_NONE: ('', '', '\n', ''),
+    Cite.MARKUP_MARKDOWN: ('', '- ', '\n', ''),
+    Cite.MARKUP_HTML: ('<ul class="bibliography" style="list-style: none; padding-left: 2em; text-indent: -2em;">\n',
+                       '<li>', '</li>\n', '</ul>\n'),
+}
+
+
+def render_bibliography(cites, style=Cite.STYLE_MLA, markup=Cite.MARKUP_NONE, out=None, sort=True):
+    """Render a whole reference list in one pass.
+
+       The style is looked up once per batch rather than once per citation, and each
+       citation's own .markup is ignored in favour of 'markup'.
+       Entries are sorted as the style orders them (see Style.sort_key()) unless
+       sort=False. If 'out' is a file-like object the list is written to it and None is
+       returned, otherwise the list is returned as a string.
+    """
+    style = _lookup_style(style)
+    if sort:
+        cites = sorted(cites, key=style.sort_key)
+    render = style.render
+    entries = [render(cite, markup) for cite in cites]
+    return _write_bibliography(entries, markup, out)
+
+
+def _write_bibliography(entries, markup, out):
+    list_open, entry_open, entry_close, list_close = BIBLIOGRAPHY_WRAPPERS[markup]
+    if out is None:
+        return list_open + ''.join([entry_open + e + entry_close for e in entries]) + list_close
+    out.write(list_open)
+    out.writelines(entry_open + e + entry_close for e in entries)
+    out.write(list_close)
+
+
+# Live bibliographies
+#
+# An editor showing a long reference list wants to redraw only what an edit touched. A
+# LiveBibliography registers itself in _watchers for each of its citations and their authors,
+# and Cite._changed() and the Author setters report to it, so it knows which entries are dirty
+# without comparing anything. Entries are kept sorted by (Style.sort_key(), number added), the
+# number breaking ties, so finding or placing one is a binary search.
+
+# What refresh() did to the list: (index, entry) pairs inserted and changed, indices removed
+BibliographyDiff = collections.namedtuple('BibliographyDiff', 'inserted removed changed')
+
+
+class LiveBibliography:
+    """A reference list that follows changes to its citations, for editors and other UIs.
+
+       bib = LiveBibliography(cites, Cite.STYLE_APA)
+       lines = list(bib)          # the entries, in the order render_bibliography() gives
+       cites[7].year = 2004       # noticed, nothing is rendered yet
+       bib.add(new_cite)
+       diff = bib.refresh()       # e.g. BibliographyDiff(inserted=[(0, '...')], removed=[3], changed=[])
+
+       refresh() re-renders only the citations changed since the last refresh and moves those
+       whose place changed. To bring a copy of the list up to date, delete the 'removed'
+       indices (into the old list) from the last one down, then insert the 'inserted' entries
+       in order and replace the 'changed' ones (both indices into the new list). Changes made
+       through an Author object are noticed too. Call close() once done with the bibliography,
+       or its citations go on reporting to it.
+    """
+
+    # Past this share of the list, refresh() re-sorts everything rather than inserting
+    # entries one at a time
+    RESORT_RATIO = 0.125
+
+    def __init__(self, cites=(), style=Cite.STYLE_MLA, markup=Cite.MARKUP_NONE):
+        self._style = _lookup_style(style)
+        self.markup = markup
+        self._keys = []          # (sort key, number), sorted
+        self._lines = []         # the entries, in the same order
+        self._entries = {}       # cite -> [number, key or None until placed, entry]
+        self._authors = {}       # cite -> the Authors watched for it
+        self._author_cites = {}  # Author -> the cites it was watched for
+        self._numbers = itertools.count()
+        self._dirty = set()
+        self._gone = []          # keys of entries to remove
+        for cite in cites:
+            self.add(cite)
+        self.refresh()
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __getitem__(self, index):
+        return self._lines[index]
+
+    def __contains__(self, cite):
+        return cite in self._entries
+
+    def index(self, cite):
+        """Where the citation's entry is, as of the last refresh"""
+        key = self._entries[cite][1]
+        if key is None:
+            raise ValueError('Citation not placed yet, call refresh() first')
+        return bisect.bisect_left(self._keys, key)
+
+    def render(self, out=None):
+        """The list as render_bibliography() would give it, as of the last refresh"""
+        return _write_bibliography(self._lines, self.markup, out)
+
+    def add(self, cite):
+        """Add a citation; it appears at the next refresh"""
+        if cite in self._entries:
+            return
+        self._entries[cite] = [next(self._numbers), None, None]
+        self._authors[cite] = frozenset()
+        self._watch(cite)
+        self._dirty.add(cite)
+
+    def remove(self, cite):
+        """Remove a citation; it disappears at the next refresh"""
+        number, key, line = self._entries.pop(cite)
+        if key is not None:
+            self._gone.append(key)
+        self._dirty.discard(cite)
+        self._unwatch(cite)
+        for author in self._authors.pop(cite):
+            self._unwatch_author(author, cite)
+
+    def close(self):
+        """Stop following the citations and empty the list"""
+        for cite in list(self._entries):
+            self.remove(cite)
+        self._gone = []
+        self._keys = []
+        self._lines = []
+
+    def _watch(self, obj):
+        _watchers.setdefault(obj, []).append(self)
+
+    def _unwatch(self, obj):
+        watchers = _watchers[obj]
+        watchers.remove(self)
+        if not watchers:
+            del _watchers[obj]
+
+    def _unwatch_author(self, author, cite):
+        cites = self._author_cites[author]
+        cites.discard(cite)
+        if not cites:
+            del self._author_cites[author]
+            self._unwatch(author)
+
+    def _touched(self, obj):
+        if type(obj) is Author:
+            self._dirty.update(self._author_cites[obj])
+        else:
+            self._dirty.add(obj)
+
+    def _render(self, cite):
+        authors = frozenset(cite.authors).union(cite.in_authors)
+        watched = self._authors[cite]
+        if authors != watched:
+            for author in authors.difference(watched):
+                if author not in self._author_cites:
+                    self._author_cites[author] = set()
+                    self._watch(author)
+                self._author_cites[author].add(cite)
+            for author in watched.difference(authors):
+                self._unwatch_author(author, cite)
+            self._authors[cite] = authors
+        return cite._cached_render(self._style, self.markup)
+
+    def refresh(self):
+        """Bring the list up to date. Returns a BibliographyDiff."""
+        dirty, self._dirty = self._dirty, set()
+        keys, lines, entries = self._keys, self._lines, self._entries
+        moving = []
+        changed = []
+        for cite in dirty:
+            entry = entries[cite]
+            line = self._render(cite)
+            key = (self._style.sort_key(cite), entry[0])
+            old = entry[1]
+            # The sort key can change when the line doesn't: APA sorts by full given names
+            if line == entry[2] and key == old:
+                continue
+            entry[1] = key
+            entry[2] = line
+            if old is not None:
+                i = bisect.bisect_left(keys, old)
+                if (i == 0 or keys[i - 1] < key) and (i + 1 == len(keys) or key < keys[i + 1]):
+                    # Still between its neighbours: changed in place
+                    keys[i] = key
+                    if line != lines[i]:
+                        lines[i] = line
+                        changed.append(key)
+                    continue
+                self._gone.append(old)
+            moving.append((key, line))
+
+        removed = sorted([bisect.bisect_left(keys, key) for key in self._gone])
+        self._gone = []
+        moving.sort()
+        if len(moving) > len(keys) * self.RESORT_RATIO:
+            dropped = set(removed)
+            merged = [item for i, item in enumerate(zip(keys, lines)) if i not in dropped] + moving
+            merged.sort()
+            keys[:] = [item[0] for item in merged]
+            lines[:] = [item[1] for item in merged]
+            inserted = [(bisect.bisect_left(keys, key), line) for key, line in moving]
+        else:
+            for i in reversed(removed):
+                del keys[i]
+                del lines[i]
+            # In ascending order each entry lands after the ones before it, so their
+            # indices stay good
+            inserted = []
+            for key, line in moving:
+                i = bisect.bisect(keys, key)
+                keys.insert(i, key)
+                lines.insert(i, line)
+                inserted.append((i, line))
+        changed = [(i, lines[i]) for i in sorted([bisect.bisect_left(keys, key) for key in changed])]
+        return BibliographyDiff(inserted, removed, changed)
+
+
+# Duplicate detection
+#
+# Comparing every pair of citations is out of the question for large collections, so each
+# citation is only compared with those sharing a block with it: the same first author family
+# name (with or without the year, which one copy may lack), or the same opening or closing words
+# of the title. Blocks that grow past
+# DuplicateIndex.max_block_size (e.g. every anonymous citation from one year) stop being
+# compared against, which keeps adding a citation close to constant time. Citations with
+# identical normalized keys are matched by a dict lookup whatever their blocks.
+
+# Cite -> (title words, author family names, year)
+DuplicateKey = collections.namedtuple('DuplicateKey', 'title families year')
+
+# Cites judged to be the same work, and the lowest similarity score that joined them
+DuplicateCluster = collections.namedtuple('DuplicateCluster', 'cites score')
+
+
+def duplicate_key(cite):
+    """The normalized form of a citation that duplicate detection compares"""
+    title = cite.title if not cite.subtitle else cite.title + ' ' + cite.subtitle
+    words = tuple(_NON_WORD.sub(' ', _fold(title)).split())
+    families = tuple([_fold(a.family_name) for a in cite.authors])
+    year = cite.year
+    if year is None and cite.date is not None:
+        year = cite.date.year
+    return DuplicateKey(words, families, year)
+
+
+def _trigrams(words):
+    text = ' ' + ' '.join(words) + ' '
+    return frozenset([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+class DuplicateIndex:
+    """Finds likely duplicates among citations as they are added.
+
+       index = DuplicateIndex(threshold=0.85)
+       for cite in cites:
+           index.add(cite)
+       for cluster in index.clusters():
+           print(cluster.score, [c.to_mla() for c in cluster.cites])
+
+       Two citations' similarity is a weighted mean of their title similarity (shared
+       character trigrams), author similarity (shared family names) and whether their years
+       match, leaving out authors or year when either citation lacks them. Pairs scoring at
+       least 'threshold' are duplicates, and duplicates of duplicates share a cluster.
+       Citations are keyed as they are when added; later changes to them aren't seen.
+    """
+    TITLE_WEIGHT = 0.6
+    AUTHORS_WEIGHT = 0.3
+    YEAR_WEIGHT = 0.1
+    # How many title words the title blocks use
+    BLOCK_WORDS = 3
+
+    def __init__(self, cites=(), threshold=0.85, max_block_size=100):
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self._cites = []
+        self._features = []  # (title trigrams, set of family names, year) per citation
+        self._exact = {}     # DuplicateKey -> first citation with it
+        self._blocks = {}    # block key -> citations in it
+        self._parent = []    # union-find forest over citation numbers
+        self._score = {}     # cluster root -> lowest score joining the cluster
+        for cite in cites:
+            self.add(cite)
+
+    def __len__(self):
+        return len(self._cites)
+
+    def _block_keys(self, key):
+        keys = [('t', key.title[:self.BLOCK_WORDS])]
+        if len(key.title) > self.BLOCK_WORDS:
+            keys.append(('e', key.title[-self.BLOCK_WORDS:]))
+        if key.families:
+            keys.append(('a', key.families[0], key.year))
+            keys.append(('f', key.families[0]))
+        return keys
+
+    def similarity(self, a, b):
+        """Similarity of two citations, from 0 to 1"""
+        return self._similarity(self._features_of(duplicate_key(a)), self._features_of(duplicate_key(b)))
+
+    @staticmethod
+    def _features_of(key):
+        return (_trigrams(key.title), frozenset(key.families), key.year)
+
+    def _similarity(self, a, b):
+        trigrams_a, families_a, year_a = a
+        trigrams_b, families_b, year_b = b
+        total = self.TITLE_WEIGHT * 2 * len(trigrams_a & trigrams_b) / ((len(trigrams_a) + len(trigrams_b)) or 1)
+        weight = self.TITLE_WEIGHT
+        if families_a and families_b:
+            total += self.AUTHORS_WEIGHT * len(families_a & families_b) / len(families_a | families_b)
+            weight += self.AUTHORS_WEIGHT
+        if year_a is not None and year_b is not None:
+            if year_a == year_b:
+                total += self.YEAR_WEIGHT
+            weight += self.YEAR_WEIGHT
+        return total / weight
+
+    def _find(self, i):
+        parent = self._parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def _union(self, i, j, score):
+        root_i, root_j = self._find(i), self._find(j)
+        if root_i == root_j:
+            if score < self._score[root_i]:
+                self._score[root_i] = score
+            return
+        if root_i > root_j:
+            root_i, root_j = root_j, root_i
+        self._parent[root_j] = root_i
+        self._score[root_i] = min(score, self._score.pop(root_i, score), self._score.pop(root_j, score))
+
+    def add(self, cite):
+        """Index a citation. Returns the (earlier citation, score) pairs it duplicates."""
+        i = len(self._cites)
+        key = duplicate_key(cite)
+        features = self._features_of(key)
+        self._cites.append(cite)
+        self._features.append(features)
+        self._parent.append(i)
+
+        scores = {}
+        first = self._exact.setdefault(key, i)
+        if first != i:
+            scores[first] = 1.0
+        # Titles too different in length can't reach the threshold even if all else matches
+        other_weights = self.AUTHORS_WEIGHT + self.YEAR_WEIGHT
+        min_dice = (self.threshold * (self.TITLE_WEIGHT + other_weights) - other_weights) / self.TITLE_WEIGHT
+        size = len(features[0])
+        all_features = self._features
+        for block_key in self._block_keys(key):
+            block = self._blocks.setdefault(block_key, [])
+            if len(block) < self.max_block_size:
+                for j in block:
+                    if j not in scores:
+                        other = all_features[j]
+                        other_size = len(other[0])
+                        if 2 * min(size, other_size) < min_dice * (size + other_size):
+                            scores[j] = 0.0
+                        else:
+                            scores[j] = self._similarity(features, other)
+                block.append(i)
+
+        matches = []
+        for j, score in sorted(scores.items()):
+            if score >= self.threshold:
+                self._union(i, j, score)
+                matches.append((self._cites[j], score))
+        return matches
+
+    def clusters(self):
+        """Clusters of two or more likely duplicates, in the order they were added"""
+        members = {}
+        for i in range(len(self._cites)):
+            members.setdefault(self._find(i), []).append(self._cites[i])
+        return [DuplicateCluster(cites, self._score[root]) for root, cites in members.items() if len(cites) > 1]
+
+
+# In-text citations
+#
+# A reference in running text names only the authors, plus the year (APA) or page (MLA), so
+# two works can come out alike: Smith (2002) for two of Smith's 2002 papers. APA then adds
+# a, b, ... to the year, in the order the works appear in the reference list, and
+# MLA adds a short title. CitationRegistry keeps the citations of a document grouped by how
+# they would otherwise read, with each group sorted, so adding a citation only touches its own
+# group: a dict lookup and a binary search.
+
+def _in_text_authors(authors, et_al, conjunction):
+    families = [a.family_name for a in authors]
+    if len(families) >= et_al:
+        return families[0] + ' et al.'
+    if len(families) == 1:
+        return families[0]
+    if len(families) == 2:
+        return families[0] + ' ' + conjunction + ' ' + families[1]
+    return ', '.join(families[:-1]) + ', ' + conjunction + ' ' + families[-1]
+
+
+# Words that end a title's first noun phrase, and punctuation that ends it before them
+_SHORT_TITLE_STOPS = frozenset(['about', 'after', 'against', 'among', 'and', 'as', 'at', 'before', 'between',
+                                'but', 'by', 'during', 'for', 'from', 'in', 'into', 'nor', 'of', 'on', 'or',
+                                'over', 'since', 'through', 'to', 'under', 'versus', 'vs', 'with', 'without'])
+_SHORT_TITLE_END = re.compile(r'[:;,?!(\[]')
+
+
+def _short_title(title):
+    """'The Zebra Studies of Africa' -> 'Zebra Studies': the first noun phrase of the title,
+       without a leading article, as MLA shortens titles in in-text citations"""
+    words = _SHORT_TITLE_END.split(title, 1)[0].split()
+    if len(words) > 1 and _fold(words[0]) + ' ' in _LEADING_ARTICLES:
+        del words[0]
+    for i in range(1, len(words)):
+        if _fold(words[i]) in _SHORT_TITLE_STOPS:
+            del words[i:]
+            break
+    return ' '.join(words) or title
+
+
+def _in_text_title(cite, markup, short=False):
+    """The title (without its subtitle), marked up as it is in the reference list. short
+       gives MLA's shortened title (see _short_title())."""
+    title = _short_title(cite.title) if short else cite.title
+    if cite.in_title:
+        return Cite.OPENING_QUOTE[markup] + title + Cite.CLOSING_QUOTE[markup]
+    return Cite.OPENING_ITALICS[markup] + title + Cite.CLOSING_ITALICS[markup]
+
+
+class CitationRegistry:
+    """The in-text citations of one document, in APA or MLA style.
+
+       registry = CitationRegistry(Cite.STYLE_APA)
+       registry.cite(smith_a, pages=25)   # '(Smith, 2002, p. 25)'
+       registry.add(smith_b)              # [smith_a, smith_b]: both now need a suffix
+       registry.cite(smith_a)             # '(Smith, 2002a)'
+
+       add() returns the citations whose in-text form changed, so a long manuscript can be
+       updated as it is written rather than re-rendered. Citations are known by identity and
+       keyed as they are when first added. Works with at least 'et_al' authors are cited by the
+       first author's name and "et al.".
+    """
+
+    def __init__(self, style=Cite.STYLE_APA, markup=Cite.MARKUP_NONE, et_al=3):
+        if style not in (Cite.STYLE_APA, Cite.STYLE_MLA):
+            raise ValueError("Unsupported style '{}'. Supported styles: {} {}".format(
+                style, Cite.STYLE_APA, Cite.STYLE_MLA))
+        self.style = style
+        self.markup = markup
+        self.et_al = et_al
+        self._groups = {}   # how the citation would read undisambiguated -> [(sort key, number, cite)]
+        self._entries = {}  # cite -> (group key, its entry in the group)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, cite):
+        return cite in self._entries
+
+    def _group_key(self, cite):
+        if cite.authors:
+            authors = _in_text_authors(cite.authors, self.et_al, '&' if self.style == Cite.STYLE_APA else 'and')
+        else:
+            authors = _in_text_title(cite, self.markup, self.style == Cite.STYLE_MLA)
+        if self.style == Cite.STYLE_MLA:
+            return (authors, None)
+        if cite.year is not None:
+            return (authors, str(cite.year))
+        if cite.date is not None:
+            return (authors, str(cite.date.year))
+        return (authors, 'n.d.')
+
+    def add(self, cite):
+        """Register a citation. Returns the registered citations whose in-text form this changed,
+           including the new one, in reference list order."""
+        if cite in self._entries:
+            return []
+        key = self._group_key(cite)
+        # Ordered as the reference list is (see Style.sort_key())
+        entry = (STYLES[self.style].sort_key(cite), len(self._entries), cite)
+        group = self._groups.setdefault(key, [])
+        # Numbers are unique, so the comparison never reaches the Cite
+        pos = bisect.bisect(group, entry)
+        group.insert(pos, entry)
+        self._entries[cite] = (key, entry)
+        if len(group) == 2:
+            return [e[2] for e in group]
+        if self.style == Cite.STYLE_APA:
+            # Everything after the new citation moves down a letter
+            return [e[2] for e in group[pos:]]
+        return [cite]
+
+    def label(self, cite):
+        """The citation without parentheses or pages, e.g. 'Smith, 2002a', adding it if need be"""
+        try:
+            key, entry = self._entries[cite]
+        except KeyError:
+            self.add(cite)
+            key, entry = self._entries[cite]
+        authors, year = key
+        group = self._groups[key]
+        if self.style == Cite.STYLE_APA:
+            if len(group) > 1:
+                suffix = _key_suffix(bisect.bisect_left(group, entry))
+                year += '-' + suffix if year == 'n.d.' else suffix
+            return authors + ', ' + year
+        if len(group) > 1:
+            if not cite.authors:
+                # Anonymous works whose shortened titles are the same
+                return _in_text_title(cite, self.markup)
+            return authors + ', ' + _in_text_title(cite, self.markup, True)
+        return authors
+
+    def cite(self, cite, pages=None):
+        """The parenthetical citation, e.g. '(Smith, 2002a, p. 25)' or '(Smith 25)'"""
+        label = self.label(cite)
+        if pages is not None:
+            pages = PageSet(pages)
+        if not pages:
+            return '(' + label + ')'
+        if self.style == Cite.STYLE_APA:
+            return '(' + label + ', ' + _mla_pages(pages) + ')'
+        return '(' + label + ' ' + str(pages) + ')'
+
+
+# SQLite store
+#
+# One row per citation in 'cites' and one per author in 'authors' (role 'a' for authors, 'i'
+# for in_authors). Searchable text is also stored folded (see _fold()) in indexed *_key
+# columns, so lookups are case and accent insensitive and title searches are index range
+# scans on a prefix. Renderings are cached in 'renders' per (citation, style, markup); triggers
+# drop a citation's renderings whenever its row is updated or deleted, whoever does it.
+
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cites (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL, title_key TEXT NOT NULL, subtitle,
+    pages TEXT, city, publisher, year INTEGER, edition,
+    in_title, in_title_key TEXT, in_subtitle, in_authors_role, journal,
+    volume, issue, date TEXT, url, retrieved_date TEXT, markup INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS authors (
+    cite_id INTEGER NOT NULL REFERENCES cites(id) ON DELETE CASCADE,
+    role TEXT NOT NULL, position INTEGER NOT NULL,
+    name TEXT NOT NULL, initials INTEGER NOT NULL, family_key TEXT NOT NULL,
+    PRIMARY KEY (cite_id, role, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS renders (
+    cite_id INTEGER NOT NULL, style TEXT NOT NULL, markup INTEGER NOT NULL, output TEXT NOT NULL,
+    PRIMARY KEY (cite_id, style, markup)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS authors_family ON authors (family_key);
+CREATE INDEX IF NOT EXISTS cites_year ON cites (year);
+CREATE INDEX IF NOT EXISTS cites_title ON cites (title_key);
+CREATE INDEX IF NOT EXISTS cites_in_title ON cites (in_title_key);
+CREATE TRIGGER IF NOT EXISTS cites_updated AFTER UPDATE ON cites BEGIN
+    DELETE FROM renders WHERE cite_id = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS cites_deleted AFTER DELETE ON cites BEGIN
+    DELETE FROM renders WHERE cite_id = old.id;
+END;
+"""
+
+# 'cites' columns after id, as stored by CiteStore
+_STORE_COLUMNS = ('title', 'title_key', 'subtitle', 'pages', 'city', 'publisher', 'year', 'edition',
+                  'in_title', 'in_title_key', 'in_subtitle', 'in_authors_role', 'journal',
+                  'volume', 'issue', 'date', 'url', 'retrieved_date', 'markup')
+_STORE_INSERT = 'INSERT INTO cites (id, {}) VALUES (?{})'.format(', '.join(_STORE_COLUMNS), ', ?' * len(_STORE_COLUMNS))
+_STORE_UPDATE = 'UPDATE cites SET {} WHERE id = ?'.format(', '.join([c + ' = ?' for c in _STORE_COLUMNS]))
+_STORE_SELECT = 'SELECT id, {} FROM cites'.format(', '.join(_STORE_COLUMNS))
+
+
+def _iso(date):
+    if date is None:
+        return None
+    # Read back with date.fromisoformat(), so a datetime is stored as its date
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    return date.isoformat()
+
+
+def _store_row(cite):
+    in_title = cite.in_title
+    return (cite.title, _fold(cite.title), cite.subtitle, str(cite.pages) if cite.pages else None,
+            cite.city, cite.publisher, cite.year, cite.edition,
+            in_title, _fold(in_title) if in_title else None, cite.in_subtitle, cite.in_authors_role,
+            getattr(cite, 'journal', None), cite.volume, cite.issue,
+            _iso(cite.date), cite.url, _iso(cite.retrieved_date), cite.markup)
+
+
+def _store_author_rows(cite_id, cite):
+    rows = []
+    for role, authors in (('a', cite.authors), ('i', cite.in_authors)):
+        for position, author in enumerate(authors):
+            rows.append((cite_id, role, position, author.name, int(author.initials), _fold(author.family_name)))
+    return rows
+
+
+class CiteStore:
+    """Citations kept in an SQLite database, by integer id.
+
+       with CiteStore('library.db') as store:
+           store.add_many(read_bibtex(f))
+           for cite in store.query(author='Smith', year=(1990, 1999)):
+               ...
+           html = list(store.render(Cite.STYLE_APA, Cite.MARKUP_HTML, title='incan'))
+
+       Queries yield citations a batch of rows at a time, so any number can be iterated over.
+       Cites read from the store are copies: change one and pass it to update() to save it.
+    """
+    # Rows fetched from SQLite at a time by query() and render()
+    FETCH_SIZE = 1000
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        # Transactions are begun and committed explicitly, see _transaction()
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA foreign_keys = ON')
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript(_STORE_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def _transaction(self):
+        return _StoreTransaction(self._db)
+
+    def __len__(self):
+        return self._db.execute('SELECT count(*) FROM cites').fetchone()[0]
+
+    def __contains__(self, cite_id):
+        return self._db.execute('SELECT 1 FROM cites WHERE id = ?', (cite_id,)).fetchone() is not None
+
+    def add(self, cite):
+        """Store a citation. Returns its id."""
+        return self.add_many([cite])[0]
+
+    def add_many(self, cites, batch_size=10000):
+        """Store citations from any iterable, batch_size to a transaction. Returns their ids."""
+        ids = []
+        insert = _STORE_INSERT
+        cites = iter(cites)
+        while True:
+            batch = list(itertools.islice(cites, batch_size))
+            if not batch:
+                return ids
+            with self._transaction() as db:
+                # Ids are assigned here rather than by SQLite so that the authors rows can be
+                # written with executemany() too
+                first = (db.execute('SELECT max(id) FROM cites').fetchone()[0] or 0) + 1
+                batch_ids = range(first, first + len(batch))
+                db.executemany(insert, [(i,) + _store_row(c) for i, c in zip(batch_ids, batch)])
+                author_rows = []
+                for i, cite in zip(batch_ids, batch):
+                    if cite.authors or cite.in_authors:
+                        author_rows.extend(_store_author_rows(i, cite))
+                db.executemany('INSERT INTO authors VALUES (?, ?, ?, ?, ?, ?)', author_rows)
+            ids.extend(batch_ids)
+
+    def update(self, cite_id, cite):
+        """Replace the stored citation 'cite_id' with 'cite'"""
+        with self._transaction() as db:
+            if db.execute(_STORE_UPDATE, _store_row(cite) + (cite_id,)).rowcount == 0:
+                raise KeyError(cite_id)
+            db.execute('DELETE FROM authors WHERE cite_id = ?', (cite_id,))
+            db.executemany('INSERT INTO authors VALUES (?, ?, ?, ?, ?, ?)', _store_author_rows(cite_id, cite))
+
+    def delete(self, cite_id):
+        with self._transaction() as db:
+            if db.execute('DELETE FROM cites WHERE id = ?', (cite_id,)).rowcount == 0:
+                raise KeyError(cite_id)
+
+    def get(self, cite_id):
+        for _, cite in self._cites(self._db.execute(_STORE_SELECT + ' WHERE id = ?', (cite_id,))):
+            return cite
+        raise KeyError(cite_id)
+
+    def _where(self, author, year, title, in_title):
+        """SQL conditions and parameters for a query"""
+        conditions = []
+        params = []
+        if author is not None:
+            conditions.append('id IN (SELECT cite_id FROM authors WHERE family_key = ? AND role = ?)')
+            params += [_fold(author), 'a']
+        if year is not None:
+            if type(year) is tuple:
+                conditions.append('year BETWEEN ? AND ?')
+                params += list(year)
+            else:
+                conditions.append('year = ?')
+                params.append(year)
+        for column, prefix in (('title_key', title), ('in_title_key', in_title)):
+            if prefix is not None:
+                # A range rather than LIKE, which can't use the index case-insensitively
+                conditions.append('{0} >= ? AND {0} < ?'.format(column))
+                prefix = _fold(prefix)
+                params += [prefix, prefix + '\U0010ffff']
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+    def _select(self, author, year, title, in_title, limit):
+        where, params = self._where(author, year, title, in_title)
+        sql = _STORE_SELECT + where + ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self._db.execute(sql, params)
+
+    def _authors(self, ids):
+        """{cite id: (authors, in_authors)} for some citations"""
+        authors = {}
+        rows = self._db.execute('SELECT cite_id, role, name, initials FROM authors WHERE cite_id IN ({}) '
+                                'ORDER BY cite_id, role, position'.format(','.join('?' * len(ids))), ids)
+        for cite_id, role, name, initials in rows:
+            names = authors.get(cite_id)
+            if names is None:
+                names = authors[cite_id] = ([], [])
+            names[role == 'i'].append(Author(name, bool(initials)))
+        return authors
+
+    def _cites(self, cursor):
+        """(id, Cite) for each 'cites' row from the cursor, FETCH_SIZE rows at a time"""
+        no_authors = ([], [])
+        while True:
+            rows = cursor.fetchmany(self.FETCH_SIZE)
+            if not rows:
+                return
+            authors = self._authors([row[0] for row in rows])
+            for (cite_id, title, _, subtitle, pages, city, publisher, year, edition, in_title, _, in_subtitle,
+                 in_authors_role, journal, volume, issue, date, url, retrieved_date, markup) in rows:
+                names, in_names = authors.get(cite_id, no_authors)
+                cite = Cite(title, subtitle, names, pages, city, publisher, year, edition, in_title, in_subtitle,
+                            in_names, in_authors_role, volume, issue,
+                            datetime.date.fromisoformat(date) if date else None, url,
+                            datetime.date.fromisoformat(retrieved_date) if retrieved_date else None, markup)
+                if journal is not None:
+                    cite.journal = journal
+                yield cite_id, cite
+
+    def query(self, author=None, year=None, title=None, in_title=None, limit=None):
+        """Generate (id, Cite) for the stored citations matching all the conditions given, in id
+           order. 'author' is a family name, 'year' a year or an inclusive (first, last) range, and
+           'title' and 'in_title' match the start of those fields. Case and accents are ignored."""
+        return self._cites(self._select(author, year, title, in_title, limit))
+
+    def render(self, style=Cite.STYLE_MLA, markup=Cite.MARKUP_NONE, author=None, year=None, title=None,
+               in_title=None, limit=None):
+        """Generate (id, rendered citation) for a query (see query()), rendering only what isn't
+           in the store's render cache, and caching that"""
+        render = _lookup_style(style).render
+        where, params = self._where(author, year, title, in_title)
+        sql = 'SELECT id FROM cites' + where + ' ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        cursor = self._db.execute(sql, params)
+        while True:
+            ids = [row[0] for row in cursor.fetchmany(self.FETCH_SIZE)]
+            if not ids:
+                return
+            placeholders = ','.join('?' * len(ids))
+            cached = dict(self._db.execute(
+                'SELECT cite_id, output FROM renders WHERE style = ? AND markup = ? AND cite_id IN ({})'.format(
+                    placeholders), [style, markup] + ids))
+            missing = [i for i in ids if i not in cached]
+            if missing:
+                rows = self._db.execute(_STORE_SELECT + ' WHERE id IN ({}) ORDER BY id'.format(
+                    ','.join('?' * len(missing))), missing)
+                new = [(cite_id, style, markup, render(cite, markup)) for cite_id, cite in self._cites(rows)]
+                with self._transaction() as db:
+                    db.executemany('INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?)', new)
+                cached.update([(row[0], row[3]) for row in new])
+            for cite_id in ids:
+                yield cite_id, cached[cite_id]
+
+    def clear_render_cache(self):
+        """Drop every cached rendering, e.g. after changing Cite.PAGE_ABBREV"""
+        with self._transaction() as db:
+            db.execute('DELETE FROM renders')
+
+
+class _StoreTransaction:
+    """Context manager for one transaction on a connection in autocommit mode"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        # Take the write lock now: add_many() reads max(id) before writing, and another writer
+        # mustn't get in between
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, *exc_info):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+# Binary snapshots
+#
+# A snapshot file holds a collection of citations laid out so that it can be memory-mapped and
+# read in place (all integers little-endian):
+#
+#   header    _SNAPSHOT_HEADER: magic, version, counts, and the offset of each section below
+#   records   one fixed-size _SNAPSHOT_RECORD per citation, so record i is at records + i * size
+#   authors   uint32 per author: string id, with the top bit set if initials are on
+#   pages     int32 pairs: each page range's begin and end
+#   strings   uint64 offsets, one more than there are strings, then the UTF-8 data
+#
+# Every distinct string is stored once, and id 0 means None. A record has a string id for each
+# of _SNAPSHOT_FIELDS, plus two bits per field saying whether it was an int or a date.
+
+_SNAPSHOT_MAGIC = b'PYCITE\x00S'
+_SNAPSHOT_VERSION = 1
+# magic, version, records, authors, pages, strings, then the offsets of the four sections
+_SNAPSHOT_HEADER = struct.Struct('<8sIIIIIxxxxQQQQ')
+# Attributes kept in the string table, in the order of their ids in a record
+_SNAPSHOT_FIELDS = ('title', 'subtitle', 'city', 'publisher', 'year', 'edition', 'in_title', 'in_subtitle',
+                    'in_authors_role', 'journal', 'volume', 'issue', 'date', 'url', 'retrieved_date')
+# String ids, first author, author count, in_authors count, first page range, page range
+# count, int/date bits, markup
+_SNAPSHOT_RECORD = struct.Struct('<{}IIIIIIIB3x'.format(len(_SNAPSHOT_FIELDS)))
+_SNAPSHOT_INITIALS = 1 << 31
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def write_snapshot(cites, f):
+    """Write citations to a snapshot file (a path, or a seekable binary file) for Snapshot to
+       read. Returns the number written."""
+    if isinstance(f, (str, bytes, os.PathLike)):
+        with open(f, 'wb') as out:
+            return write_snapshot(cites, out)
+    strings = {}
+    blob = bytearray()
+    string_offsets = array.array('Q', [0, 0])  # id 0 is None
+
+    def string_id(value):
+        try:
+            return strings[value]
+        except KeyError:
+            blob.extend(value.encode('utf-8'))
+            string_offsets.append(len(blob))
+            sid = strings[value] = len(string_offsets) - 2
+            return sid
+
+    authors = array.array('I')
+    pages = array.array('i')
+    pack = _SNAPSHOT_RECORD.pack
+    start = f.tell()
+    f.write(bytes(_SNAPSHOT_HEADER.size))
+    count = 0
+    records = []
+    for cite in cites:
+        ids = []
+        kinds = 0
+        for i, name in enumerate(_SNAPSHOT_FIELDS):
+            value = getattr(cite, name, None)
+            if value is None:
+                ids.append(0)
+                continue
+            if type(value) is int:
+                kinds |= 1 << (2 * i)
+                value = str(value)
+            elif type(value) is datetime.date:
+                kinds |= 2 << (2 * i)
+                value = value.isoformat()
+            elif type(value) is not str:
+                value = str(value)
+            ids.append(string_id(value))
+        first_author = len(authors)
+        for author in itertools.chain(cite.authors, cite.in_authors):
+            sid = string_id(author.name)
+            authors.append(sid | _SNAPSHOT_INITIALS if author.initials else sid)
+        cite_pages = cite.pages
+        first_page = len(pages) // 2
+        if type(cite_pages) is PageSet:
+            for begin, end in zip(cite_pages._begins, cite_pages._ends):
+                pages.append(begin)
+                pages.append(end)
+        else:
+            for page in cite_pages:
+                pages.append(page.begin)
+                pages.append(page.end)
+        records.append(pack(*ids, first_author, len(cite.authors), len(cite.in_authors),
+                            first_page, len(pages) // 2 - first_page, kinds, cite.markup))
+        count += 1
+        if len(records) >= 4096:
+            f.write(b''.join(records))
+            records = []
+    f.write(b''.join(records))
+
+    # The other sections, each 8-byte aligned
+    offsets = []
+    position = start + _SNAPSHOT_HEADER.size + count * _SNAPSHOT_RECORD.size
+    for section in (authors, pages, string_offsets, blob):
+        padding = _align(position) - position
+        f.write(bytes(padding))
+        position += padding
+        offsets.append(position - start)
+        data = section.tobytes() if type(section) is array.array else section
+        if sys.byteorder != 'little' and type(section) is array.array:
+            swapped = array.array(section.typecode, section)
+            swapped.byteswap()
+            data = swapped.tobytes()
+        f.write(data)
+        position += len(data)
+    end = f.tell()
+    f.seek(start)
+    f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, count, len(authors),
+                                  len(pages) // 2, len(string_offsets) - 2, *offsets))
+    f.seek(end)
+    return count
+
+
+class Snapshot:
+    """A snapshot file (see write_snapshot()), memory-mapped.
+
+       with Snapshot('library.snapshot') as snapshot:
+           print(len(snapshot), snapshot[123456].to_mla())
+
+       Opening one reads only the header. snapshot[i] and iteration give SnapshotCite views,
+       which read their fields from the mapping as they're accessed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self._count, author_count, page_count, string_count, authors_at, pages_at,
+             offsets_at, blob_at) = _SNAPSHOT_HEADER.unpack_from(self._mmap, 0)
+            if magic != _SNAPSHOT_MAGIC:
+                raise ValueError('{} is not a citation snapshot'.format(path))
+            if version != _SNAPSHOT_VERSION:
+                raise ValueError('{} is snapshot version {}; this reads version {}'.format(
+                    path, version, _SNAPSHOT_VERSION))
+            if sys.byteorder != 'little':
+                raise ValueError('Snapshots can only be memory-mapped on little-endian machines')
+            view = memoryview(self._mmap)
+            self._view = view
+            self._authors = view[authors_at:authors_at + 4 * author_count].cast('I')
+            self._pages = view[pages_at:pages_at + 8 * page_count].cast('i')
+            self._string_offsets = view[offsets_at:offsets_at + 8 * (string_count + 2)].cast('Q')
+            self._blob_at = blob_at
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        # The memoryviews must go before the mapping can close
+        for name in ('_authors', '_pages', '_string_offsets', '_view'):
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+                setattr(self, name, None)
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('snapshot index out of range')
+        return SnapshotCite(self, _SNAPSHOT_RECORD.unpack_from(
+            self._mmap, _SNAPSHOT_HEADER.size + index * _SNAPSHOT_RECORD.size))
+
+    def __iter__(self):
+        for record in _SNAPSHOT_RECORD.iter_unpack(self._view[_SNAPSHOT_HEADER.size:
+                                                              _SNAPSHOT_HEADER.size + self._count * _SNAPSHOT_RECORD.size]):
+            yield SnapshotCite(self, record)
+
+    def _string(self, sid):
+        offsets = self._string_offsets
+        start = self._blob_at + offsets[sid]
+        return str(self._view[start:self._blob_at + offsets[sid + 1]], 'utf-8')
+
+
+_SNAPSHOT_AUTHORS_IDX = len(_SNAPSHOT_FIELDS)
+
+
+def _snapshot_field(i):
+    def get(self):
+        sid = self._record[i]
+        if not sid:
+            return None
+        value = self._snapshot._string(sid)
+        kind = self._record[_SNAPSHOT_AUTHORS_IDX + 5] >> (2 * i) & 3
+        if kind == 1:
+            return int(value)
+        if kind == 2:
+            return datetime.date.fromisoformat(value)
+        return value
+    return property(get)
+
+
+class SnapshotCite:
+    """Read-only view of one citation in a Snapshot. Fields are read from the snapshot each time
+       they're accessed: strings as str, authors as Author, pages as a PageSet. It renders like
+       a Cite; to_cite() makes a full, independent Cite."""
+    __slots__ = ('_snapshot', '_record')
+
+    def __init__(self, snapshot, record):
+        self._snapshot = snapshot
+        self._record = record
+
+    def _authors(self, first, count):
+        authors = self._snapshot._authors
+        string = self._snapshot._string
+        return [Author(string(value & ~_SNAPSHOT_INITIALS), bool(value & _SNAPSHOT_INITIALS))
+                for value in authors[first:first + count]]
+
+    @property
+    def authors(self):
+        first, count = self._record[_SNAPSHOT_AUTHORS_IDX:_SNAPSHOT_AUTHORS_IDX + 2]
+        return self._authors(first, count)
+
+    @property
+    def in_authors(self):
+        first, count, in_count = self._record[_SNAPSHOT_AUTHORS_IDX:_SNAPSHOT_AUTHORS_IDX + 3]
+        return self._authors(first + count, in_count)
+
+    @property
+    def pages(self):
+        first, count = self._record[_SNAPSHOT_AUTHORS_IDX + 3:_SNAPSHOT_AUTHORS_IDX + 5]
+        values = self._snapshot._pages[2 * first:2 * (first + count)]
+        return PageSet(list(zip(values[::2], values[1::2])))
+
+    @property
+    def markup(self):
+        return self._record[-1]
+
+    def to_cite(self):
+        cite = Cite(self.title, self.subtitle, self.authors, self.pages, self.city, self.publisher, self.year,
+                    self.edition, self.in_title, self.in_subtitle, self.in_authors, self.in_authors_role,
+                    self.volume, self.issue, self.date, self.url, self.retrieved_date, self.markup)
+        journal = self.journal
+        if journal is not None:
+            cite.journal = journal
+        return cite
+
+    def to_mla(self):
+        return MLA.render(self, self.markup)
+
+    def to_apa(self):
+        return APA.render(self, self.markup)
+
+
+for _i, _name in enumerate(_SNAPSHOT_FIELDS):
+    setattr(SnapshotCite, _name, _snapshot_field(_i))
+del _i, _name
+
+
+# Search
+#
+# SearchIndex keeps, per field, a posting list for every word: an array of the numbers of the
+# citations containing it, in the order they were added, so that whether a citation contains a
+# word is a binary search. A sorted vocabulary of all the words gives prefix lookups for
+# autocompletion. Removed citations are only marked as gone, and the posting lists are
+# compacted once more than half of what they hold is gone.
+
+class SearchIndex:
+    """Ranked word and prefix search over titles, authors, in_title and year.
+
+       index = SearchIndex(cites)
+       index.search('smith incan myth')   # citations matching every word, best first
+       index.complete('myth')             # ['mythology', 'myths', ...]
+
+       The last word of a query is also matched as a prefix, unless the query ends in a space.
+       A match scores its field's weight (FIELD_WEIGHTS) times how rare the query word is; a
+       prefix match scores PREFIX_WEIGHT of that. Searches stop at 'budget' seconds and return the best
+       results found by then. Citations are indexed as they are when added: after changing one,
+       update() it.
+    """
+    FIELD_WEIGHTS = collections.OrderedDict([
+        ('title', 3.0),
+        ('family', 3.0),
+        ('year', 2.0),
+        ('in_title', 1.5),
+        ('given', 1.0),
+    ])
+    PREFIX_WEIGHT = 0.8
+    # Most words a prefix is expanded to, shortest first
+    PREFIX_EXPANSIONS = 64
+    # Default time limit for search(), in seconds
+    BUDGET = 0.005
+
+    def __init__(self, cites=()):
+        self._cites = []   # citation number -> Cite, or None once removed
+        self._numbers = {}  # Cite -> citation number
+        self._indexed = []  # citation number -> the words it was indexed under, or None once removed
+        self._removed = 0
+        self._postings = {field: {} for field in self.FIELD_WEIGHTS}
+        self._counts = {}  # word -> how many citations have it, in any field
+        self._vocabulary = []  # sorted
+        self.add_many(cites)
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def __contains__(self, cite):
+        return cite in self._numbers
+
+    @staticmethod
+    def _words(text):
+        return _NON_WORD.sub(' ', _fold(text)).split()
+
+    def _fields(self, cite):
+        """{field: set of words} for a citation"""
+        title = cite.title if not cite.subtitle else cite.title + ' ' + cite.subtitle
+        family = set()
+        given = set()
+        for author in cite.authors:
+            family.update(self._words(author.family_name))
+            for name in author.given_names:
+                given.update(self._words(name))
+        year = cite.year
+        if year is None and cite.date is not None:
+            year = cite.date.year
+        return {
+            'title': set(self._words(title)),
+            'family': family,
+            'year': {str(year)} if year is not None else set(),
+            'in_title': set(self._words(cite.in_title)) if cite.in_title else set(),
+            'given': given,
+        }
+
+    def add(self, cite):
+        self.add_many([cite])
+
+    def add_many(self, cites):
+        postings = self._postings
+        counts = self._counts
+        new_words = []
+        for cite in cites:
+            if cite in self._numbers:
+                continue
+            number = len(self._cites)
+            self._cites.append(cite)
+            self._numbers[cite] = number
+            seen = set()
+            for field, words in self._fields(cite).items():
+                field_postings = postings[field]
+                for word in words:
+                    try:
+                        field_postings[word].append(number)
+                    except KeyError:
+                        field_postings[word] = array.array('I', (number,))
+                seen |= words
+            self._indexed.append(tuple(seen))
+            for word in seen:
+                if word in counts:
+                    counts[word] += 1
+                else:
+                    counts[word] = 1
+                    new_words.append(word)
+        if new_words:
+            # One sort for a batch; for a few words, inserting them is cheaper
+            if len(new_words) > 16:
+                self._vocabulary = sorted(self._vocabulary + new_words)
+            else:
+                for word in new_words:
+                    bisect.insort(self._vocabulary, word)
+
+    def remove(self, cite):
+        number = self._numbers.pop(cite)
+        self._cites[number] = None
+        self._removed += 1
+        # The words it had when it was added: it may have changed since
+        for word in self._indexed[number]:
+            self._counts[word] -= 1
+        self._indexed[number] = None
+        if self._removed * 2 > len(self._cites):
+            self._compact()
+
+    def update(self, cite):
+        """Re-index a citation after it has changed"""
+        self.remove(cite)
+        self.add(cite)
+
+    def _compact(self):
+        cites = [cite for cite in self._cites if cite is not None]
+        self.__init__()
+        self.add_many(cites)
+
+    def complete(self, prefix, limit=10):
+        """Up to 'limit' indexed words starting with 'prefix', the most common first"""
+        words = self._words(prefix)
+        if not words:
+            return []
+        prefix = words[-1]
+        vocabulary = self._vocabulary
+        start = bisect.bisect_left(vocabulary, prefix)
+        end = bisect.bisect_left(vocabulary, prefix + '\U0010ffff', start)
+        counts = self._counts
+        matches = [w for w in vocabulary[start:end] if counts[w] > 0]
+        return heapq.nsmallest(limit, matches, key=lambda w: (-counts[w], w))
+
+    def _sources(self, word, prefix):
+        """[(weight, posting list)] for a query word, the shortest lists first"""
+        expansions = [(word, 1.0)] if word in self._counts else []
+        if prefix:
+            vocabulary = self._vocabulary
+            start = bisect.bisect_left(vocabulary, word)
+            end = bisect.bisect_left(vocabulary, word + '\U0010ffff', start)
+            longer = [w for w in vocabulary[start:end] if w != word]
+            if len(longer) > self.PREFIX_EXPANSIONS:
+                longer = heapq.nsmallest(self.PREFIX_EXPANSIONS, longer, key=len)
+            expansions += [(w, self.PREFIX_WEIGHT) for w in longer]
+        expansions = [(w, factor) for w, factor in expansions if self._counts[w] > 0]
+        if not expansions:
+            return []
+        # How rare the query word is, counting every word it expands to
+        rarity = math.log(1 + len(self._cites) / sum([self._counts[w] for w, _ in expansions]))
+        sources = []
+        for expansion, factor in expansions:
+            for field, weight in self.FIELD_WEIGHTS.items():
+                numbers = self._postings[field].get(expansion)
+                if numbers is not None:
+                    sources.append((weight * factor * rarity, numbers))
+        sources.sort(key=lambda source: len(source[1]))
+        return sources
+
+    def search(self, query, limit=10, budget=None):
+        """Up to 'limit' citations matching every word of the query, best first"""
+        words = self._words(query)
+        if not words:
+            return []
+        deadline = time.perf_counter() + (self.BUDGET if budget is None else budget)
+        prefix = not query[-1].isspace()
+        terms = [self._sources(word, prefix and i == len(words) - 1) for i, word in enumerate(words)]
+        if not all(terms):
+            return []
+        # Candidates come from the word with the fewest matches, taking its posting lists best
+        # first so that the first list a citation turns up in gives its score for that word.
+        # The other words are checked by binary search in their posting lists.
+        sizes = [sum([len(numbers) for _, numbers in sources]) for sources in terms]
+        order = sorted(range(len(terms)), key=sizes.__getitem__)
+        driver = sorted(terms[order[0]], key=lambda source: -source[0])
+        others = []
+        for i in order[1:]:
+            others.append(sorted(terms[i], key=lambda source: -source[0]))
+        others_best = sum([max([weight for weight, _ in terms[i]]) for i in order[1:]])
+        cites = self._cites
+        seen = set()
+        best = []  # heap of (score, -number)
+        checked = 0
+        for driver_weight, driver_numbers in driver:
+            if len(best) == limit and driver_weight + others_best < best[0][0]:
+                break  # nothing left can do better
+            for number in driver_numbers:
+                if number in seen:
+                    continue
+                seen.add(number)
+                checked += 1
+                if checked & 15 == 0 and time.perf_counter() > deadline:
+                    break
+                if cites[number] is None:
+                    continue
+                score = driver_weight
+                for sources in others:
+                    term_score = 0.0
+                    for weight, numbers in sources:
+                        if _has(numbers, number):
+                            term_score = weight
+                            break
+                    if not term_score:
+                        break
+                    score += term_score
+                else:
+                    entry = (score, -number)
+                    if len(best) < limit:
+                        heapq.heappush(best, entry)
+                    elif entry > best[0]:
+                        heapq.heapreplace(best, entry)
+            else:
+                continue
+            break
+        return [cites[-number] for _, number in sorted(best, reverse=True)]
+
+
+def _has(numbers, number):
+    """Whether a posting list (sorted) contains a citation number"""
+    i = bisect.bisect_left(numbers, number)
+    return i < len(numbers) and numbers[i] == number
+
+
+# Parallel formatting
+#
+# Worker processes are sent flat tuples of plain values rather than Cite objects: they pickle
+# smaller and faster than the Cite/Author/PageRange object graph, and the worker rebuilds each
+# Cite just before rendering it.
+#
+# format_threaded() shares the citations themselves with a pool of threads instead. Rendering
+# only reads a citation, and the threads go straight to Style.render(), skipping the
+# per-citation render cache, which would be written to.
+
+# Cite.__init__() parameters, in order, as they appear in a record
+RECORD_FIELDS = ('title', 'subtitle', 'authors', 'pages', 'city', 'publisher', 'year', 'edition',
+                 'in_title', 'in_subtitle', 'in_authors', 'in_authors_role',
+                 'volume', 'issue', 'date', 'url', 'retrieved_date', 'markup')
+
+# Below this many citations format_many() doesn't start any processes
+PARALLEL_THRESHOLD = 5000
+
+_record_values = operator.attrgetter(*RECORD_FIELDS)
+_AUTHORS_IDX = RECORD_FIELDS.index('authors')
+_PAGES_IDX = RECORD_FIELDS.index('pages')
+_IN_AUTHORS_IDX = RECORD_FIELDS.index('in_authors')
+
+
+def _to_record(cite):
+    record = list(_record_values(cite))
+    if record[_AUTHORS_IDX]:
+        record[_AUTHORS_IDX] = tuple([(a._parsed.name, a._initials) for a in record[_AUTHORS_IDX]])
+    else:
+        record[_AUTHORS_IDX] = ()
+    if record[_IN_AUTHORS_IDX]:
+        record[_IN_AUTHORS_IDX] = tuple([(a._parsed.name, a._initials) for a in record[_IN_AUTHORS_IDX]])
+    else:
+        record[_IN_AUTHORS_IDX] = ()
+    pages = record[_PAGES_IDX]
+    record[_PAGES_IDX] = tuple(zip(pages._begins, pages._ends)) if pages else ()
+    return tuple(record)
+
+
+# Read-only stand-in for a Cite that styles can render: same attributes, none of the validation
+_CiteView = collections.namedtuple('_CiteView', RECORD_FIELDS)
+
+
+def _from_record(record):
+    record = list(record)
+    record[_AUTHORS_IDX] = [Author(*a) for a in record[_AUTHORS_IDX]]
+    record[_IN_AUTHORS_IDX] = [Author(*a) for a in record[_IN_AUTHORS_IDX]]
+    record[_PAGES_IDX] = PageSet(record[_PAGES_IDX])
+    return _CiteView._make(record)
+
+
+def _format_records(style, markup, records):
+    render = STYLES[style].render
+    if markup is None:
+        return [render(cite, cite.markup) for cite in map(_from_record, records)]
+    return [render(cite, markup) for cite in map(_from_record, records)]
+
+
+def format_iter(cites, style=Cite.STYLE_MLA, markup=None, workers=None, chunksize=1000):
+    """Like format_many(), but consumes 'cites' lazily and yields each formatted citation as it
+       is ready, keeping at most two chunks per worker in flight."""
+    _lookup_style(style)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    cites = iter(cites)
+    head = list(itertools.islice(cites, PARALLEL_THRESHOLD))
+    if workers < 2 or len(head) < PARALLEL_THRESHOLD:
+        render = STYLES[style].render
+        for cite in itertools.chain(head, cites):
+            yield render(cite, cite.markup if markup is None else markup)
+        return
+
+    chunks = itertools.chain(
+        (head[i:i + chunksize] for i in range(0, len(head), chunksize)),
+        iter(lambda: list(itertools.islice(cites, chunksize)), []))
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_format_records, style, markup, [_to_record(c) for c in chunk]))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def format_many(cites, style=Cite.STYLE_MLA, markup=None, workers=None, chunksize=1000):
+    """Format many citations in one style, in parallel, returning a list in input order.
+
+       Citations are sent to 'workers' processes (default: one per CPU) 'chunksize' at a time
+       as compact records. With fewer than PARALLEL_THRESHOLD citations, or workers=1, they are
+       rendered in this process instead. markup=None uses each citation's own .markup.
+    """
+    return list(format_iter(cites, style, markup, workers, chunksize))
+
+
+def _format_chunk(render, markup, cites):
+    if markup is None:
+        return [render(cite, cite.markup) for cite in cites]
+    return [render(cite, markup) for cite in cites]
+
+
+def format_threaded(cites, style=Cite.STYLE_MLA, markup=None, workers=None, chunksize=1000):
+    """Like format_many(), but rendering 'chunksize' citations at a time on 'workers' threads
+       (default: one per CPU) of this process. The citations are not copied, so none of them
+       may change until it returns; FrozenCites can't. markup=None uses each one's .markup.
+    """
+    render = _lookup_style(style).render
+    if workers is None:
+        workers = os.cpu_count() or 1
+    cites = list(cites)
+    chunks = [cites[i:i + chunksize] for i in range(0, len(cites), chunksize)]
+    if workers < 2 or len(chunks) < 2:
+        return _format_chunk(render, markup, cites)
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        results = executor.map(functools.partial(_format_chunk, render, markup), chunks)
+        return list(itertools.chain.from_iterable(results))
+
+
+# Formatting server
+#
+# Clients send one JSON object per line and get one back per line, in the same order, so they
+# may pipeline. A request is {"record": {...}} with optional "style", "markup" (a name from
+# MARKUP_NAMES) and "id" (echoed back); the reply is {"id": ..., "citation": "..."} or
+# {"id": ..., "error": "..."}. {"op": "stats"} returns FormatServer.stats().
+#
+# Requests from all connections are parsed as they arrive and queued; one task takes them off
+# the queue in batches of up to batch_size, giving a batch batch_delay seconds to fill unless
+# it is full already, and renders each batch in one go. At most max_in_flight requests are queued or being
+# rendered at once: past that, connections stop being read, and TCP pushes back on clients.
+
+# asyncio (and concurrent.futures, for the parallel formatters) is imported where it's used
+# rather than at the top: importing it takes far longer than the rest of this module, and most
+# programs never start a server.
+
+# How many of the most recent request latencies FormatServer.stats() works from
+LATENCY_SAMPLES = 10000
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FormatServer:
+    """Formats citation records sent over a TCP or Unix socket. See serve()."""
+
+    def __init__(self, style=Cite.STYLE_MLA, markup=Cite.MARKUP_NONE, batch_size=256, batch_delay=0.001,
+                 max_in_flight=1024):
+        _lookup_style(style)
+        self.style = style
+        self.markup = markup
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_in_flight = max_in_flight
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self._in_flight = 0
+        self._rendered = 0
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._queue = None
+        self._slots = None
+        self._server = None
+        self._batcher = None
+        self._connections = set()
+
+    async def start(self, address):
+        """Listen on 'host:port' or 'unix:/path/to/socket'. Returns the asyncio Server."""
+        import asyncio
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        if address.startswith('unix:'):
+            self._server = await asyncio.start_unix_server(self._handle, address[len('unix:'):],
+                                                           limit=IO_BUFFER_SIZE)
+        else:
+            host, _, port = address.rpartition(':')
+            self._server = await asyncio.start_server(self._handle, host or None, int(port), limit=IO_BUFFER_SIZE)
+        return self._server
+
+    async def close(self):
+        """Stop listening and drop open connections"""
+        import asyncio
+        self._server.close()
+        connections = list(self._connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._batcher.cancel()
+
+    def stats(self):
+        """Request, error and batch counts, and latency percentiles in milliseconds over the
+           last LATENCY_SAMPLES requests, from being read to being rendered"""
+        ordered = sorted(self._latencies)
+        stats = {
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch_size': self._rendered / self.batches if self.batches else 0.0,
+            'in_flight': self._in_flight,
+        }
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+            stats['latency_' + name + '_ms'] = _percentile(ordered, fraction) * 1e3 if ordered else None
+        return stats
+
+    def _parse(self, request):
+        """(style, markup, cite) for a request; raises ValueError etc. on bad requests"""
+        if type(request.get('record')) is not dict:
+            raise ValueError('Request has no "record" object')
+        style = request.get('style', self.style)
+        _lookup_style(style)
+        markup = request.get('markup')
+        if markup is None:
+            markup = self.markup
+        else:
+            try:
+                markup = MARKUP_NAMES[markup]
+            except (KeyError, TypeError):
+                raise ValueError("Unsupported markup {!r}. Supported markups: {}".format(
+                    markup, ' '.join(MARKUP_NAMES))) from None
+        return style, markup, Cite.from_dict(request['record'])
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        self._connections.add(asyncio.current_task())
+        replies = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send(replies, writer))
+        try:
+            await self._receive(reader, replies)
+        except asyncio.CancelledError:
+            sender.cancel()
+            raise
+        finally:
+            self._connections.discard(asyncio.current_task())
+        replies.put_nowait(None)
+        await sender
+
+    async def _receive(self, reader, replies):
+        """Queue a reply future per request line, and each valid request for rendering"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                received = time.perf_counter()
+                reply = loop.create_future()
+                replies.put_nowait(reply)
+                self.requests += 1
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    if type(request) is not dict:
+                        raise ValueError('Request must be a JSON object')
+                    request_id = request.get('id')
+                    if request.get('op') == 'stats':
+                        reply.set_result({'id': request_id, 'stats': self.stats()})
+                        continue
+                    style, markup, cite = self._parse(request)
+                except (ValueError, TypeError, AttributeError) as e:
+                    self.errors += 1
+                    reply.set_result({'id': request_id, 'error': str(e)})
+                    continue
+                # Blocks reading this connection while the server is at max_in_flight
+                await self._slots.acquire()
+                self._in_flight += 1
+                self._queue.put_nowait((style, markup, cite, request_id, received, reply))
+        except (ConnectionError, ValueError):
+            # ValueError: a line longer than IO_BUFFER_SIZE
+            pass
+
+    async def _send(self, replies, writer):
+        try:
+            while True:
+                reply = await replies.get()
+                if reply is None:
+                    break
+                writer.write(json.dumps(await reply).encode('utf-8') + b'\n')
+                if replies.empty():
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _batch_loop(self):
+        import asyncio
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            # One sleep per batch rather than a timed wait per request
+            if self.batch_delay and queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            self._render_batch(batch)
+
+    def _render_batch(self, batch):
+        self.batches += 1
+        self._rendered += len(batch)
+        self._in_flight -= len(batch)
+        styles = {}
+        now = time.perf_counter
+        latencies = self._latencies
+        for style, markup, cite, request_id, received, reply in batch:
+            try:
+                render = styles[style]
+            except KeyError:
+                render = styles[style] = STYLES[style].render
+            try:
+                reply.set_result({'id': request_id, 'citation': render(cite, markup)})
+            except Exception as e:
+                self.errors += 1
+                reply.set_result({'id': request_id, 'error': '{}: {}'.format(type(e).__name__, e)})
+            latencies.append(now() - received)
+            self._slots.release()
+
+
+def serve(address, style=Cite.STYLE_MLA, markup=Cite.MARKUP_NONE, batch_size=256, batch_delay=0.001,
+          max_in_flight=1024, ready=None):
+    """Run a FormatServer on 'address' ('host:port' or 'unix:/path') until interrupted.
+       ready(listener), if given, is called with the asyncio Server once it is listening."""
+    async def run():
+        server = FormatServer(style, markup, batch_size, batch_delay, max_in_flight)
+        listener = await server.start(address)
+        if ready is not None:
+            ready(listener)
+        async with listener:
+            await listener.serve_forever()
+    import asyncio
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+# Command line
+
+MARKUP_NAMES = {
+    'none': Cite.MARKUP_NONE,
+    'markdown': Cite.MARKUP_MARKDOWN,
+    'html': Cite.MARKUP_HTML,
+}
+
+IO_BUFFER_SIZE = 1 << 16
+
+
+def _read_cites(lines, input_format, errors, stderr, batch_size=1000):
+    """Generate a Cite for each JSON Lines or CSV record, reporting bad ones to stderr. Records
+       are read batch_size at a time with Cite.from_records()."""
+    if input_format == 'csv':
+        reader = csv.DictReader(lines)
+        records = ((reader.line_num, row) for row in reader)
+    else:
+        records = ((n, line) for n, line in enumerate(lines, 1) if line.strip())
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        linenos = []
+        dicts = []
+        bad = []
+        for lineno, record in batch:
+            if input_format != 'csv':
+                try:
+                    record = json.loads(record)
+                except ValueError as e:
+                    bad.append((lineno, str(e)))
+                    continue
+            linenos.append(lineno)
+            dicts.append(record)
+        report = Cite.from_records(dicts)
+        bad.extend([(linenos[i], message) for i, message in report.errors])
+        for lineno, message in sorted(bad):
+            errors[0] += 1
+            stderr.write('line {}: {}\n'.format(lineno, message))
+        yield from report.cites
+
+
+def _peak_memory():
+    """Peak resident memory of this process or any of its workers, in bytes, or None"""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    parser = argparse.ArgumentParser(prog='python -m cite',
+        description='Format citation records (JSON Lines or CSV, one per line/row) read on stdin, '
+                    'writing one formatted citation per line to stdout.')
+    parser.add_argument('--style', choices=sorted(STYLES), default=Cite.STYLE_MLA)
+    parser.add_argument('--markup', choices=list(MARKUP_NAMES), default='none')
+    parser.add_argument('--input-format', choices=('auto', 'jsonl', 'csv'), default='auto',
+                        help='auto: JSON Lines if the first line starts with {, otherwise CSV with a header row')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes to format in (default 1; 0 means one per CPU)')
+    parser.add_argument('--chunksize', type=int, default=1000, help='records sent to a worker at a time')
+    parser.add_argument('--stats', action='store_true', help='report records per second and peak memory on stderr')
+    server = parser.add_argument_group('server', 'With --serve, format JSON requests from a socket instead of stdin')
+    server.add_argument('--serve', metavar='ADDRESS', help="'host:port' or 'unix:/path/to/socket'")
+    server.add_argument('--batch-size', type=int, default=256, help='most requests rendered together')
+    server.add_argument('--batch-delay', type=float, default=1.0,
+                        help='milliseconds to wait for a batch to fill (default 1)')
+    server.add_argument('--max-in-flight', type=int, default=1024,
+                        help='requests queued or rendering before connections stop being read')
+    args = parser.parse_args(argv)
+
+    if stderr is None:
+        stderr = sys.stderr
+    if args.serve:
+        def ready(listener):
+            for sock in listener.sockets:
+                stderr.write('listening on {}\n'.format(sock.getsockname()))
+            stderr.flush()
+        serve(args.serve, args.style, MARKUP_NAMES[args.markup], args.batch_size, args.batch_delay / 1e3,
+              args.max_in_flight, ready)
+        return 0
+
+    if stdin is None:
+        stdin = open(sys.stdin.fileno(), encoding='utf-8', newline='', buffering=IO_BUFFER_SIZE, closefd=False)
+    if stdout is None:
+        stdout = open(sys.stdout.fileno(), 'w', encoding='utf-8', buffering=IO_BUFFER_SIZE, closefd=False)
+
+    start = time.perf_counter()
+    first = stdin.readline()
+    input_format = args.input_format
+    if input_format == 'auto':
+        input_format = 'jsonl' if first.lstrip().startswith('{') else 'csv'
+    errors = [0]
+    cites = _read_cites(itertools.chain([first], stdin), input_format, errors, stderr)
+
+    count = 0
+    write = stdout.write
+    for line in format_iter(cites, args.style, MARKUP_NAMES[args.markup], args.workers or None, args.chunksize):
+        write(line)
+        write('\n')
+        count += 1
+    stdout.flush()
+
+    if args.stats:
+        elapsed = time.perf_counter() - start
+        peak = _peak_memory()
+        stderr.write('{} records in {:.2f}s ({:.0f} records/s), {} bad, peak memory {}\n'.format(
+            count, elapsed, count / elapsed if elapsed else 0, errors[0],
+            '{:.1f} MiB'.format(peak / (1 << 20)) if peak is not None else 'unknown'))
+    return 1 if errors[0] else 0
+
 
+if __name__ == '__main__':
+    sys.exit(main())
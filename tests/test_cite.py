@@ -1,5 +1,21 @@
 import unittest
-from cite import Cite, Author, PageRange
+import asyncio
+import datetime
+import io
+import json
+import mmap
+import pickle
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from cite import Cite, Author, PageRange, render_bibliography, Style, Field, Italic, Quoted, If, MLA, APA, read_bibtex, write_bibtex
+from cite import render_cache_info, render_cache_clear, author_cache_info, format_many, Profiler, PageSet
+from cite import DuplicateIndex, duplicate_key, CitationRegistry, FormatServer, CiteStore
+from cite import Snapshot, write_snapshot, SearchIndex, LiveBibliography, read_mla, read_apa
+from cite import FrozenCite, FrozenAuthor, format_threaded
+import cite as cite_module
 
 class TestAuthor(unittest.TestCase):
     def test_author(self):
@@ -12,7 +28,136 @@ class TestAuthor(unittest.TestCase):
         a.initials = True
         self.assertEqual(str(a), 'J. K. Brown')
         self.assertEqual(list(reversed(a)), ['Brown', 'J.', 'K.'])
-        
+
+    def test_iteration(self):
+        a = Author('James Kitchener Brown')
+        self.assertEqual(list(a), ['James', 'Kitchener', 'Brown'])
+        a.initials = True
+        self.assertEqual(list(a), ['J.', 'K.', 'Brown'])
+        self.assertEqual(str(reversed(a)), 'Brown, J. K.')
+        a = Author('Plato', initials=True)
+        self.assertEqual(str(a), 'Plato')
+        self.assertEqual(str(reversed(a)), 'Plato')
+        self.assertEqual(list(Author('')), [])
+
+    def test_parse_once(self):
+        name = ''.join(['Cynthia', ' ', 'Davis'])
+        a = Author(name)
+        b = Author('Cynthia Davis')
+        self.assertIs(a._parsed, b._parsed)
+        self.assertEqual((a.given_names, a.family_name), (('Cynthia',), 'Davis'))
+        hits = author_cache_info().hits
+        b.name = 'Cynthia Davis'
+        self.assertEqual(author_cache_info().hits, hits)
+        b.name = 'Cynthia Jones'
+        self.assertEqual(b.family_name, 'Jones')
+        self.assertEqual(a.family_name, 'Davis')
+        with self.assertRaises(TypeError):
+            Author(None)
+
+
+class TestPageRange(unittest.TestCase):
+    def test_page_range(self):
+        pr = PageRange('129 - 132')
+        self.assertEqual((pr.begin, pr.end), (129, 132))
+        self.assertEqual(len(pr), 4)
+        self.assertEqual(list(pr), [129, 130, 131, 132])
+        self.assertIn(130, pr)
+        self.assertNotIn(133, pr)
+        self.assertEqual(str(PageRange('96')), '96')
+        self.assertEqual(repr(PageRange(96)), 'PageRange(96)')
+        with self.assertRaises(AttributeError):
+            pr.begin = 1
+
+    def test_ordering(self):
+        self.assertGreater(PageRange(20, 25), PageRange(10, 30))
+        self.assertGreaterEqual(PageRange(20), 20)
+        self.assertEqual(sorted([PageRange(30), PageRange(5, 9), 12]), [5, 12, 30])
+        self.assertEqual(len({PageRange(5), PageRange(5, 9), 5}), 1)
+
+
+class TestPageSet(unittest.TestCase):
+    def test_merge(self):
+        pages = PageSet('10-20, 15-25, 26')
+        self.assertEqual(str(pages), '10-26')
+        pages.update([PageRange(40, 42), 3, '28--30'])
+        self.assertEqual(str(pages), '3, 10-26, 28-30, 40-42')
+        pages.add(27)
+        pages.add('1-50')
+        self.assertEqual(pages, [PageRange(1, 50)])
+        self.assertEqual(str(PageSet('5,,  7 – 9 ,')), '5, 7-9')
+        self.assertRaises(ValueError, PageSet, '5, xii')
+
+    def test_queries(self):
+        pages = PageSet.parse('1-5, 9, 20-30')
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[1], PageRange(9))
+        self.assertEqual([(p.begin, p.end) for p in pages], [(1, 5), (9, 9), (20, 30)])
+        self.assertIn(4, pages)
+        self.assertNotIn(6, pages)
+        self.assertNotIn(0, pages)
+        self.assertIn(PageRange(21, 30), pages)
+        self.assertNotIn('25-31', pages)
+        self.assertIn(PageSet('2, 22-23'), pages)
+        union = pages | PageSet('6-8, 31')
+        self.assertEqual(str(union), '1-9, 20-31')
+        self.assertEqual(str(pages), '1-5, 9, 20-30')
+        self.assertEqual(pickle.loads(pickle.dumps(pages)), pages)
+
+    def test_cite_pages(self):
+        cite = Cite('Index', pages=['10-20', 15, PageRange(21, 25), '40, 26'])
+        self.assertEqual(cite.to_mla(), 'Index. pp. 10-26, 40.')
+        cite.pages.add(27)
+        self.assertEqual(cite.to_mla(), 'Index. pp. 10-27, 40.')
+        other = Cite('Other', pages=cite.pages)
+        other.pages.clear()
+        self.assertEqual(str(cite.pages), '10-27, 40')
+
+    def test_item_assignment(self):
+        cite = Cite('Index', pages='3, 10-20, 40')
+        mla = cite.to_mla()
+        cite.pages[0] = PageRange(5)
+        self.assertEqual(str(cite.pages), '5, 10-20, 40')
+        self.assertNotEqual(cite.to_mla(), mla)
+        cite.pages[2] = '21-25'
+        self.assertEqual(str(cite.pages), '5, 10-25')
+        cite.pages[:1] = [1, 2]
+        self.assertEqual(str(cite.pages), '1-2, 10-25')
+        with self.assertRaises(ValueError):
+            cite.pages[0] = 'xii'
+        self.assertEqual(str(cite.pages), '1-2, 10-25')
+        with self.assertRaises(TypeError):
+            cite.freeze().pages[0] = 1
+
+    def test_no_pages(self):
+        cite = Cite('Index')
+        self.assertIs(cite.pages._begins, Cite('Other').pages._begins)
+        self.assertEqual(cite.pages, [])
+        with self.assertRaises(IndexError):
+            del cite.pages[0]
+        cite.pages.append('4-6')
+        cite.pages.add(2)
+        self.assertEqual(cite.pages, PageSet('2, 4-6'))
+        self.assertEqual(cite.to_mla(), 'Index. pp. 2, 4-6.')
+        del cite.pages[:]
+        self.assertEqual(cite.pages, PageSet())
+        self.assertEqual(Cite('Other').pages, [])
+
+
+class TestSlots(unittest.TestCase):
+    def test_no_instance_dict(self):
+        for obj in (Cite('Title'), Author('James Brown'), PageRange(1, 2)):
+            self.assertFalse(hasattr(obj, '__dict__'))
+
+    def test_whitelist_and_coercion(self):
+        cite = Cite('Title', authors='James Brown', pages='1-2')
+        with self.assertRaises(AttributeError):
+            cite.isbn = '123'
+        self.assertEqual(cite.authors[0].name, 'James Brown')
+        self.assertEqual(cite.pages, [PageRange(1, 2)])
+        cite.in_authors = None
+        self.assertEqual(cite.in_authors, [])
+
 
 # https://guides.lib.uw.edu/c.php?g=341448&p=4076094
 class TestToMLA(unittest.TestCase):
@@ -100,6 +245,894 @@ class TestToAPA(unittest.TestCase):
                     url='https://doi.org/12345.6789/ws0001234', markup=Cite.MARKUP_MARKDOWN)
         self.assertEqual(cite.to_apa(), 'Livingston, D. F. (2011). Wigwams in Timbuktu: Dispersion data and comparisons with previous work. *Wigwam Studies, 10*(2), 15-22. https://doi.org/12345.6789/ws0001234')
 
+    def test_leaves_authors_alone(self):
+        cite = Cite('Wigwams', authors=['David Frederick Livingston', 'Bob Tweedle'], year=2011, publisher='Carne Press')
+        mla = cite.to_mla()
+        self.assertEqual(cite.to_apa(), 'Livingston, D. F., & Tweedle, B. (2011). Wigwams. Carne Press.')
+        self.assertFalse(cite.authors[0].initials)
+        self.assertEqual(cite.to_mla(), mla)
+
+
+class TestFrozenCite(unittest.TestCase):
+    def test_freeze(self):
+        cite = Cite('Wigwams', authors=['David Livingston', Author('Bob Tweedle', initials=True)], pages='15-22, 30',
+                    in_title='Wigwam Studies', volume=10, year=2011, markup=Cite.MARKUP_HTML)
+        frozen = cite.freeze()
+        self.assertEqual(frozen.to_mla(), cite.to_mla())
+        self.assertEqual(frozen.to_apa(), cite.to_apa())
+        self.assertEqual(frozen.to_bibtex(), cite.to_bibtex())
+        self.assertEqual(frozen, FrozenCite('Wigwams', authors=['David Livingston', Author('Bob Tweedle', initials=True)],
+                                            pages='15-22, 30', in_title='Wigwam Studies', volume=10, year=2011,
+                                            markup=Cite.MARKUP_HTML))
+        self.assertEqual({frozen: 1}[cite.freeze()], 1)
+        self.assertNotEqual(frozen, frozen._replace(year=2012))
+        self.assertEqual(frozen._replace(pages='1-2').pages, PageSet('1-2'))
+        self.assertEqual(pickle.loads(pickle.dumps(frozen)), frozen)
+
+        with self.assertRaises(AttributeError):
+            frozen.title = 'Igloos'
+        with self.assertRaises(AttributeError):
+            frozen.authors[0].initials = True
+        with self.assertRaises(TypeError):
+            frozen.pages.add(40)
+        self.assertEqual(FrozenAuthor('Bob Tweedle', True), frozen.authors[1])
+
+        copy = frozen.to_cite()
+        self.assertIs(type(copy.authors[0]), Author)
+        self.assertEqual(copy.to_mla(), cite.to_mla())
+        copy.pages.add(40)
+        self.assertEqual(str(frozen.pages), '15-22, 30')
+
+
+class TestFromFormatted(unittest.TestCase):
+    # The expected strings of TestToMLA and TestToAPA
+    MLA = [
+        'The Bible (Authorized Version).',
+        'James, King. The Bible (Authorized Version).',
+        'James, King. *The Bible (Authorized Version).*',
+        'James, King. <em>The Bible (Authorized Version).</em>',
+        'James, King. <em>The Bible (Authorized Version).</em> London.',
+        'James, King. <em>The Bible (Authorized Version).</em> London, 1611.',
+        'James, King. <em>The Bible: Authorized Version.</em> London, 1611.',
+        'Davis, Cynthia, and Brown, Jack. Landscape Gardening. Wiley & Sons, 1994.',
+        'Davis, Cynthia, and Brown, Jack. Landscape Gardening. Wiley & Sons.',
+        'Davis, Cynthia, and Brown, Jack. Landscape Gardening. 1994.',
+        'Davis, Cynthia, and Brown, Jack. *Landscape Gardening.* 1994.',
+        'Davis, Cynthia, and Brown, Jack. <em>Landscape Gardening.</em> Wiley & Sons, 1994.',
+        'Shakespeare, William, and Marlowe, Christopher. 17th Century Plays and Playwrights. 98th ed. London: The Globe Theatre Company, 1620.',
+        'Smith, Bob, Pearson, Sheila, and McDonald, James. "Incan Mythology." All the Worlds Mythology. Neil Tavistock. Macmillan, 2002.',
+        'Smith, Bob, Pearson, Sheila, and McDonald, James. &ldquo;Incan Mythology.&rdquo; <em>All the Worlds Mythology.</em> Neil Tavistock. Macmillan, 2002. pp. 25-31.',
+        'Smith, Bob, Pearson, Sheila, and McDonald, James. "Incan Mythology: New Perspectives." *All the Worlds Mythology: Historical, Religious, and Ethnographical.* Edited by Neil Tavistock. Macmillan, 2002. pp. 10-20, 25-40, 96, 129-132.',
+    ]
+    APA = [
+        'Lecter, H. (1989). How to eat friends and barbecue people. Carne Press.',
+        'Lecter, H. (1989). <em>How to eat friends and barbecue people.</em> Carne Press.',
+        'Fredrickson, J. F., Tweedle, B., & Lopez, F. M. J. (2000). *Chainsaw Juggling for Beginners.* Denmark: Inadvisable Press.',
+        'Livingston, D. F. (2011). Wigwams in Timbuktu: Dispersion data and comparisons with previous work. *Wigwam Studies, 10*(2), 15-22. https://doi.org/12345.6789/ws0001234',
+    ]
+
+    def test_round_trip(self):
+        for text in self.MLA:
+            self.assertEqual(Cite.from_mla(text).to_mla(), text)
+        for text in self.APA:
+            self.assertEqual(Cite.from_apa(text).to_apa(), text)
+            plain = text.replace('*', '').replace('<em>', '').replace('</em>', '')
+            self.assertEqual(Cite.from_apa(plain, Cite.MARKUP_NONE).to_apa(), plain)
+
+    def test_fields(self):
+        cite = Cite.from_mla(self.MLA[-1])
+        self.assertEqual(cite.markup, Cite.MARKUP_MARKDOWN)
+        self.assertEqual([a.name for a in cite.authors], ['Bob Smith', 'Sheila Pearson', 'James McDonald'])
+        self.assertEqual((cite.title, cite.subtitle), ('Incan Mythology', 'New Perspectives'))
+        self.assertEqual((cite.in_title, cite.in_subtitle), ('All the Worlds Mythology', 'Historical, Religious, and Ethnographical'))
+        self.assertEqual((cite.in_authors_role, cite.in_authors[0].name), ('Edited by', 'Neil Tavistock'))
+        self.assertEqual((cite.publisher, cite.year, str(cite.pages)), ('Macmillan', 2002, '10-20, 25-40, 96, 129-132'))
+        cite = Cite.from_apa(self.APA[-1].replace('*', ''))
+        self.assertEqual((cite.in_title, cite.volume, cite.issue, str(cite.pages)), ('Wigwam Studies', 10, 2, '15-22'))
+        self.assertEqual(cite.url, 'https://doi.org/12345.6789/ws0001234')
+        self.assertEqual([a.name for a in Cite.from_mla('Plato, Adams, Ann Marie, and Smith, Bob. *Dialogues.*').authors],
+                         ['Plato', 'Ann Marie Adams', 'Bob Smith'])
+        with self.assertRaises(ValueError):
+            Cite.from_apa('Lecter, H. (1989). <em>Unclosed.')
+
+    def test_many_authors(self):
+        # Reading a citation takes time linear in its length, however many ways its commas could be split
+        cite = Cite('Incan Mythology', authors=['Author{0} Name{0}'.format(i) for i in range(30)], year=2002)
+        start = time.perf_counter()
+        self.assertEqual(Cite.from_mla(cite.to_mla()).to_mla(), cite.to_mla())
+        with self.assertRaises(ValueError):
+            Cite.from_mla('a, ' * 30 + 'x')
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    def test_abbreviated_journal(self):
+        for markup in (Cite.MARKUP_NONE, Cite.MARKUP_MARKDOWN, Cite.MARKUP_HTML):
+            for journal in ('J. Appl Phys', 'Proc. Natl Acad Sci', 'J. Appl. Phys.'):
+                for volume in (None, 10):
+                    cite = Cite('Thin films', authors='Ann Lee', in_title=journal, volume=volume, pages='15-22',
+                                year=2011, markup=markup)
+                    text = cite.to_apa()
+                    copy = Cite.from_apa(text)
+                    self.assertEqual(copy.to_apa(), text)
+                    # Plain text can't say where the title ends and the journal starts, but italics can
+                    if markup != Cite.MARKUP_NONE:
+                        self.assertEqual((copy.title, copy.in_title, copy.volume), ('Thin films', journal, volume))
+
+    def test_read(self):
+        cites = [Cite.from_mla(text) for text in self.MLA]
+        for markup in (Cite.MARKUP_NONE, Cite.MARKUP_MARKDOWN, Cite.MARKUP_HTML):
+            for style, read in ((Cite.STYLE_MLA, read_mla), (Cite.STYLE_APA, read_apa)):
+                text = render_bibliography(cites, style, markup)
+                self.assertEqual(render_bibliography(read(io.StringIO(text)), style, markup), text)
+        with self.assertRaisesRegex(ValueError, 'Line 3: '):
+            list(read_apa(['Lecter, H. (1989). *A.*', '', 'Lecter, H. (1989). *A.']))
+        errors = []
+        lines = ['Lecter, H. (1989). *A.*', 'Lecter, H. (1989). *A.', 'not a citation', 'Lecter, H. (1990). *B.*']
+        self.assertEqual([c.year for c in read_apa(lines, errors=errors)], [1989, 1990])
+        self.assertEqual([number for number, _ in errors], [2, 3])
+        self.assertIn('Not an APA citation', errors[0][1])
+
+
+class TestStyle(unittest.TestCase):
+    def test_template(self):
+        style = Style('test',
+            Italic(Field('title')),
+            If('year', ' (', Field('year', str), ')', otherwise=' (n.d.)'),
+            If('city and publisher', ' ', Quoted(Field('city'), ': ', Field('publisher'))))
+        self.assertEqual(style.fields, ('title', 'year', 'city', 'publisher'))
+        cite = Cite('Title', year=2000, city='London', publisher='Pub')
+        self.assertEqual(style.render(cite, Cite.MARKUP_HTML), '<em>Title</em> (2000) &ldquo;London: Pub&rdquo;')
+        cite.year = None
+        cite.city = None
+        self.assertEqual(style.render(cite, Cite.MARKUP_MARKDOWN), '*Title* (n.d.)')
+        self.assertEqual(len(style._compiled), 2)
+        self.assertEqual(style.render(Cite('Other', publisher='Pub'), Cite.MARKUP_MARKDOWN), '*Other* (n.d.)')
+        self.assertEqual(len(style._compiled), 2)
+
+    def test_unsupported_field(self):
+        with self.assertRaises(AttributeError):
+            Field('isbn')
+        with self.assertRaises(AttributeError):
+            If('city or isbn', 'x')
+
+    def test_mla_in_authors(self):
+        cite = Cite('Incan Mythology', in_title='All the Worlds Mythology', in_authors=['Neil Tavistock', 'Ann Lee'],
+                    in_authors_role='Edited by')
+        self.assertEqual(MLA.render(cite, Cite.MARKUP_NONE),
+            '"Incan Mythology." All the Worlds Mythology. Edited by Neil Tavistock and Ann Lee.')
+        cite.in_authors.append(Author('Bo Ng'))
+        self.assertEqual(cite.to_mla(),
+            '"Incan Mythology." All the Worlds Mythology. Edited by Neil Tavistock, Ann Lee, and Bo Ng.')
+
+
+class TestBibtex(unittest.TestCase):
+    def make_cites(self):
+        return [
+            Cite(title='Wigwams in Timbuktu', subtitle='Dispersion data & comparisons',
+                 authors=Author('David Frederick Livingston'), in_title='Wigwam Studies',
+                 volume=10, issue=2, pages=[PageRange(15, 22), 30], year=2011,
+                 url='https://doi.org/12345.6789/ws0001234'),
+            Cite(title='Incan Mythology', authors=['Bob Smith', 'Sheila Pearson'], publisher='Macmillan', year=2002,
+                 in_title='All the Worlds Mythology', in_authors='Neil Tavistock', city='London'),
+            Cite('Landscape Gardening', authors=['Cynthia Davis', 'Jack Brown'], publisher='Wiley & Sons', year=1994),
+        ]
+
+    def test_to_bibtex(self):
+        self.assertEqual(self.make_cites()[0].to_bibtex(),
+            '@article{livingston2011,\n'
+            '  author = {Livingston, David Frederick},\n'
+            '  title = {Wigwams in Timbuktu: Dispersion data \\& comparisons},\n'
+            '  journal = {Wigwam Studies},\n'
+            '  year = {2011},\n'
+            '  volume = {10},\n'
+            '  number = {2},\n'
+            '  pages = {15--22, 30},\n'
+            '  url = {https://doi.org/12345.6789/ws0001234},\n'
+            '}\n')
+        self.assertNotIn('url', self.make_cites()[0].to_bibtex(strict=True))
+
+    def test_round_trip(self):
+        cites = self.make_cites()
+        out = io.StringIO()
+        write_bibtex(cites + cites[-1:], out)
+        self.assertIn('@book{davis1994a,', out.getvalue())
+        for chunk_size in (7, 1 << 16):
+            parsed = list(read_bibtex(io.StringIO(out.getvalue()), chunk_size=chunk_size))
+            self.assertEqual([c.to_mla() for c in parsed], [c.to_mla() for c in cites + cites[-1:]])
+            self.assertEqual(parsed[0].pages, [PageRange(15, 22), PageRange(30)])
+            self.assertEqual(parsed[0].volume, 10)
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as f:
+            f.write('@string{ pub = "Wiley" }\n% a comment with an @ sign\n'
+                    '@Book(key, title = "Sch{\\"o}ne " # {G{\\"a}rten}, publisher = pub # { \\& Sons},\n'
+                    '      author = "Davis, Cynthia and Jack Brown", year = 1994, month = jan)\n'.encode('utf-8'))
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                cites = list(read_bibtex(m, chunk_size=5))
+        self.assertEqual(len(cites), 1)
+        self.assertEqual(cites[0].to_mla(), 'Davis, Cynthia, and Brown, Jack. Schöne Gärten. Wiley & Sons, 1994.')
+
+    def test_parenthesis_in_quoted_value(self):
+        text = ('@book(k, title = "Gardening (Second Thoughts)", publisher = "Wiley", year = 1994)\n'
+                '@book(j, title = {Orchards (Revised)}, year = 1995)\n')
+        for chunk_size in (3, 1 << 16):
+            cites = list(read_bibtex(io.StringIO(text), chunk_size=chunk_size))
+            self.assertEqual([c.to_mla() for c in cites], ['Gardening (Second Thoughts). Wiley, 1994.',
+                                                           'Orchards (Revised). 1995.'])
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        render_cache_clear()
+
+    def test_hits_and_misses(self):
+        cite = Cite('Landscape Gardening', authors=['Cynthia Davis', 'Jack Brown'], year=1994)
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia, and Brown, Jack. Landscape Gardening. 1994.')
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia, and Brown, Jack. Landscape Gardening. 1994.')
+        self.assertEqual(render_cache_info(), (1, 1))
+        cite.markup = Cite.MARKUP_MARKDOWN
+        cite.to_mla()
+        cite.markup = Cite.MARKUP_NONE
+        cite.to_mla()
+        self.assertEqual(render_cache_info(), (2, 2))
+
+    def test_invalidation(self):
+        author = Author('Cynthia Davis')
+        cite = Cite('Landscape Gardening', authors=author, year=1994)
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia. Landscape Gardening. 1994.')
+        cite.year = 1995
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia. Landscape Gardening. 1995.')
+        cite.authors.append('Jack Brown')
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia, and Brown, Jack. Landscape Gardening. 1995.')
+        cite.pages += ['5-6']
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia, and Brown, Jack. Landscape Gardening. 1995. pp. 5-6.')
+        del cite.pages[0]
+        author.name = 'Cynthia Jones'
+        self.assertEqual(cite.to_mla(), 'Jones, Cynthia, and Brown, Jack. Landscape Gardening. 1995.')
+        author.initials = True
+        self.assertEqual(cite.to_mla(), 'Jones, C., and Brown, Jack. Landscape Gardening. 1995.')
+        self.assertEqual(render_cache_info(), (0, 6))
+
+    def test_clear(self):
+        cite = Cite('Gardening', pages=5)
+        self.assertEqual(cite.to_mla(), 'Gardening. p. 5.')
+        old = Cite.PAGE_ABBREV
+        Cite.PAGE_ABBREV = 'pg'
+        try:
+            render_cache_clear()
+            self.assertEqual(cite.to_mla(), 'Gardening. pg. 5.')
+        finally:
+            Cite.PAGE_ABBREV = old
+            render_cache_clear()
+
+    def test_pickle(self):
+        cite = Cite('Gardening', authors='Cynthia Davis')
+        copy = pickle.loads(pickle.dumps(cite))
+        copy.authors.append('Jack Brown')
+        self.assertEqual(copy.to_mla(), 'Davis, Cynthia, and Brown, Jack. Gardening.')
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia. Gardening.')
+
+
+class TestProfiler(unittest.TestCase):
+    def test_stages(self):
+        cites = [Cite('Landscape Gardening', authors=['Cynthia Davis', 'Jack Brown'], year=1994, pages='5-6'),
+                 Cite('Gardening', year=1995)]
+        expected = [cite.to_mla() for cite in cites]
+        render_cache_clear()
+        with Profiler() as profiler:
+            self.assertEqual([cite.to_mla() for cite in cites], expected)
+            cites[0].to_mla()  # cached, not rendered again
+        stats = profiler.snapshot()['mla']
+        self.assertEqual(stats['total']['calls'], 2)
+        self.assertEqual(stats['compile']['calls'], 2)
+        self.assertEqual(stats['field:authors']['calls'], 1)
+        self.assertEqual(stats['field:pages']['calls'], 1)
+        self.assertEqual(stats['field:year']['calls'], 2)
+        self.assertIn('field:authors', profiler.table())
+        self.assertEqual(json.loads(profiler.to_json())['mla']['render']['calls'], 2)
+
+        cites[1].year = 1996
+        cites[1].to_mla()
+        self.assertEqual(profiler.snapshot()['mla']['total']['calls'], 2)
+
+    def test_one_at_a_time(self):
+        with Profiler():
+            self.assertRaises(RuntimeError, Profiler().start)
+        Profiler().start()
+        self.assertIsNotNone(cite_module._profiler)
+        cite_module._profiler.stop()
+        self.assertIsNone(cite_module._profiler)
+
+
+class TestDuplicateIndex(unittest.TestCase):
+    def test_clusters(self):
+        cites = [Cite('Incan Mythology', subtitle='New Perspectives', authors=['Bob Smith', 'Sheila Pearson'], year=2002),
+                 Cite('Landscape Gardening', authors='Cynthia Davis', year=1994),
+                 Cite('INCAN MYTHOLOGY: New Perspectives', authors=['B. Smith', 'Sheila Pearson'], year=2002),
+                 Cite('Landscape Painting', authors='Cynthia Davis', year=1994),
+                 Cite('Incan Mythologie: new perspectives', authors=['Bob Smith', 'Sheila Pearson'],
+                      date=datetime.date(2002, 5, 1)),
+                 Cite('Landscape Gardening', authors='Cynthia Davis')]
+        index = DuplicateIndex()
+        self.assertEqual(index.add(cites[0]), [])
+        index.add(cites[1])
+        self.assertEqual(index.add(cites[2]), [(cites[0], 1.0)])
+        for cite in cites[3:]:
+            index.add(cite)
+        self.assertEqual(len(index), 6)
+        clusters = index.clusters()
+        self.assertEqual([cluster.cites for cluster in clusters], [[cites[0], cites[2], cites[4]], [cites[1], cites[5]]])
+        self.assertLess(clusters[0].score, 1.0)
+        self.assertGreaterEqual(clusters[0].score, index.threshold)
+        self.assertEqual(clusters[1].score, 1.0)
+        self.assertLess(index.similarity(cites[1], cites[3]), index.threshold)
+
+    def test_key(self):
+        key = duplicate_key(Cite('Éléments', subtitle='A  History!', authors='Chloé Müller', year=1999))
+        self.assertEqual(key, (('elements', 'a', 'history'), ('muller',), 1999))
+
+    def test_block_size(self):
+        cites = [Cite('Untitled', year=2000) for _ in range(5)]
+        index = DuplicateIndex(cites, max_block_size=2)
+        # Past max_block_size only exact duplicates are still found
+        self.assertEqual(len(index.clusters()[0].cites), 5)
+        near = Cite('Untitled', authors='Jo Smith', year=2000)
+        self.assertEqual(index.similarity(cites[0], near), 1.0)
+        self.assertEqual(index.add(near), [])
+
+    def test_short_title_missing_year(self):
+        # No title block in common, and only one copy has a year
+        original = Cite('Incan Mythology', authors=['Bob Smith'], year=2002)
+        copy = Cite('Incan Mythologie', authors=['B. Smith'])
+        index = DuplicateIndex([original])
+        self.assertGreaterEqual(index.similarity(original, copy), index.threshold)
+        self.assertEqual([cite for cite, score in index.add(copy)], [original])
+
+
+class TestInText(unittest.TestCase):
+    def test_single(self):
+        cite = Cite(title='Incan Mythology', authors=['Bob Smith', 'Sheila Pearson'], publisher='Macmillan', year=2002)
+        self.assertEqual(cite.to_apa_in_text(), '(Smith & Pearson, 2002)')
+        self.assertEqual(cite.to_apa_in_text(pages='25-27'), '(Smith & Pearson, 2002, pp. 25-27)')
+        self.assertEqual(cite.to_mla_in_text(25), '(Smith and Pearson 25)')
+        cite.authors.append('James McDonald')
+        self.assertEqual(cite.to_apa_in_text(25), '(Smith et al., 2002, p. 25)')
+        self.assertEqual(cite.to_mla_in_text(), '(Smith et al.)')
+        self.assertEqual(CitationRegistry(et_al=4).cite(cite), '(Smith, Pearson, & McDonald, 2002)')
+        anonymous = Cite('Gardening', in_title='Garden Monthly', markup=Cite.MARKUP_HTML)
+        self.assertEqual(anonymous.to_apa_in_text(), '(&ldquo;Gardening&rdquo;, n.d.)')
+
+    def test_apa_disambiguation(self):
+        zebras = Cite('Zebra Studies', authors='Bob Smith', year=2002)
+        apples = Cite('Apple Studies', authors='Bob Smith', year=2002)
+        other = Cite('Apple Studies', authors='Bob Smith', year=2003)
+        registry = CitationRegistry()
+        self.assertEqual(registry.add(zebras), [zebras])
+        self.assertEqual(registry.cite(zebras), '(Smith, 2002)')
+        self.assertEqual(registry.add(other), [other])
+        self.assertEqual(registry.add(apples), [apples, zebras])
+        self.assertEqual(registry.add(apples), [])
+        self.assertEqual(registry.cite(apples, 5), '(Smith, 2002a, p. 5)')
+        self.assertEqual(registry.label(zebras), 'Smith, 2002b')
+        self.assertEqual(registry.label(other), 'Smith, 2003')
+        mangoes = Cite('Mango Studies', authors='Bob Smith', year=2002)
+        self.assertEqual(registry.add(mangoes), [mangoes, zebras])
+        self.assertEqual(registry.label(zebras), 'Smith, 2002c')
+        self.assertEqual(len(registry), 4)
+        undated = [Cite('B', authors='Bob Smith'), Cite('A', authors='Bob Smith')]
+        self.assertEqual([registry.label(c) for c in undated], ['Smith, n.d.', 'Smith, n.d.-a'])
+        self.assertEqual(registry.label(undated[0]), 'Smith, n.d.-b')
+
+    def test_apa_letters_follow_reference_list(self):
+        # Leading articles are ignored in the reference list, so the letters ignore them too
+        banana = Cite('Banana', authors='Bob Smith', year=2002)
+        apple = Cite('The Apple', authors='Bob Smith', year=2002)
+        registry = CitationRegistry()
+        registry.add(banana)
+        registry.add(apple)
+        self.assertEqual([registry.label(apple), registry.label(banana)], ['Smith, 2002a', 'Smith, 2002b'])
+        self.assertEqual(render_bibliography([banana, apple], Cite.STYLE_APA).splitlines()[0], apple.to_apa())
+
+    def test_mla_disambiguation(self):
+        zebras = Cite('The Zebra Studies of Southern Africa', authors='Bob Smith', year=2002)
+        apples = Cite('Apple Studies: A History', authors='Bob Smith', year=1990, in_title='Fruit')
+        registry = CitationRegistry(Cite.STYLE_MLA, Cite.MARKUP_MARKDOWN)
+        self.assertEqual(registry.cite(zebras, 25), '(Smith 25)')
+        self.assertEqual(registry.add(apples), [apples, zebras])
+        self.assertEqual(registry.cite(zebras, 25), '(Smith, *Zebra Studies* 25)')
+        self.assertEqual(registry.cite(apples), '(Smith, "Apple Studies")')
+        anonymous = [Cite('A Garden in Winter'), Cite('A Garden for All Seasons')]
+        self.assertEqual(registry.cite(anonymous[0], 3), '(*Garden* 3)')
+        self.assertEqual(registry.cite(anonymous[1]), '(*A Garden for All Seasons*)')
+        self.assertEqual(registry.cite(anonymous[0]), '(*A Garden in Winter*)')
+        self.assertRaises(ValueError, CitationRegistry, 'chicago')
+
+
+class TestCiteStore(unittest.TestCase):
+    def setUp(self):
+        self.store = CiteStore()
+        self.cites = [
+            Cite(title='Wigwams in Timbuktu', subtitle='Dispersion data & comparisons',
+                 authors=Author('David Frederick Livingston'), in_title='Wigwam Studies',
+                 volume=10, issue=2, pages=[PageRange(15, 22), 30], year=2011,
+                 url='https://doi.org/12345.6789/ws0001234', retrieved_date=datetime.date(2020, 1, 31)),
+            Cite(title='Incan Mythology', authors=['Bob Smith', 'Sheila Pearson'], publisher='Macmillan', year=2002,
+                 in_title='All the Worlds Mythology', in_authors='Neil Tavistock', city='London'),
+            Cite('Éléments de jardinage', authors=['Chloé Müller'], date=datetime.date(1994, 5, 1),
+                 markup=Cite.MARKUP_HTML),
+        ]
+        self.ids = self.store.add_many(self.cites, batch_size=2)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.store), 3)
+        for cite_id, cite in zip(self.ids, self.cites):
+            stored = self.store.get(cite_id)
+            self.assertEqual((stored.to_mla(), stored.markup, stored.pages), (cite.to_mla(), cite.markup, cite.pages))
+        self.assertEqual(self.store.get(self.ids[1]).in_authors[0].name, 'Neil Tavistock')
+        self.assertRaises(KeyError, self.store.get, 99)
+
+    def test_query(self):
+        def ids(**query):
+            return [cite_id for cite_id, _ in self.store.query(**query)]
+        self.assertEqual(ids(author='SMITH'), [self.ids[1]])
+        self.assertEqual(ids(author='muller'), [self.ids[2]])
+        self.assertEqual(ids(author='Tavistock'), [])
+        self.assertEqual(ids(year=(2000, 2020)), self.ids[:2])
+        self.assertEqual(ids(year=2002, title='incan myth'), [self.ids[1]])
+        self.assertEqual(ids(title='elements'), [self.ids[2]])
+        self.assertEqual(ids(in_title='wigwam studies'), [self.ids[0]])
+        self.assertEqual(ids(limit=2), self.ids[:2])
+
+    def test_render_cache(self):
+        expected = [(cite_id, MLA.render(cite, Cite.MARKUP_NONE)) for cite_id, cite in zip(self.ids, self.cites)]
+        self.assertEqual(list(self.store.render()), expected)
+        count = 'SELECT count(*) FROM renders'
+        self.assertEqual(self.store._db.execute(count).fetchone()[0], 3)
+        self.assertEqual(list(self.store.render()), expected)
+
+        cite = self.store.get(self.ids[1])
+        cite.year = 2003
+        self.store.update(self.ids[1], cite)
+        self.assertEqual(self.store._db.execute(count).fetchone()[0], 2)
+        self.assertEqual(list(self.store.render(author='smith')), [(self.ids[1], cite.to_mla())])
+        self.store.delete(self.ids[0])
+        self.assertEqual(self.store._db.execute(count).fetchone()[0], 2)
+        self.assertEqual(len(list(self.store.render(Cite.STYLE_APA))), 2)
+        self.assertRaises(KeyError, self.store.delete, self.ids[0])
+
+    def test_datetime(self):
+        cite_id = self.store.add(Cite('Gardening', date=datetime.datetime(1994, 5, 1, 12, 30)))
+        self.assertEqual(self.store.get(cite_id).date, datetime.date(1994, 5, 1))
+
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + '/store.db'
+            CiteStore(path).close()
+            ids = []
+            failures = []
+
+            def write(n):
+                with CiteStore(path) as store:
+                    for i in range(20):
+                        try:
+                            ids.extend(store.add_many([Cite('Gardening {} {}'.format(n, i))] * 5))
+                        except sqlite3.Error as e:
+                            failures.append(e)
+            threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(failures, [])
+            self.assertEqual(sorted(ids), list(range(1, 401)))
+            with CiteStore(path) as store:
+                self.assertEqual(len(store), 400)
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_round_trip(self):
+        cites = [
+            Cite(title='Wigwams in Timbuktu', authors=Author('David Frederick Livingston', initials=True),
+                 in_title='Wigwam Studies', volume=10, issue=2, pages=[PageRange(15, 22), 30], year=2011),
+            Cite(title='Incan Mythology', authors=['Bob Smith', 'Sheila Pearson'], publisher='Macmillan', year=2002,
+                 in_title='All the Worlds Mythology', in_authors='Neil Tavistock', volume='12a'),
+            Cite('Éléments de jardinage', authors=['Chloé Müller'], date=datetime.date(1994, 5, 1),
+                 markup=Cite.MARKUP_HTML),
+        ]
+        cites[1].journal = 'Mythology Quarterly'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + '/cites.snapshot'
+            self.assertEqual(write_snapshot(cites, path), 3)
+            with Snapshot(path) as snapshot:
+                self.assertEqual(len(snapshot), 3)
+                self.assertEqual([view.to_mla() for view in snapshot], [cite.to_mla() for cite in cites])
+                view = snapshot[-1]
+                self.assertEqual((view.title, view.date, view.markup, view.url), (cites[2].title, cites[2].date,
+                                                                                 Cite.MARKUP_HTML, None))
+                self.assertEqual(snapshot[0].year, 2011)
+                self.assertEqual(snapshot[0].pages, cites[0].pages)
+                self.assertTrue(snapshot[0].authors[0].initials)
+                copy = snapshot[1].to_cite()
+                self.assertEqual((copy.volume, copy.journal, copy.in_authors[0].name),
+                                 ('12a', 'Mythology Quarterly', 'Neil Tavistock'))
+                copy.year = 2003
+                self.assertEqual(snapshot[1].year, 2002)
+                self.assertRaises(IndexError, snapshot.__getitem__, 3)
+
+    def test_not_a_snapshot(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'@book{key, title = {Gardening}}' * 10)
+            f.flush()
+            self.assertRaises(ValueError, Snapshot, f.name)
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.cites = [
+            Cite('Incan Mythology', authors=['Bob Smith', 'Sheila Pearson'], year=2002),
+            Cite('Myths of the Incas', authors='Jane Smithers', year=1999),
+            Cite('Landscape Gardening', authors='Cynthia Davis', year=1994, in_title='Smith Quarterly'),
+            Cite('Smith and Sons', subtitle='A History', authors='Cynthia Davis', date=datetime.date(2002, 1, 1)),
+        ]
+        self.index = SearchIndex(self.cites)
+
+    def titles(self, query, **kwargs):
+        return [cite.title for cite in self.index.search(query, **kwargs)]
+
+    def test_search(self):
+        # Title and author matches outrank in_title ones, and whole words prefixes
+        self.assertEqual(self.titles('smith'), ['Incan Mythology', 'Smith and Sons', 'Myths of the Incas',
+                                                'Landscape Gardening'])
+        self.assertEqual(self.titles('smith '), ['Incan Mythology', 'Smith and Sons', 'Landscape Gardening'])
+        self.assertEqual(self.titles('SMITH 2002'), ['Incan Mythology', 'Smith and Sons'])
+        self.assertEqual(self.titles('davis hist'), ['Smith and Sons'])
+        self.assertEqual(self.titles('sheila myth'), ['Incan Mythology'])
+        self.assertEqual(self.titles('smith', limit=1), ['Incan Mythology'])
+        self.assertEqual(self.titles('inca myth'), [])
+        self.assertEqual(self.titles('  '), [])
+
+    def test_complete(self):
+        self.assertEqual(self.index.complete('my'), ['mythology', 'myths'])
+        self.assertEqual(self.index.complete('incan smi'), ['smith', 'smithers'])
+
+    def test_incremental(self):
+        self.index.remove(self.cites[0])
+        self.assertNotIn(self.cites[0], self.index)
+        self.assertEqual(self.titles('myth'), ['Myths of the Incas'])
+        self.assertEqual(self.index.complete('my'), ['myths'])
+        self.cites[1].title = 'Gardening Myths'
+        self.index.update(self.cites[1])
+        self.assertEqual(self.titles('gardening'), ['Landscape Gardening', 'Gardening Myths'])
+        self.index.remove(self.cites[2])
+        self.index.add(self.cites[0])
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.titles('myth'), ['Gardening Myths', 'Incan Mythology'])
+
+    def test_edit_then_remove_another(self):
+        # Removing a citation takes away the words it was indexed under, not the ones it has now
+        cites = [Cite('Gardening Myths'), Cite('Orchards')] + [Cite('Filler {}'.format(i)) for i in range(10)]
+        index = SearchIndex(cites)
+        cites[1].title = 'Gardening'
+        index.update(cites[1])
+        index.remove(cites[0])
+        self.assertEqual([cite.title for cite in index.search('gardening ')], ['Gardening'])
+        self.assertEqual(index.complete('orch'), [])
+        self.assertEqual(index.complete('garden'), ['gardening'])
+        self.assertEqual(index._counts['gardening'], 1)
+
+
+class TestRenderBibliography(unittest.TestCase):
+    def setUp(self):
+        self.cites = [
+            Cite('Landscape Gardening', authors=['Cynthia Davis', 'Jack Brown'], publisher='Wiley & Sons', year=1994),
+            Cite('The Bible', subtitle='Authorized Version', authors='King James', city='London', year=1611),
+        ]
+
+    def test_sorted_plain(self):
+        self.assertEqual(render_bibliography(self.cites),
+            'Davis, Cynthia, and Brown, Jack. Landscape Gardening. Wiley & Sons, 1994.\n'
+            'James, King. The Bible: Authorized Version. London, 1611.\n')
+        self.assertEqual(render_bibliography(self.cites, sort=False).splitlines(),
+            [c.to_mla() for c in self.cites])
+
+    def test_markup_overrides_cite(self):
+        html = render_bibliography(self.cites, markup=Cite.MARKUP_HTML)
+        self.assertTrue(html.startswith('<ul class="bibliography"'))
+        self.assertIn('<li>James, King. <em>The Bible: Authorized Version.</em> London, 1611.</li>\n', html)
+        self.assertTrue(html.endswith('</ul>\n'))
+        out = render_bibliography(self.cites, style=Cite.STYLE_APA, markup=Cite.MARKUP_MARKDOWN)
+        self.assertEqual(out,
+            '- Davis, C., & Brown, J. (1994). *Landscape Gardening.* Wiley & Sons.\n'
+            '- James, K. (1611). *The Bible: Authorized Version.* London.\n')
+
+    def test_stream(self):
+        buf = io.StringIO()
+        self.assertIsNone(render_bibliography(self.cites, markup=Cite.MARKUP_HTML, out=buf))
+        self.assertEqual(buf.getvalue(), render_bibliography(self.cites, markup=Cite.MARKUP_HTML))
+
+    def test_bad_style(self):
+        with self.assertRaises(ValueError):
+            render_bibliography(self.cites, style='chicago')
+
+    def test_collation(self):
+        cites = [
+            Cite('Zebras', authors='Émile Zola', year=1880),
+            Cite('the Ümlaut', authors='ann adams', year=1999),
+            Cite('An Apple', authors='Ann Adams', year=2001),
+            Cite('Bananas', authors='Ann Adams'),
+            Cite('"Quoted" Title', year=1990),
+            Cite('Apples', authors=['Ann Adams', 'Bob Brown'], year=1990),
+        ]
+        titles = lambda style: [c.title for c in sorted(cites, key=style.sort_key)]
+        self.assertEqual(titles(MLA), ['An Apple', 'Bananas', 'the Ümlaut', 'Apples', '"Quoted" Title', 'Zebras'])
+        self.assertEqual(titles(APA), ['Bananas', 'the Ümlaut', 'An Apple', 'Apples', '"Quoted" Title', 'Zebras'])
+        self.assertEqual(render_bibliography(cites).splitlines()[0], 'Adams, Ann. An Apple. 2001.')
+
+    def test_sort_key_cache(self):
+        cite = self.cites[0]
+        key = MLA.sort_key(cite)
+        self.assertIs(MLA.sort_key(cite), key)
+        cite.title = 'Aardvarks'
+        self.assertEqual(MLA.sort_key(cite).split('\x00')[1], 'aardvarks')
+        cite.authors[0].name = 'Cynthia Ávila'
+        self.assertTrue(MLA.sort_key(cite).startswith('avila\x01cynthia\x02brown\x01jack\x00'))
+
+
+class TestLiveBibliography(unittest.TestCase):
+    def setUp(self):
+        self.cites = [
+            Cite('Landscape Gardening', authors=['Cynthia Davis', 'Jack Brown'], publisher='Wiley & Sons', year=1994),
+            Cite('The Bible', subtitle='Authorized Version', authors='King James', city='London', year=1611),
+            Cite('Incan Mythology', authors='Bob Smith', publisher='Macmillan', year=2002),
+        ]
+        self.bib = LiveBibliography(self.cites)
+        self.addCleanup(self.bib.close)
+
+    def apply(self, lines, diff):
+        for i in reversed(diff.removed):
+            del lines[i]
+        for i, line in diff.inserted:
+            lines.insert(i, line)
+        for i, line in diff.changed:
+            lines[i] = line
+
+    def test_initial(self):
+        self.assertEqual(self.bib.render(), render_bibliography(self.cites))
+        self.assertEqual(self.bib.index(self.cites[1]), 1)
+        self.assertEqual(self.bib.refresh(), ([], [], []))
+
+    def test_changes(self):
+        bible = self.cites[1]
+        bible.year = 1612
+        self.assertEqual(self.bib.refresh(), ([], [], [(1, 'James, King. The Bible: Authorized Version. London, 1612.')]))
+        bible.authors[0].name = 'Adam Zed'
+        self.assertEqual(self.bib.refresh(), ([(2, 'Zed, Adam. The Bible: Authorized Version. London, 1612.')], [1], []))
+        self.bib.remove(self.cites[0])
+        new = Cite('Apple Studies', authors='Ann Archer')
+        self.bib.add(new)
+        self.assertEqual(self.bib.refresh(), ([(0, 'Archer, Ann. Apple Studies.')], [0], []))
+        self.assertEqual(self.bib.render(), render_bibliography(self.cites[1:] + [new]))
+        self.bib.close()
+        bible.year = 1613
+        self.assertEqual(self.bib.refresh(), ([], [], []))
+        self.assertEqual(len(self.bib), 0)
+        self.assertEqual(cite_module._watchers, {})
+
+    def test_same_line_new_place(self):
+        # APA renders initials but sorts by full given names, so the entry moves with its line unchanged
+        cites = [Cite('B', authors='Ann Adams', year=2000), Cite('A', authors='Amy Adams', year=2000)]
+        bib = LiveBibliography(cites, style=Cite.STYLE_APA)
+        self.addCleanup(bib.close)
+        lines = list(bib)
+        cites[0].authors[0].name = 'Aaron Adams'
+        self.apply(lines, bib.refresh())
+        self.assertEqual(list(bib), render_bibliography(cites, Cite.STYLE_APA).splitlines())
+        self.assertEqual(lines, list(bib))
+
+    def test_random_edits(self):
+        rng = random.Random(1)
+        words = ['apple', 'Banana', 'cherry', 'Damson', 'elder']
+        cites = [Cite(' '.join(rng.sample(words, 2)), authors=rng.choice(words)) for _ in range(200)]
+        bib = LiveBibliography(cites[:100], style=Cite.STYLE_APA)
+        self.addCleanup(bib.close)
+        lines = list(bib)
+        present = cites[:100]
+        for _ in range(20):
+            for _ in range(rng.randrange(1, 40)):
+                cite = rng.choice(cites)
+                if cite in bib and rng.random() < 0.2:
+                    bib.remove(cite)
+                    present.remove(cite)
+                elif cite not in bib:
+                    bib.add(cite)
+                    present.append(cite)
+                else:
+                    cite.title = ' '.join(rng.sample(words, 2))
+            self.apply(lines, bib.refresh())
+            self.assertEqual(lines, list(bib))
+            self.assertEqual(bib.render(), render_bibliography(present, style=Cite.STYLE_APA))
+
+
+class TestFormatMany(unittest.TestCase):
+    def make_cites(self, n):
+        return [Cite('Gardening {}'.format(i), authors=[Author('Cynthia Davis', initials=bool(i % 2)), 'Jack Brown'],
+                     pages=[PageRange(i, i + 2)], year=1990 + i % 10, markup=i % 3) for i in range(n)]
+
+    def test_in_process(self):
+        cites = self.make_cites(10)
+        self.assertEqual(format_many(cites, Cite.STYLE_MLA), [c.to_mla() for c in cites])
+        self.assertEqual(format_many(cites, Cite.STYLE_MLA, markup=Cite.MARKUP_HTML),
+                         [MLA.render(c, Cite.MARKUP_HTML) for c in cites])
+        with self.assertRaises(ValueError):
+            format_many(cites, 'chicago')
+
+    def test_records(self):
+        for cite in self.make_cites(3):
+            copy = cite_module._from_record(cite_module._to_record(cite))
+            self.assertEqual(MLA.render(copy, cite.markup), cite.to_mla())
+            self.assertEqual(copy.authors[0].initials, cite.authors[0].initials)
+
+    def test_workers(self):
+        cites = self.make_cites(50)
+        threshold = cite_module.PARALLEL_THRESHOLD
+        cite_module.PARALLEL_THRESHOLD = 10
+        try:
+            out = format_many(iter(cites), Cite.STYLE_APA, workers=2, chunksize=7)
+        finally:
+            cite_module.PARALLEL_THRESHOLD = threshold
+        self.assertEqual(out, [c.to_apa() for c in cites])
+
+    def test_threads(self):
+        cites = self.make_cites(50)
+        self.assertEqual(format_threaded(cites, Cite.STYLE_APA, workers=4, chunksize=7), [c.to_apa() for c in cites])
+        self.assertEqual(format_threaded(cites, workers=1), [c.to_mla() for c in cites])
+
+    def test_concurrent_rendering(self):
+        # Threads format the same citations at once, through the thread pool and through the
+        # cached to_mla()/to_apa(), and all get what rendering them one by one does
+        cites = self.make_cites(200) + [c.freeze() for c in self.make_cites(200)]
+        random.Random(1).shuffle(cites)
+        before = [c if type(c) is FrozenCite else c.freeze() for c in cites]
+        expected = {style: [(MLA if style == Cite.STYLE_MLA else APA).render(c, c.markup) for c in cites]
+                    for style in (Cite.STYLE_MLA, Cite.STYLE_APA)}
+        results = []
+
+        def work(seed):
+            rng = random.Random(seed)
+            for _ in range(5):
+                style = rng.choice((Cite.STYLE_MLA, Cite.STYLE_APA))
+                results.append((style, format_threaded(cites, style, workers=4, chunksize=rng.randint(7, 50))))
+                method = 'to_mla' if style == Cite.STYLE_MLA else 'to_apa'
+                results.append((style, [getattr(c, method)() for c in cites]))
+        threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 80)
+        for style, output in results:
+            self.assertEqual(output, expected[style])
+        self.assertEqual([c if type(c) is FrozenCite else c.freeze() for c in cites], before)
+
+
+class TestFormatServer(unittest.TestCase):
+    async def exchange(self, server, requests):
+        listener = await server.start('127.0.0.1:0')
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            # Pipelined: everything is sent before any reply is read
+            writer.write(''.join([r + '\n' for r in requests]).encode('utf-8'))
+            await writer.drain()
+            replies = [json.loads(await reader.readline()) for _ in requests]
+            writer.close()
+            return replies
+        finally:
+            await server.close()
+
+    def test_requests(self):
+        record = json.dumps({'title': 'Gardening', 'authors': 'Cynthia Davis', 'year': 1994})
+        requests = ['{{"id": {}, "record": {}}}'.format(i, record) for i in range(50)]
+        requests[3] = '{"id": "apa", "style": "apa", "markup": "html", "record": ' + record + '}'
+        requests[7] = '{"id": 7, "record": {"authors": "Cynthia Davis"}}'
+        requests[9] = '[1, 2'
+        requests.append('{"op": "stats"}')
+        server = FormatServer(batch_size=8, max_in_flight=4)
+        replies = asyncio.run(self.exchange(server, requests))
+        self.assertEqual(replies[0], {'id': 0, 'citation': 'Davis, Cynthia. Gardening. 1994.'})
+        self.assertEqual(replies[3], {'id': 'apa', 'citation': 'Davis, C. (1994). <em>Gardening.</em>'})
+        self.assertEqual(replies[7], {'id': 7, 'error': 'Record has no title'})
+        self.assertIsNone(replies[9]['id'])
+        self.assertIn('error', replies[9])
+        self.assertEqual([r['id'] for r in replies[10:50]], list(range(10, 50)))
+        stats = replies[-1]['stats']
+        self.assertEqual(stats['requests'], 51)
+        self.assertEqual(stats['errors'], 2)
+        self.assertLessEqual(stats['mean_batch_size'], 8)
+        self.assertLessEqual(stats['latency_p50_ms'], stats['latency_max_ms'])
+        self.assertLessEqual(stats['in_flight'], 4)
+
+
+class TestCommandLine(unittest.TestCase):
+    def run_main(self, argv, text):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        status = cite_module.main(argv, io.StringIO(text), stdout, stderr)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_from_dict(self):
+        cite = Cite.from_dict({'title': 'Gardening', 'authors': 'Cynthia Davis; Jack Brown', 'year': '1994',
+                               'pages': '5--9, 12', 'city': ''})
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia, and Brown, Jack. Gardening. 1994. pp. 5-9, 12.')
+        self.assertEqual(cite.year, 1994)
+        with self.assertRaises(AttributeError):
+            Cite.from_dict({'title': 'Gardening', 'isbn': '123'})
+        with self.assertRaises(ValueError):
+            Cite.from_dict({'authors': 'Cynthia Davis'})
+
+    def test_from_records(self):
+        records = [{'title': 'Gardening', 'authors': 'Cynthia Davis; Jack Brown', 'year': '1994', 'pages': '5--9, 12',
+                    'city': ''},
+                   {'title': 'Gardening', 'isbn': '123'},
+                   {'authors': 'Cynthia Davis'},
+                   {'title': 'Mythology', 'pages': 'ix'},
+                   {'title': 'Wigwams', 'authors': ['David Livingston'], 'in_title': 'Wigwam Studies', 'volume': 10,
+                    'journal': 'Wigwam Studies', 'date': '2011-04-01', 'markup': '2'},
+                   {'title': 'Gardening', 'isbn': '456'}]
+        report = Cite.from_records(iter(records))
+        self.assertEqual([index for index, _ in report.errors], [1, 2, 3, 5])
+        self.assertIn("'isbn' is unsupported", report.errors[0][1])
+        self.assertEqual(report.errors[1][1], 'Record has no title')
+        self.assertEqual(len(report.cites), 2)
+        for cite, record in zip(report.cites, (records[0], records[4])):
+            expected = Cite.from_dict(record)
+            self.assertEqual(repr(cite.__getstate__()), repr(expected.__getstate__()))
+            self.assertEqual((cite.to_mla(), cite.to_apa()), (expected.to_mla(), expected.to_apa()))
+        self.assertFalse(hasattr(report.cites[0], 'journal'))
+
+        # Built without __setattr__(), but changes still reach the render cache
+        cite = report.cites[0]
+        cite.authors.append('Bob Smith')
+        cite.pages.add(40)
+        self.assertEqual(cite.to_mla(), 'Davis, Cynthia, Brown, Jack, and Smith, Bob. Gardening. 1994. pp. 5-9, 12, 40.')
+        cite.year = 1995
+        self.assertIn('1995', cite.to_mla())
+
+    def test_jsonl(self):
+        status, out, err = self.run_main(['--style', 'apa', '--markup', 'html', '--stats'],
+            '{"title": "Landscape Gardening", "authors": ["Cynthia Davis"], "year": 1994}\n'
+            '\n'
+            '{"title": "Incan Mythology", "authors": "Bob Smith", "publisher": "Macmillan"}\n')
+        self.assertEqual(status, 0)
+        self.assertEqual(out, 'Davis, C. (1994). <em>Landscape Gardening.</em>\n'
+                              'Smith, B. <em>Incan Mythology.</em> Macmillan.\n')
+        self.assertIn('2 records in', err)
+
+    def test_csv_and_errors(self):
+        status, out, err = self.run_main([],
+            'title,authors,year\n'
+            'Landscape Gardening,Cynthia Davis; Jack Brown,1994\n'
+            ',Nobody,2000\n')
+        self.assertEqual(status, 1)
+        self.assertEqual(out, 'Davis, Cynthia, and Brown, Jack. Landscape Gardening. 1994.\n')
+        self.assertEqual(err, 'line 3: Record has no title\n')
+
+    def test_values_that_would_not_render(self):
+        status, out, err = self.run_main([],
+            '{"title": "Gardening", "edition": 2, "year": 1994}\n'
+            '{"title": "Orchards", "edition": [2]}\n'
+            '{"title": "Myths", "markup": 7}\n'
+            '{"title": "Wigwams", "date": 1999}\n'
+            '{"title": "Incan Mythology"}\n')
+        self.assertEqual(status, 1)
+        self.assertEqual(out, 'Gardening. 2 ed. 1994.\nIncan Mythology.\n')
+        self.assertEqual(err, "line 2: The attribute 'edition' must be text, not list\n"
+                              "line 3: Unknown markup: 7\n"
+                              "line 4: The attribute 'date' must be a date, not int\n")
+        self.assertEqual(Cite.from_dict({'title': 'Gardening', 'edition': 2}).edition, '2')
+
 
 if __name__ == '__main__':
     unittest.main()